@@ -0,0 +1,88 @@
+# ------------------------------------------------------------------------------
+# Copyright 2021 Mohammad Reza Golsorkhi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+# name: bench_registration.py
+# Description: per job construction cost of create_job, create_class_job and create_jobs
+# Version: 0.1.0
+# Author: Mohammad Reza Golsorkhi
+# ------------------------------------------------------------------------------
+"""
+run from repository root:
+
+    python -m benchmarks.bench_registration --jobs 50000
+
+only public Agent API is used so the same script can measure an older checkout
+"""
+
+import argparse
+import datetime
+import logging
+import time
+
+from src.agent import Agent
+from src.agent.job import Job
+
+OPTIONS = {
+    'scheduler': 'interval',
+    'start_time': datetime.datetime.now() + datetime.timedelta(days=1),
+    'interval': 60
+}
+
+
+def _job_func(message, job):
+    return message
+
+
+class _ClassJob(Job):
+    def run(self, message):
+        return message
+
+
+def _per_job_us(func, n):
+    agent = Agent()
+    started = time.perf_counter()
+    func(agent, n)
+    return (time.perf_counter() - started) / n * 1e6
+
+
+def create_job(agent, n):
+    for i in range(n):
+        agent.create_job(func=_job_func, options=OPTIONS, args=('m',), name=f'job_{i}')
+
+
+def create_class_job(agent, n):
+    for i in range(n):
+        agent.create_class_job(job=_ClassJob, options=OPTIONS, args=('m',), name=f'job_{i}')
+
+
+def create_jobs(agent, n):
+    agent.create_jobs({'func': _job_func, 'options': OPTIONS, 'args': ('m',), 'name': f'job_{i}'} for i in range(n))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--jobs', type=int, default=50000)
+    args = parser.parse_args(argv)
+    logging.disable(logging.CRITICAL)
+
+    benches = [create_job, create_class_job]
+    if hasattr(Agent, 'create_jobs'):
+        benches.append(create_jobs)
+    for bench in benches:
+        print(f'{bench.__name__:<20}{args.jobs:>10} jobs {_per_job_us(bench, args.jobs):>10.2f} us/job')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# ------------------------------------------------------------------------------
+# Copyright 2021 Mohammad Reza Golsorkhi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+# name: bench_scheduler.py
+# Description: compare scheduler backends on schedule, reschedule, pop and cancel
+# Version: 0.1.0
+# Author: Mohammad Reza Golsorkhi
+# ------------------------------------------------------------------------------
+"""
+run from repository root:
+
+    python -m benchmarks.bench_scheduler --sizes 1000 10000 100000 1000000
+"""
+
+import argparse
+import datetime
+import random
+import time
+
+from src.agent import scheduler as _scheduler
+from src.agent.scheduler import create_scheduler
+
+BACKENDS = {
+    'heap': {'backend': 'heap'},
+    'timing_wheel': {'backend': 'timing_wheel', 'tick': 0.01},
+}
+if _scheduler.numpy is not None:
+    BACKENDS['vectorized'] = {'backend': 'vectorized', 'capacity': 1024}
+
+OPTIONS = {'scheduler': 'interval', 'interval': 5}
+
+
+class _Job:
+    """
+    the schedulers only read next_run_time so a real Job is not needed
+    """
+    __slots__ = ('next_run_time', 'options', '__weakref__')
+
+    def __init__(self, next_run_time):
+        self.next_run_time = next_run_time
+        self.options = OPTIONS
+
+
+def _per_op(seconds, n):
+    return seconds / n * 1e6
+
+
+def bench(backend, n, seed=0):
+    rnd = random.Random(seed)
+    now = datetime.datetime.now()
+    # short interval fleet plus some far future start_time values
+    jobs = [_Job(now + datetime.timedelta(seconds=rnd.uniform(0, 60) if i % 100 else rnd.uniform(0, 86400 * 30)))
+            for i in range(n)]
+    scheduler = create_scheduler(BACKENDS[backend])
+
+    started = time.perf_counter()
+    for job in jobs:
+        scheduler.schedule(job)
+    schedule_time = time.perf_counter() - started
+
+    # what Cnrt._interval cause, every job move a few seconds
+    for job in jobs:
+        job.next_run_time += datetime.timedelta(seconds=5)
+    started = time.perf_counter()
+    for job in jobs:
+        scheduler.schedule(job)
+    reschedule_time = time.perf_counter() - started
+
+    # drain the next 70 seconds in 100 ms agent wake ups
+    base = time.monotonic()
+    popped = 0
+    started = time.perf_counter()
+    for step in range(1, 701):
+        popped += len(scheduler.pop_due(base + step * 0.1))
+    pop_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for job in jobs:
+        scheduler.cancel(job)
+    cancel_time = time.perf_counter() - started
+
+    return {
+        'backend': backend,
+        'jobs': n,
+        'schedule_us': _per_op(schedule_time, n),
+        'reschedule_us': _per_op(reschedule_time, n),
+        'pop_us': _per_op(pop_time, max(popped, 1)),
+        'cancel_us': _per_op(cancel_time, n),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--backends', nargs='+', default=list(BACKENDS), choices=list(BACKENDS))
+    args = parser.parse_args(argv)
+
+    print(f'{"backend":<14}{"jobs":>10}{"schedule us":>14}{"reschedule us":>16}{"pop us":>10}{"cancel us":>12}')
+    for n in args.sizes:
+        for backend in args.backends:
+            r = bench(backend, n)
+            print(f'{r["backend"]:<14}{r["jobs"]:>10}{r["schedule_us"]:>14.2f}{r["reschedule_us"]:>16.2f}'
+                  f'{r["pop_us"]:>10.2f}{r["cancel_us"]:>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
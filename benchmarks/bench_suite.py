@@ -0,0 +1,320 @@
+# ------------------------------------------------------------------------------
+# Copyright 2021 Mohammad Reza Golsorkhi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+# name: bench_suite.py
+# Description: registration, dispatch, throughput, idle cpu, memory and job file benchmarks of agent
+# Version: 0.1.0
+# Author: Mohammad Reza Golsorkhi
+# ------------------------------------------------------------------------------
+"""
+run from repository root:
+
+    python -m benchmarks.bench_suite --sizes 100 10000 100000 --output results.json
+    python -m benchmarks.bench_suite --baseline results.json
+
+every size is a fleet of registered jobs that are due in a day, the measured jobs run beside them
+results are written as json and compared whit a baseline, exit status is 1 if a metric regressed
+"""
+
+import argparse
+import datetime
+import gc
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from src.agent import Agent
+from src.agent.job import Job
+
+FAR_OPTIONS = {
+    'scheduler': 'interval',
+    'start_time': datetime.datetime.now() + datetime.timedelta(days=1),
+    'interval': 60
+}
+
+# metrics where a larger value is better, every other metric is better when smaller
+HIGHER_IS_BETTER = {'runs_per_second', 'save_job_per_second', 'load_job_per_second', 'load_jobs_per_second'}
+
+
+def _job_func(message):
+    return message
+
+
+class _ClassJob(Job):
+    def run(self, message):
+        return message
+
+
+def _fleet(agent, n):
+    agent.create_jobs({'func': _job_func, 'options': FAR_OPTIONS, 'args': ('m',), 'name': f'fleet_{i}'}
+                      for i in range(n))
+
+
+def _per_job_us(setup, n):
+    agent = Agent()
+    gc.collect()
+    started = time.perf_counter()
+    setup(agent, n)
+    return (time.perf_counter() - started) / n * 1e6
+
+
+def bench_registration(n):
+    def create_job(agent, n):
+        for i in range(n):
+            agent.create_job(func=_job_func, options=FAR_OPTIONS, args=('m',), name=f'job_{i}')
+
+    def create_job_decorator(agent, n):
+        for i in range(n):
+            agent.create_job_decorator(options=FAR_OPTIONS, args=('m',), name=f'job_{i}')(_job_func)
+
+    def create_class_job(agent, n):
+        for i in range(n):
+            agent.create_class_job(job=_ClassJob, options=FAR_OPTIONS, args=('m',), name=f'job_{i}')
+
+    return {
+        'create_job_us': _per_job_us(create_job, n),
+        'create_job_decorator_us': _per_job_us(create_job_decorator, n),
+        'create_class_job_us': _per_job_us(create_class_job, n),
+    }
+
+
+def bench_dispatch_latency(n, probes=50, spread=1.0):
+    """
+    seconds from next_run_time of a probe job to its function starting
+    """
+    agent = Agent()
+    _fleet(agent, n)
+    latencies = []
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def probe(planned):
+        latency = (datetime.datetime.now() - planned).total_seconds()
+        with lock:
+            latencies.append(latency)
+            if len(latencies) == probes:
+                done.set()
+
+    start = datetime.datetime.now() + datetime.timedelta(seconds=0.5)
+    for i in range(probes):
+        planned = start + datetime.timedelta(seconds=spread * i / probes)
+        agent.create_job(func=probe, args=(planned,), name=f'probe_{i}',
+                         options={'scheduler': 'interval', 'start_time': planned, 'interval': 3600})
+    agent.start()
+    try:
+        done.wait(spread + 30)
+    finally:
+        agent.stop()
+    latencies.sort()
+    return {
+        'dispatch_p50_ms': statistics.median(latencies) * 1e3,
+        'dispatch_p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1e3,
+        'dispatch_max_ms': latencies[-1] * 1e3,
+    }
+
+
+def bench_throughput(n, jobs=100, interval=0.02, duration=2.0):
+    """
+    runs per second of a group of short interval jobs beside the fleet
+    """
+    agent = Agent()
+    _fleet(agent, n)
+    counter = [0]
+    lock = threading.Lock()
+
+    def count():
+        with lock:
+            counter[0] += 1
+
+    start = datetime.datetime.now() + datetime.timedelta(seconds=0.2)
+    for i in range(jobs):
+        agent.create_job(func=count, name=f'busy_{i}',
+                         options={'scheduler': 'interval', 'start_time': start, 'interval': interval,
+                                  'coalesce': True})
+    agent.start()
+    try:
+        time.sleep(0.2)
+        before = counter[0]
+        started = time.perf_counter()
+        time.sleep(duration)
+        runs = counter[0] - before
+        elapsed = time.perf_counter() - started
+    finally:
+        agent.stop()
+    return {'runs_per_second': runs / elapsed}
+
+
+def bench_idle_cpu(n, duration=1.0):
+    """
+    cpu of the process while agent wait for a fleet that is not due
+    """
+    agent = Agent()
+    _fleet(agent, n)
+    agent.start()
+    try:
+        time.sleep(0.1)
+        cpu = time.process_time()
+        time.sleep(duration)
+        cpu = time.process_time() - cpu
+    finally:
+        agent.stop()
+    return {'idle_cpu_percent': cpu / duration * 100}
+
+
+def bench_memory(n):
+    """
+    bytes that tracemalloc count per registered job
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        agent = Agent()
+        _fleet(agent, n)
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del agent
+    return {'memory_per_job_bytes': (after - before) / n}
+
+
+def bench_job_files(n):
+    agent = Agent()
+    _fleet(agent, n)
+    directory = tempfile.mkdtemp()
+    try:
+        jobs = list(agent.jobs)
+        started = time.perf_counter()
+        for job in jobs:
+            agent.save_job(job, directory)
+        save_time = time.perf_counter() - started
+
+        paths = [os.path.join(directory, f'{job.name}.job') for job in jobs]
+        loader = Agent()
+        started = time.perf_counter()
+        for path in paths:
+            loader.load_job(path)
+        load_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        report = Agent().load_jobs(directory, manifest=False)
+        load_jobs_time = time.perf_counter() - started
+        if report.errors:
+            raise RuntimeError(f'{len(report.errors)} job files could not be loaded')
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        'save_job_per_second': n / save_time,
+        'load_job_per_second': n / load_time,
+        'load_jobs_per_second': n / load_jobs_time,
+    }
+
+
+BENCHES = {
+    'registration': bench_registration,
+    'dispatch': bench_dispatch_latency,
+    'throughput': bench_throughput,
+    'idle_cpu': bench_idle_cpu,
+    'memory': bench_memory,
+    'job_files': bench_job_files,
+}
+
+
+def run(sizes, benches=tuple(BENCHES), file_cap=10000):
+    """
+    :param file_cap: job file benchmarks write at most this many files
+    :return: dict that is written as json
+    """
+    results = {}
+    for n in sizes:
+        results[str(n)] = {}
+        for name in benches:
+            size = min(n, file_cap) if name == 'job_files' else n
+            result = BENCHES[name](size)
+            results[str(n)].update(result)
+            for metric, value in result.items():
+                print(f'{n:>8} {metric:<26}{value:>14.3f}', file=sys.stderr)
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        },
+        'results': results,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    :param tolerance: relative change that is not a regression
+    :return: list of (size, metric, baseline value, value, relative change) that regressed
+    """
+    regressions = []
+    for size, metrics in results['results'].items():
+        for metric, value in metrics.items():
+            base = baseline['results'].get(size, {}).get(metric)
+            if not base:
+                continue
+            change = (value - base) / abs(base)
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            if worse > tolerance:
+                regressions.append((size, metric, base, value, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 10000, 100000])
+    parser.add_argument('--benches', nargs='+', default=list(BENCHES), choices=list(BENCHES))
+    parser.add_argument('--file-cap', type=int, default=10000, help='max job files of save/load benchmarks')
+    parser.add_argument('--output', help='write json results to this file, default is stdout')
+    parser.add_argument('--baseline', help='json results of a previous run to compare whit')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='relative change that is allowed')
+    args = parser.parse_args(argv)
+    logging.disable(logging.CRITICAL)
+
+    results = run(args.sizes, args.benches, args.file_cap)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.tolerance)
+        for size, metric, base, value, change in regressions:
+            print(f'regression {size:>8} {metric:<26}{base:>14.3f} -> {value:<14.3f}{change:+.1%}', file=sys.stderr)
+        if regressions:
+            return 1
+        print('no regression', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1 +1,2 @@
-from src.agent.agent import Agent
\ No newline at end of file
+from src.agent.agent import Agent
+from src.agent.async_agent import AsyncAgent
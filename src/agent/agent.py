@@ -20,30 +20,36 @@
 # ------------------------------------------------------------------------------
 
 
+import collections
 import datetime
+import gc
+import heapq
+import itertools
+import os
 import threading
-from time import sleep
+from http.server import ThreadingHTTPServer
+from time import monotonic, perf_counter
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
 
 import src.agent.exceptions as exceptions
 import src.agent.interrupt as _interrupt
-from src.agent.job import FunctionJob, Job
+import src.agent.loader as loader
+import src.agent.serialization as serialization
+from src.agent.job import FunctionJob, Job, LastRuntimeState, agent_construction
+from src.agent.executor import RUN_LATE, JobRun, ProcessPool, RunWatchdog, WorkerPool
+from src.agent.limits import ConcurrencyLimiter, RateLimits
+from src.agent.metrics import AgentMetrics, DEFAULT_BUCKETS, start_http_server
+from src.agent.registry import JobRegistry
+from src.agent.history import LagSummary
+from src.agent.scheduler import create_scheduler, job_deadline
 import logging
 from pathlib import Path
 
-try:
-    import dill
-
-    is_dill_available = True
-except ImportError:
-    is_dill_available = False
-
 logger = logging.getLogger(__name__)
 
-
-def handle_error_no_dill():
-    print(f"""
-    dill in not installed
-    """)
+# options that if are not changed a reloaded job keep its next_run_time
+_SCHEDULE_OPTIONS = ('scheduler', 'start_time', 'interval', 'cron', 'timezone', 'custom_time_scheduler',
+                     'scheduler_args')
 
 
 class Agent:
@@ -51,22 +57,120 @@ class Agent:
     _initialized = False
     _Agent_counter = 0
     _job_id_counter = 0
+    dispatch_policies = ('fifo', 'priority', 'edf')
 
     def __repr__(self):
         return f'name : {self.name} agent_id : {self._id}'
 
-    def __init__(self, daemon=True, id=None, name=None, **kwargs):
+    def __init__(self, daemon=True, id=None, name=None, scheduler_options: Optional[Dict[str, Any]] = None,
+                 executor_options: Optional[Dict[str, Any]] = None, jobstore=None,
+                 jobstore_options: Optional[Dict[str, Any]] = None, watch_options: Optional[Dict[str, Any]] = None,
+                 checkpoint=None, metrics_options: Optional[Dict[str, Any]] = None, **kwargs):
+        """
+        :param daemon: run agent thread as daemon
+        :param id: agent id default is a counter
+        :param name: agent name default is Agent-<id>
+        :param scheduler_options: dict that choose timer queue backend
+        {'backend': 'heap'} is default, {'backend': 'timing_wheel', 'tick': 0.01, 'wheel_size': 256, 'levels': 4}
+        is faster for very large numbers of short interval jobs
+        :param executor_options: dict for worker pool that run jobs
+        'max_workers' default is min(32, cpu count + 4), 'max_queue_size' default is 1000 (0 for no limit),
+        'overflow_policy' is 'block' (default), 'drop' or 'run_late' and 'run_late_delay' seconds default is 1
+        a job that start a job from a worker thread never block on a full queue, that run is run late instead
+        jobs whit options['executor'] = 'process' run in a pool of 'max_processes' (default cpu count) worker
+        processes started whit multiprocessing start method 'mp_context' (default 'spawn', 'fork' is opt-in
+        because forking a process whit threads can deadlock the child)
+        'max_concurrent_jobs' limit runs of all jobs and 'tag_limits' {tag: n} limit runs of jobs whit a tag in
+        options['tags'], runs that wait for a slot are queued without a thread
+        'dispatch_policy' decide which due runs get workers and slots first, 'fifo' (default), 'priority' by
+        options['priority'] of jobs (larger first) whit 'aging' seconds that raise priority of a waiting run by 1
+        (default is no aging, so runs of low priority jobs can wait forever while higher priority runs keep coming),
+        or 'edf' by earliest deadline that is due time plus options['deadline_tolerance'] of job
+        'tag_rate_limits' {tag: {'rate': runs per second, 'burst': n}} are token buckets of jobs whit a tag like
+        options['rate_limit'] of a job, a run that find no token is delayed until its token is refilled
+        :param jobstore: a instance of BaseJobStore like SQLiteJobStore, stored jobs are loaded when they are due
+        :param jobstore_options: dict whit 'window' seconds ahead that due jobs are loaded (default 60) and
+        'poll_interval' seconds between loads (default window / 2)
+        :param watch_options: dict whit 'directory' of job files that agent keep in sync while it is running,
+        'poll_interval' seconds (default 1), 'pattern' (default '*.job') and 'full_scan_interval' seconds that
+        files edited in place are found (default 60)
+        :param checkpoint: a instance of CheckpointLog, state of jobs is written to it on every change and jobs
+        that are added whit a name found in it resume whit their checkpointed state
+        :param metrics_options: dict that enable agent.metrics, 'buckets' of histograms in seconds and 'port' and
+        'address' (default 127.0.0.1) of a http listener of prometheus text format that run while agent is started
+        :param kwargs: saved as agent attribute
+        """
         # increment
         Agent._Agent_counter += 1
 
         self._id = Agent._Agent_counter if id is None else id
-        self.jobs = []
+        self.jobs = JobRegistry()
         self._daemon = daemon
         self._started = threading.Event()
         self._is_stop = threading.Event()
+        self._scheduler = create_scheduler(scheduler_options)
+        # interrupts that are set and wait for agent thread, deque append and popleft are thread safe
+        self._interrupts: Deque[_interrupt.BaseInterrupt] = collections.deque()
         self._interrupt = _interrupt.NoneInterrupt(self)
 
         self._name = str(name or Agent._newname())
+        self._executor_options = executor_options or {}
+        self._dispatch_policy = self._executor_options.get('dispatch_policy', 'fifo')
+        if self._dispatch_policy not in self.dispatch_policies:
+            raise exceptions.InvalidOption(f'dispatch_policy must be one of {self.dispatch_policies}')
+        self._aging = self._executor_options.get('aging')
+        if self._aging is not None and self._aging <= 0:
+            raise exceptions.InvalidOption('aging must be greater than 0')
+        prioritized = self._dispatch_policy != 'fifo'
+        # priority: LagSummary of how late runs started
+        self._start_lag: Dict[float, LagSummary] = {}
+        self._start_lag_lock = threading.Lock()
+        self._executor = WorkerPool(max_workers=self._executor_options.get('max_workers'),
+                                    max_queue_size=self._executor_options.get('max_queue_size', 1000),
+                                    overflow_policy=self._executor_options.get('overflow_policy', 'block'),
+                                    name=self._name, daemon=daemon, run_late=self._run_late,
+                                    prioritized=prioritized)
+        self._limiter = ConcurrencyLimiter(self._executor_options.get('max_concurrent_jobs'),
+                                           self._executor_options.get('tag_limits'), prioritized)
+        self._rate_limits = RateLimits(self._executor_options.get('tag_rate_limits'))
+        # (monotonic time, counter, run) of runs that wait for rate limit tokens
+        self._deferred: List[Tuple[float, int, JobRun]] = []
+        self._deferred_lock = threading.Lock()
+        self._deferred_changed = threading.Condition(self._deferred_lock)
+        self._deferred_counter = itertools.count()
+        # thread that submit deferred runs while agent loop is not running
+        self._deferred_thread: Optional[threading.Thread] = None
+        self._process_pool = ProcessPool(max_processes=self._executor_options.get('max_processes'),
+                                         mp_context=self._executor_options.get('mp_context', 'spawn'),
+                                         name=self._name)
+        # cancel runs of jobs that are longer than options['run_timeout']
+        self._watchdog = RunWatchdog(name=self._name)
+        self._jobstore = jobstore
+        self._jobstore_options = jobstore_options or {}
+        # loaded jobs that are saved in jobstore
+        self._stored_jobs: Set[Job] = set()
+        self._next_poll = 0
+        self._watch_options = watch_options or {}
+        self._watcher: Optional[loader.DirectoryWatcher] = None
+        if self._watch_options.get('directory') is not None:
+            self._watcher = loader.DirectoryWatcher(self._watch_options['directory'],
+                                                    self._watch_options.get('pattern', '*.job'),
+                                                    self._watch_options.get('full_scan_interval', 60))
+        # file name of watched directory: job
+        self._watched_jobs: Dict[str, Job] = {}
+        # path of file that load_jobs loaded: job, an unchanged file of a job that is still in agent is skipped
+        self._loaded_files: Dict[str, Job] = {}
+        # directory that load_jobs loaded: Manifest of its files
+        self._manifests: Dict[str, loader.Manifest] = {}
+        # job whose definition is changed: new job that replace it after its run
+        self._pending_swaps: Dict[Job, Job] = {}
+        self._next_watch = 0
+        self._checkpoint = checkpoint
+        self._metrics_options = metrics_options or {}
+        self.metrics = None
+        self._metrics_server: Optional[ThreadingHTTPServer] = None
+        if metrics_options is not None:
+            self.metrics = AgentMetrics(self, metrics_options.get('buckets', DEFAULT_BUCKETS))
         self.is_running = threading.Event()
         self.__dict__.update(kwargs)
         self._initialized = True
@@ -78,21 +182,481 @@ class Agent:
     def _agent(self):
         self.is_running.set()
         logger.info(msg=f'agent {self.name} started')
-        while not self._is_stop.is_set():
-            for job in self.jobs:
-                if self._interrupt.is_set():
-                    self._interrupt.lock.acquire()
-                    self._interrupt.interrupt_handler()
-                    self._interrupt.lock.release()
-                    self._interrupt.clear()
-                if (job.initialized is True) and (job.is_not_running.is_set() and job.is_enable) and (
-                        job.next_run_time <= datetime.datetime.now()):
-                    job.start(0.01)
-            sleep(1)
+        while True:
+            self._handle_interrupts()
+            if self._is_stop.is_set():
+                break
+            iteration_start = perf_counter()
+            for job in self._order_due(self._scheduler.pop_due()):
+                self._dispatch(job)
+            timeout = self._run_periodic()
+            if self.metrics is not None:
+                self.metrics.loop_seconds.set(perf_counter() - iteration_start)
+            self._scheduler.wait(timeout)
         self.is_running.clear()
         logger.info(msg=f'agent {self.name} stopped')
         return 0
 
+    def _dispatch(self, job: Job):
+        """
+        start a due job and record in job.status['last_lag'] how late it is
+        a run that is later than options['misfire_grace_time'] is skipped
+        """
+        if not ((job.initialized is True) and job.is_enable and
+                job._admitted + job._parked + job._deferred < job.max_instances):
+            return
+        lag = job._dispatch_lag()
+        grace = job.options.get('misfire_grace_time')
+        if grace is not None and lag > grace:
+            job._misfire(lag)
+            return
+        job.status['last_lag'] = lag
+        if self.metrics is not None:
+            self.metrics.dispatch_lag.observe(lag)
+        job.start(0.01)
+
+    def _post_interrupt(self, interrupt: _interrupt.BaseInterrupt):
+        """
+        queue a interrupt that is set and wake up agent thread, it never block
+        """
+        self._interrupts.append(interrupt)
+        self._wakeup()
+
+    def _handle_interrupts(self):
+        """
+        run handler of every queued interrupt in the order they are set
+        """
+        while self._interrupts:
+            interrupt = self._interrupts.popleft()
+            # a interrupt that is set twice before it is handled is queued twice but handled once
+            if not interrupt.is_set():
+                continue
+            with interrupt.lock:
+                # clear before handler so a set during handler queue the interrupt again
+                interrupt.clear()
+                try:
+                    interrupt.interrupt_handler()
+                except Exception:
+                    logger.error(msg=f'interrupt {type(interrupt).__name__} of agent {self.name} failed', exc_info=True)
+
+    def _schedule_job(self, job: Job):
+        """
+        put job in timer queue or move it to its new next_run_time
+        jobs call this when next_run_time or is_enable change or a run is done
+        """
+        if not self._job_changed(job):
+            return
+        if job.is_enable:
+            self._scheduler.schedule(job)
+        else:
+            self._scheduler.cancel(job)
+
+    def _job_changed(self, job: Job):
+        """
+        keep pending reloads, checkpoint and jobstore in sync whit state of job
+        :return: True if job still belong to agent and must be scheduled
+        """
+        if job.agent is not self or job not in self.jobs:
+            return False
+        if job in self._pending_swaps:
+            # definition changed while job was running, new job take its place after the run
+            self._swap_if_idle(job)
+            if job not in self.jobs:
+                return False
+        if self._checkpoint is not None:
+            state = self._checkpoint.pop_replayed(job._name)
+            if state is not None:
+                self._restore_checkpoint(job, state)
+            self._checkpoint.record(job)
+        if job in self._stored_jobs:
+            self._jobstore.update_job_state(job)
+        return True
+
+    @staticmethod
+    def _restore_checkpoint(job: Job, state):
+        """
+        job resume whit state that it had before agent restart, a past next_run_time follow misfire options
+        """
+        job._fail_count = state['fail_count']
+        job.status['LastRunState'] = LastRuntimeState[state['last_run_state']]
+        job.status['LastRuntime'] = state['last_runtime']
+        job.update_status()
+        job._is_enable = state['is_enable']
+        job._next_run_time = state['next_run_time']
+        job._planned_deadline = None
+
+    def _unschedule_job(self, job: Job):
+        """
+        remove job from timer queue
+        """
+        self._scheduler.cancel(job)
+
+    def _submit(self, job: Job):
+        """
+        give a run of job to worker pool when it get its concurrency slots, until then it wait in limiter
+        :return: JobRun or None if run did not queued
+        """
+        run = self._new_run(job)
+        delay = self._rate_limits.reserve(job)
+        if delay > 0:
+            self._defer(run, delay)
+            return run
+        return self._admit(run)
+
+    def _admit(self, run: JobRun):
+        job = run.job
+        if not self._limiter.admit(run):
+            logger.debug(msg=f'job {job.name} wait for a concurrency slot')
+            return run
+        started = self._start_run(run)
+        if started is None or started is RUN_LATE:
+            self._run_dropped(job, late=started is RUN_LATE)
+            return None
+        return run
+
+    def _defer(self, run: JobRun, delay):
+        """
+        run did not get a rate limit token, submit it when its token is refilled
+        """
+        job = run.job
+        self._limiter.defer(job)
+        logger.debug(msg=f'job {job.name} is rate limited, it run after {delay:.3f} seconds')
+        if self.metrics is not None:
+            self.metrics.throttled.labels(job.name).inc()
+        with self._deferred_lock:
+            heapq.heappush(self._deferred, (monotonic() + delay, next(self._deferred_counter), run))
+            if not self.is_running.is_set():
+                # no agent loop to wait for it, one thread wait for every deferred run
+                if self._deferred_thread is None:
+                    self._deferred_thread = threading.Thread(target=self._drain_deferred, daemon=True,
+                                                             name=f'{self._name}_deferred')
+                    self._deferred_thread.start()
+                else:
+                    self._deferred_changed.notify()
+                return
+        self._wakeup()
+
+    def _drain_deferred(self):
+        """
+        submit deferred runs until there is none or agent loop take them over
+        """
+        while True:
+            with self._deferred_lock:
+                if not self._deferred or self.is_running.is_set():
+                    self._deferred_thread = None
+                    return
+                timeout = self._deferred[0][0] - monotonic()
+                if timeout > 0:
+                    self._deferred_changed.wait(timeout)
+                    continue
+            self._release_deferred()
+
+    def _submit_deferred(self, run: JobRun):
+        self._limiter.undefer(run.job)
+        if self._admit(run) is None:
+            run._done.set()
+
+    def _release_deferred(self):
+        """
+        submit deferred runs whose tokens are refilled
+        :return: seconds until the next deferred run or None
+        """
+        if not self._deferred:
+            return None
+        now = monotonic()
+        ready = []
+        with self._deferred_lock:
+            while self._deferred and self._deferred[0][0] <= now:
+                ready.append(heapq.heappop(self._deferred)[-1])
+            timeout = max(self._deferred[0][0] - now, 0) if self._deferred else None
+        for run in ready:
+            self._submit_deferred(run)
+        return timeout
+
+    def rate_limit_stats(self):
+        """
+        token level, allowed and throttled runs of rate limits
+        :return: {'jobs': {job name: stats}, 'tags': {tag: stats}}
+        """
+        return {
+            'jobs': {job.name: job._rate_bucket.stats() for job in self.jobs if job._rate_bucket is not None},
+            'tags': self._rate_limits.stats(),
+        }
+
+    def _order_due(self, jobs):
+        """
+        jobs that are due at the same time are dispatched by dispatch_policy
+        """
+        if self._dispatch_policy == 'fifo' or len(jobs) < 2:
+            return jobs
+        now = monotonic()
+        return sorted(jobs, key=lambda job: self._run_key(job, min(job_deadline(job) or now, now), now))
+
+    def _run_key(self, job: Job, due, now):
+        """
+        :return: order of a run in worker queue and limiter, smaller first
+        """
+        if self._dispatch_policy == 'edf':
+            return due + job.deadline_tolerance
+        if self._dispatch_policy == 'priority':
+            if self._aging is not None:
+                # priority + waited / aging at any later time t has the same order as this
+                return now / self._aging - job.priority
+            return -job.priority
+        return None
+
+    def _run_class(self, job: Job):
+        return JobRun
+
+    def _new_run(self, job: Job):
+        now = monotonic()
+        due = job_deadline(job)
+        # a run that is started by hand is due now
+        if due is None or due > now:
+            due = now
+        return self._run_class(job)(job, self._run_key(job, due, now), due, self._run_starting)
+
+    def _run_starting(self, run: JobRun):
+        """
+        a worker start run, record how late it is for its priority class
+        """
+        lag = monotonic() - run.due
+        job = run.job
+        job.status['last_start_lag'] = lag
+        with self._start_lag_lock:
+            summary = self._start_lag.get(job.priority)
+            if summary is None:
+                summary = self._start_lag[job.priority] = LagSummary()
+            summary.add(lag)
+        if self.metrics is not None:
+            self.metrics.start_lag.labels(str(job.priority)).observe(lag)
+
+    def start_lag_stats(self):
+        """
+        seconds from due time of runs to their start by priority class
+        :return: {priority: dict whit count, mean, max and quantiles}
+        """
+        with self._start_lag_lock:
+            return {priority: summary.stats() for priority, summary in sorted(self._start_lag.items())}
+
+    def _start_run(self, run: JobRun):
+        """
+        :return: run, RUN_LATE if worker pool gave job to run_late or None if worker pool dropped it
+        """
+        return self._executor.submit(run.job, run)
+
+    def _run_done(self, job: Job):
+        """
+        a run of job is finished or dropped, its slots go to waiting runs
+        """
+        for run in self._limiter.release(job):
+            started = self._start_run(run)
+            if started is None or started is RUN_LATE:
+                self._run_dropped(run.job, late=started is RUN_LATE)
+                run._done.set()
+
+    def _run_dropped(self, job: Job, late=False):
+        """
+        worker pool did not queue a run of job, its slots are free again
+        a dropped run is skipped and job wait for its next run, job was popped from timer queue so it must be
+        planned again, a run that is given to run_late is already in timer queue
+        """
+        self._run_done(job)
+        if not late:
+            job._plan_next_run()
+
+    def _run_late(self, job: Job):
+        """
+        worker queue was full, ask timer queue to dispatch job again after run_late_delay
+        """
+        self._scheduler.schedule(job, deadline=monotonic() + self._executor_options.get('run_late_delay', 1))
+
+    def _wakeup(self):
+        """
+        wake up agent thread if it is waiting for next due job
+        """
+        self._scheduler.notify()
+
+    def _scheduled_count(self):
+        return len(self._scheduler)
+
+    def _start_metrics_server(self):
+        if self.metrics is not None and self._metrics_options.get('port') is not None:
+            self._metrics_server = start_http_server(self.metrics, self._metrics_options['port'],
+                                                     self._metrics_options.get('address', '127.0.0.1'))
+
+    def _jobstore_window(self):
+        return self._jobstore_options.get('window', 60)
+
+    def _has_periodic(self):
+        return self._jobstore is not None or self._watcher is not None or bool(self._deferred)
+
+    def _run_periodic(self):
+        """
+        poll jobstore and watched directory and submit deferred runs when their time is come
+        :return: seconds until the next poll or None
+        """
+        timeouts = [t for t in (self._poll_jobstore(), self._poll_watch(), self._release_deferred()) if t is not None]
+        return min(timeouts) if timeouts else None
+
+    def _poll_watch(self):
+        """
+        apply changes of watched directory
+        :return: seconds until next poll or None if agent do not watch a directory
+        """
+        if self._watcher is None:
+            return None
+        now = monotonic()
+        if now >= self._next_watch:
+            self._next_watch = now + self._watch_options.get('poll_interval', 1)
+            try:
+                self._sync_watch(now)
+            except Exception:
+                logger.error(msg=f'agent {self.name} failed to sync watched directory', exc_info=True)
+        return max(self._next_watch - now, 0)
+
+    def _sync_watch(self, now):
+        assert self._watcher is not None
+        added, changed, deleted, errors = self._watcher.poll(now)
+        for path, error in errors.items():
+            logger.error(msg=f'failed to read job file {path}: {error!r}')
+        for file_name in deleted:
+            job = self._watched_jobs.pop(file_name, None)
+            if job is not None:
+                self._pending_swaps.pop(job, None)
+                self.remove_job(job)
+                logger.info(msg=f'job {job.name} is removed, {file_name} is deleted')
+        new_jobs = []
+        for file_name, spec in added + changed:
+            try:
+                if isinstance(spec, Job):
+                    raise exceptions.SerializationError('old job files can not be watched, save them again')
+                old = self._watched_jobs.get(file_name)
+                if old is None:
+                    job = self._build_job(spec['definition'], spec['name'], spec['state'])
+                    self._watched_jobs[file_name] = job
+                    new_jobs.append(job)
+                else:
+                    self._change_job(old, spec)
+            except Exception:
+                logger.error(msg=f'failed to load job file {file_name}', exc_info=True)
+        self._extend_jobs(new_jobs)
+        # jobs that were running on the last poll
+        for job in list(self._pending_swaps):
+            self._swap_if_idle(job)
+
+    def _change_job(self, old, spec):
+        """
+        build the new definition of a watched job, it replace the old job when the old job is not running
+        """
+        self._pending_swaps[old] = self._build_job(spec['definition'], old.name, spec['state'])
+        self._swap_if_idle(old)
+
+    def _swap_if_idle(self, old):
+        with self.jobs.lock:
+            if not old.is_not_running.is_set() or old not in self._pending_swaps:
+                return
+            job = self._pending_swaps.pop(old)
+            if old not in self.jobs:
+                return
+            # runtime state of old job is newer than the state in file
+            job._fail_count = old._fail_count
+            job.status['LastRunState'] = old.status['LastRunState']
+            job.status['LastRuntime'] = old.status['LastRuntime']
+            job.update_status()
+            if all(old.options.get(key) == job.options.get(key) for key in _SCHEDULE_OPTIONS):
+                # same schedule, job keep its place in timer queue
+                job._next_run_time, job._planned_deadline = old._next_run_time, old._planned_deadline
+                job._resume_next_run_time = old._resume_next_run_time
+            self.jobs.replace(old, job)
+            for file_name, watched in self._watched_jobs.items():
+                if watched is old:
+                    self._watched_jobs[file_name] = job
+                    break
+            for path, loaded in self._loaded_files.items():
+                if loaded is old:
+                    self._loaded_files[path] = job
+                    break
+        self._unschedule_job(old)
+        self._schedule_job(job)
+        logger.info(msg=f'job {job.name} is reloaded')
+
+    def _poll_jobstore(self):
+        """
+        when poll_interval is passed load jobs of jobstore that are due in window and unload the others
+        :return: seconds until next poll or None if agent has no jobstore
+        """
+        if self._jobstore is None:
+            return None
+        now = monotonic()
+        if now >= self._next_poll:
+            self._next_poll = now + self._jobstore_options.get('poll_interval', self._jobstore_window() / 2)
+            try:
+                self._sync_jobstore()
+            except Exception:
+                logger.error(msg=f'agent {self.name} failed to load jobs from jobstore', exc_info=True)
+        return max(self._next_poll - now, 0)
+
+    def _sync_jobstore(self):
+        until = datetime.datetime.now() + datetime.timedelta(seconds=self._jobstore_window())
+        for job in list(self._stored_jobs):
+            if job.is_not_running.is_set() and (
+                    not job.is_enable or job.next_run_time is None or job.next_run_time > until):
+                self._unload_job(job)
+        for record in self._jobstore.get_due_jobs(until):
+            if self.get_job_by_name(record['name']) is None:
+                self._load_record(record)
+
+    def _load_record(self, record):
+        """
+        build a job from a jobstore record and add it to agent
+        """
+        job = self._build_job(record['definition'], record['name'], record)
+        self.jobs.append(job)
+        self._schedule_job(job)
+        self._stored_jobs.add(job)
+        return job
+
+    def _unload_job(self, job: Job):
+        """
+        remove a stored job from memory, it stay in jobstore
+        """
+        self._stored_jobs.discard(job)
+        with self.jobs.lock:
+            if job in self.jobs:
+                self.jobs.remove(job)
+        self._unschedule_job(job)
+
+    def store_job(self, job):
+        """
+        save job in jobstore, after every change its state is updated in jobstore
+        a stored job that is not due in jobstore window is unloaded from agent and loaded again when it is due
+        :param job: a instance of job or name of job
+        :return: None
+        """
+        if self._jobstore is None:
+            raise RuntimeError(f'agent {self.name} has no jobstore')
+        if isinstance(job, str):
+            job = self.get_job_by_name(job)
+        if job is None or job not in self.jobs:
+            raise ValueError('job is not in agent')
+        self._jobstore.add_job(job)
+        self._stored_jobs.add(job)
+
+    def load_stored_job(self, name):
+        """
+        load a stored job even if it is not due, like a disabled job
+        :param name: name of job
+        :return: the job or None if jobstore has no job whit this name
+        """
+        if self._jobstore is None:
+            raise RuntimeError(f'agent {self.name} has no jobstore')
+        job = self.get_job_by_name(name)
+        if job is not None:
+            return job
+        record = self._jobstore.get_job(name)
+        return None if record is None else self._load_record(record)
+
     @staticmethod
     def _get_new_job_id():
         Agent._job_id_counter += 1
@@ -101,99 +665,221 @@ class Agent:
     def append_job(self, job: Job, name=None):
         """
         load a job and add to jobs list
+        if job belong to another agent it is removed from that agent
         :param job: a instance of job
-        :param name: name default is job.name
+        :param name: name default is job.name, ' (n)' is added to name if it is not unique
         :return: None
         """
-        if name:
-            job.name = name
-        if self.get_job_by_name(job.name):
-            while True:
-                counter = 1
-                if self.get_job_by_name(str(job.name + f' ({counter})')) is None:
-                    job.name = str(job.name + f' ({counter})')
-                    break
-        job._id = self._get_new_job_id()
-        job.agent = self
-        self.jobs.append(job)
+        if not job.is_not_running.is_set():
+            raise PermissionError('cannot assign active job to another agent')
+        with self.jobs.lock:
+            name = self.jobs.unique_name(name or job.name)
+            old_agent = job._agent
+            if old_agent is not self and isinstance(old_agent, Agent):
+                old_agent.remove_job(job)
+            self.jobs.rename(job, name)
+            job.agent = self
+            job._id = self._get_new_job_id()
+            job.update_status()
+            self.jobs.append(job)
+        self._schedule_job(job)
+
+    def remove_job(self, job):
+        """
+        remove job from agent, a running job finish its current run but is not scheduled again
+        a stored job is removed from jobstore too
+        :param job: a instance of job or name of job
+        :return: 1 if job removed 0 if job not found
+        """
+        if isinstance(job, str):
+            job = self.get_job_by_name(job)
+        with self.jobs.lock:
+            if job is None or job not in self.jobs:
+                return 0
+            self.jobs.remove(job)
+        self._unschedule_job(job)
+        if self._checkpoint is not None:
+            self._checkpoint.remove(job.name)
+        if self.metrics is not None:
+            self.metrics.forget_job(job.name)
+        if job in self._stored_jobs:
+            self._stored_jobs.discard(job)
+            self._jobstore.remove_job(job.name)
+        return 1
+
+    def _build_job(self, definition, name, state):
+        """
+        build a job of this agent from a definition and state of a job spec or job store record
+        """
+        job_class, func = definition['class'], definition['func']
+        args: Tuple[Any, ...] = (self, Agent._get_new_job_id(), name)
+        if func is not None:
+            args += (func,)
+        with agent_construction():
+            job = job_class(*args, definition['options'], state['is_enable'], definition['args'], definition['kwargs'])
+        serialization.restore_job_state(job, state)
+        return job
+
+    def _add_spec(self, spec, name=None):
+        """
+        add a job from a decoded job spec or a job of a old job file
+        """
+        if isinstance(spec, Job):
+            job = spec
+        else:
+            job = self._build_job(spec['definition'], spec['name'], spec['state'])
+        self.append_job(job=job, name=name)
+        return job
+
+    def _extend_jobs(self, jobs):
+        """
+        add jobs that are built for this agent, a ' (n)' suffix is added to names that are not unique
+        """
+        with self.jobs.lock:
+            names: Set[str] = set()
+            for job in jobs:
+                name = self.jobs.unique_name(job._name, names)
+                if name != job._name:
+                    job._name = name
+                    job.update_status()
+                names.add(name)
+            self.jobs.extend(jobs)
+        for job in jobs:
+            self._schedule_job(job)
+
+    def _load_spec(self, data, name=None, **kwargs):
+        return self._add_spec(serialization.loads_spec(data, **kwargs), name)
 
     def load_job(self, filepath, name=None, **kwargs):
         """
         load a job file and add to agent
         :param filepath: path to job file
         :param name: name default is job.name
-        :param kwargs:
-        :return: None
+        :param kwargs: passed to dill for job files of older versions
+        :return: the loaded job or None if file not found
         """
-        if not is_dill_available:
-            handle_error_no_dill()
-            return
-
         filepath = Path(filepath)
         if filepath.exists() and filepath.is_file():
-            with open(filepath, 'rb') as file:
-                job = dill.load(file, **kwargs)
-                if isinstance(job, Job):
-                    self.append_job(job=job, name=name)
-                else:
-                    raise TypeError(f'object in {filepath} file is not a instance of Job')
+            return self._load_spec(filepath.read_bytes(), name, **kwargs)
 
     def loads_job(self, str, name=None, **kwargs):
         """
-
-        :param str:
+        add a job from bytes that dumps_job returned
+        :param str: bytes
         :param name: name default is job.name
-        :param kwargs:
-        :return:
+        :param kwargs: passed to dill for job data of older versions
+        :return: the loaded job
         """
-        if not is_dill_available:
-            handle_error_no_dill()
-            return
+        return self._load_spec(str, name, **kwargs)
 
-        job = dill.loads(str, **kwargs)
-        if not isinstance(job, Job):
-            raise TypeError(f'object in {type(job)} is not a instance of Job')
-        self.append_job(job=job, name=name)
+    def load_jobs(self, dirpath, pattern='*.job', workers=None, manifest=True):
+        """
+        load every job file of a directory, files are read in parallel and decoded one by one
+        a file that can not be loaded is reported and do not stop the others
+        a file that did not change since it is loaded by this agent is skipped and its job is kept,
+        a changed file replace its job after the current run
+        :param dirpath: path to dir
+        :param pattern: glob pattern of job files
+        :param workers: number of reader threads default is min(32, cpu count + 4)
+        :param manifest: True to keep a manifest of (size, mtime, hash) of files in dirpath in memory so the next
+        load skip unchanged files whit out reading them, False to read every file
+        :return: LoadReport whit jobs, errors and number of decoded and skipped files
+        """
+        dirpath = Path(dirpath)
+        if manifest:
+            manifest = self._manifests.setdefault(str(dirpath), loader.Manifest())
+        else:
+            self._manifests.pop(str(dirpath), None)
+            manifest = loader.Manifest()
+        names = loader.scan(dirpath, pattern)
+        for name in set(manifest.entries) - set(names):
+            manifest.remove(name)
+        loaded = {}
+        for path, job in list(self._loaded_files.items()):
+            directory, name = os.path.split(path)
+            if directory != str(dirpath):
+                continue
+            if name in names and job in self.jobs:
+                loaded[name] = job
+            else:
+                # file is deleted or job is removed
+                del self._loaded_files[path]
+
+        report = loader.LoadReport()
+        # like create_jobs, specs and jobs of a directory all stay alive so collecting cycles in between only cost time
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            results, report.errors = loader.read_specs(dirpath, names, manifest, workers, known=loaded)
+            decoded = {os.path.basename(path): (path, spec) for path, spec in results}
+            built = []
+            for name in sorted(names):
+                if name not in decoded:
+                    if name in loaded:
+                        report.jobs.append(loaded[name])
+                        report.cached += 1
+                    continue
+                path, spec = decoded[name]
+                try:
+                    if isinstance(spec, Job):
+                        self.append_job(spec)
+                        job = spec
+                    elif name in loaded:
+                        # old job stay in _loaded_files until new job take its place
+                        old = loaded[name]
+                        self._change_job(old, spec)
+                        job = self._pending_swaps.get(old) or self._loaded_files[path]
+                        report.jobs.append(job)
+                        report.read += 1
+                        continue
+                    else:
+                        job = self._build_job(spec['definition'], spec['name'], spec['state'])
+                        built.append(job)
+                except Exception as E:
+                    logger.error(msg=f'failed to load job file {path}', exc_info=True)
+                    report.errors[path] = E
+                    continue
+                self._loaded_files[path] = job
+                report.jobs.append(job)
+                report.read += 1
+            self._extend_jobs(built)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        return report
 
     @staticmethod
     def save_job(job: Job, dirpath, file_name=None, protocol=None, **kwargs):
         """
-        save job in to a file
+        save job spec in to a file, function and job class are saved by import path
         :param job: get a job you can us get_job_by_name or get_job_by_id
         :param dirpath: path to dir you want job be save
         :param file_name: name of file default is job.name
-        :param protocol: dill protocol
-        :param kwargs:
-        :return:
+        :param protocol: pickle protocol
+        :param kwargs: not used, kept for older callers
+        :return: None
         """
-        if not is_dill_available:
-            handle_error_no_dill()
-            return
-
         dirpath = Path(dirpath)
         data_file_path = dirpath.joinpath(str((job.name if file_name is None else file_name) + '.job'))
 
         if not dirpath.exists():
             dirpath.mkdir(parents=True)
 
-        with open(data_file_path, mode='wb') as file:
-            dill.dump(obj=job, file=file, protocol=protocol, **kwargs)
+        # a reader never see a half written file
+        tmp_path = data_file_path.with_name(data_file_path.name + '.tmp')
+        tmp_path.write_bytes(serialization.dumps_spec(job, protocol))
+        os.replace(tmp_path, data_file_path)
 
     @staticmethod
     def dumps_job(job, protocol=None, **kwargs):
         """
-        this methode is like dill dumps methode
+        job spec as bytes, see serialization.py
         :param job: a job you can get it whit get_job_by_name or get_job_by_id
-        :param protocol: dill protocol
-        :param kwargs: for dill or dill you can pass more argument but because the difference within dill and dill
-        I only give **kwargs to dumps function
-        :return:  str
+        :param protocol: pickle protocol
+        :param kwargs: not used, kept for older callers
+        :return: bytes
         """
-        if not is_dill_available:
-            handle_error_no_dill()
-            return
-
-        return dill.dumps(obj=job, protocol=protocol, **kwargs)
+        return serialization.dumps_spec(job, protocol)
 
     def _add_job(self, func, options, is_enable, args, kwargs, name, **job_variables):
         job_id = Agent._get_new_job_id()
@@ -202,7 +888,17 @@ class Agent:
         if self.get_job_by_name(name) is not None:
             raise exceptions.DuplicateName('job name must be unique')
 
-        self.jobs.append(FunctionJob(self, job_id, name, func, options, is_enable, args, kwargs, **job_variables))
+        job_class = self._function_job_class(func)
+        job = job_class(self, job_id, name, func, options, is_enable, args, kwargs, **job_variables)
+        self.jobs.append(job)
+        self._schedule_job(job)
+
+    @staticmethod
+    def _function_job_class(func):
+        """
+        :return: job class that create_job and create_job_decorator use for func
+        """
+        return FunctionJob
 
     def create_class_job(self, job, options, args=(), kwargs=None, is_enable: bool = True, name: str = None,
                          **job_variables):
@@ -212,7 +908,58 @@ class Agent:
         if self.get_job_by_name(name) is not None:
             raise exceptions.DuplicateName('job name must be unique')
 
-        self.jobs.append(job(self, job_id, name, options, is_enable, args, kwargs, **job_variables))
+        with agent_construction():
+            job = job(self, job_id, name, options, is_enable, args, kwargs, **job_variables)
+        self.jobs.append(job)
+        self._schedule_job(job)
+
+    def create_jobs(self, specs):
+        """
+        create many jobs at once, names are checked and jobs are added to agent in one pass
+        if any spec is invalid no job is added
+        :param specs: iterable of dict, a spec has 'func' like create_job or 'job' like create_class_job
+        and 'options', optional 'args', 'kwargs', 'is_enable' and 'name', other keys are job variables
+        :return: list of created jobs
+        """
+        specs = [dict(spec) for spec in specs]
+        names = set()
+        for spec in specs:
+            if ('func' in spec) == ('job' in spec):
+                raise exceptions.InvalidOption('job spec must have one of func or job')
+            if 'options' not in spec:
+                raise exceptions.InvalidOption('job spec must have options')
+            spec['job_id'] = Agent._get_new_job_id()
+            if spec.get('name') is None:
+                spec['name'] = 'job_' + str(spec['job_id'])
+            if spec['name'] in names or self.get_job_by_name(spec['name']) is not None:
+                raise exceptions.DuplicateName(f'job name must be unique {spec["name"]} already exist')
+            names.add(spec['name'])
+
+        jobs = []
+        # a batch allocate many objects that all stay alive, collecting cycles in between only cost time
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with agent_construction():
+                for spec in specs:
+                    func, job_class = spec.pop('func', None), spec.pop('job', None)
+                    args = (spec.pop('job_id'), spec.pop('name'))
+                    options, is_enable = spec.pop('options'), spec.pop('is_enable', True)
+                    job_args, job_kwargs = spec.pop('args', ()), spec.pop('kwargs', None)
+                    if func is not None:
+                        job_class = self._function_job_class(func)
+                        job = job_class(self, *args, func, options, is_enable, job_args, job_kwargs, **spec)
+                    else:
+                        job = job_class(self, *args, options, is_enable, job_args, job_kwargs, **spec)
+                    jobs.append(job)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        self.jobs.extend(jobs)
+        for job in jobs:
+            self._schedule_job(job)
+        return jobs
 
     def create_job(self, func, options, args=(), kwargs=None, is_enable: bool = True, name: str = None,
                    **job_variables):
@@ -227,18 +974,10 @@ class Agent:
         return decorator
 
     def get_job_by_name(self, job_name: str):
-        for job in self.jobs:
-            if job.name == job_name:
-                return job
-        else:
-            return None
+        return self.jobs.get_by_name(job_name)
 
     def get_job_by_id(self, job_id: int):
-        for job in self.jobs:
-            if job.status['job_id'] == job_id:
-                return job
-        else:
-            return None
+        return self.jobs.get_by_id(job_id)
 
     @staticmethod
     def run_job(job: FunctionJob, timeout=None):
@@ -265,10 +1004,40 @@ class Agent:
             return 0
 
     def get_all_jobs(self):
-        return self.jobs
+        return list(self.jobs)
+
+    def profile_report(self, job, top=20):
+        """
+        aggregated profile of sampled runs of a job whit options['profile']
+        :param job: a instance of job or name of job
+        :param top: number of functions and allocation sites
+        :return: dict whit runs, sampled, functions and allocations or None if job is not profiled
+        """
+        if isinstance(job, str):
+            job = self.get_job_by_name(job)
+        if job is None or job._profiler is None:
+            return None
+        return job._profiler.report(top)
+
+    def profile_reports(self, top=20):
+        """
+        :return: {job name: profile report} of all profiled jobs
+        """
+        return {job.name: job._profiler.report(top) for job in self.jobs if job._profiler is not None}
+
+    def dump_profile(self, job, path):
+        """
+        write aggregated pstats of a profiled job to path
+        :param job: a instance of job or name of job
+        """
+        if isinstance(job, str):
+            job = self.get_job_by_name(job)
+        if job is None or job._profiler is None:
+            raise ValueError('job is not profiled')
+        job._profiler.dump(path)
 
     def get_all_running_jobs(self):
-        return [job for job in self.jobs if job.is_running.is_set()]
+        return [job for job in self.jobs if not job.is_not_running.is_set()]
 
     def start(self):
         """
@@ -282,6 +1051,7 @@ class Agent:
             raise RuntimeError("Agent can only be started once")
 
         logger.info(msg=f'agent {self.name} is starting')
+        self._start_metrics_server()
         threading.Thread(target=self._agent, daemon=self._daemon, name=self._name).start()
         self._is_stop.clear()
         self._started.set()
@@ -300,13 +1070,30 @@ class Agent:
         self._interrupt.set()
         self._interrupt.wait()
         self._is_stop.set()
+        self._wakeup()
+        for run in self._limiter.cancel_waiting():
+            run._done.set()
+        with self._deferred_lock:
+            deferred, self._deferred = self._deferred, []
+            self._deferred_changed.notify()
+        for _, _, run in deferred:
+            self._limiter.undefer(run.job)
+            run._done.set()
+        self._executor.shutdown()
+        self._process_pool.shutdown()
+        if self._checkpoint is not None:
+            self._checkpoint.flush()
+        if self._metrics_server is not None:
+            self._metrics_server.shutdown()
+            self._metrics_server.server_close()
+            self._metrics_server = None
         self._started.clear()
         logger.info(msg=f'agent {self.name} stopped')
 
     @property
     def interrupt(self):
         """
-        you can active a interrupt with .set() methode
+        the last interrupt that is assigned to agent, you can active it with .set() methode
         :return: interrupt
         """
         if not self._initialized:
@@ -317,15 +1104,11 @@ class Agent:
     def interrupt(self, val: _interrupt.BaseInterrupt):
         """
         set a interrupt that can be activate whit interrupt.set() methode
+        any interrupt of agent can be set at any time, each set interrupt is queued so nothing is overwritten
         :param val: get a class that inherited BaseInterrupt
         you can find it in agent.interrupt
         :return:
         """
-        if self._interrupt is not None:
-            if self._interrupt.lock.locked():
-                logger.error(msg='interrupt is set waiting for interrupt clear')
-                self._interrupt.lock.acquire()
-                self._interrupt.lock.release()
         self._interrupt = val
 
     @property
@@ -356,6 +1139,6 @@ class Agent:
         """
         return {
             'version': '0.1.2',
-            'is_dill_sported': is_dill_available
+            'is_dill_sported': serialization.dill_available
 
         }
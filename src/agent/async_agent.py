@@ -0,0 +1,189 @@
+# ------------------------------------------------------------------------------
+# Copyright 2021 Mohammad Reza Golsorkhi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+# name: async_agent.py
+# Description: A agent that run coroutine jobs as tasks on one event loop
+# Version: 0.1.0
+# Author: Mohammad Reza Golsorkhi
+# ------------------------------------------------------------------------------
+
+
+import asyncio
+import inspect
+import logging
+import threading
+from time import monotonic
+from typing import Any, Dict, Optional, Set
+
+from src.agent.agent import Agent
+from src.agent.executor import JobRun
+from src.agent.job import AsyncFunctionJob, FunctionJob, Job
+from src.agent.scheduler import job_deadline
+
+logger = logging.getLogger(__name__)
+
+
+class _AsyncJobRun(JobRun):
+    """
+    a run of AsyncFunctionJob that is a task on event loop of agent
+    do not join it from event loop thread
+    """
+
+    async def _run_async(self):
+        self._started()
+        try:
+            await self.job._job_run_async(self)
+        finally:
+            self._done.set()
+
+
+class AsyncAgent(Agent):
+    """
+    agent that run `async def` jobs as tasks on one event loop
+    every job get a asyncio timer for its next_run_time, sync jobs run in worker pool of agent
+    start it in its own thread whit start() or inside a running event loop whit `await agent.serve()`
+    """
+
+    def __init__(self, daemon=True, id=None, name=None, scheduler_options: Optional[Dict[str, Any]] = None,
+                 executor_options: Optional[Dict[str, Any]] = None, **kwargs):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._timers: Dict[Job, asyncio.TimerHandle] = {}
+        self._tasks: Set['asyncio.Task[None]'] = set()
+        super().__init__(daemon, id, name, scheduler_options, executor_options, **kwargs)
+
+    @staticmethod
+    def _function_job_class(func):
+        return AsyncFunctionJob if inspect.iscoroutinefunction(func) else FunctionJob
+
+    def _agent(self):
+        asyncio.run(self._main())
+        return 0
+
+    async def serve(self):
+        """
+        run agent on the running event loop until stop() is called
+        :return: None
+        """
+        if not self._initialized:
+            raise RuntimeError("Agent.__init__() not called")
+
+        if self._started.is_set():
+            raise RuntimeError("Agent can only be started once")
+
+        logger.info(msg=f'agent {self.name} is starting')
+        self._start_metrics_server()
+        self._is_stop.clear()
+        self._started.set()
+        await self._main()
+
+    async def _main(self):
+        loop = self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        wake = self._wake = asyncio.Event()
+        self.is_running.set()
+        logger.info(msg=f'agent {self.name} started')
+        for job in self.jobs:
+            self._set_timer(job)
+        try:
+            while True:
+                if self._interrupts:
+                    # handlers like StopInterrupt join job runs so they must not block event loop
+                    await loop.run_in_executor(None, self._handle_interrupts)
+                if self._is_stop.is_set():
+                    break
+                timeout = None
+                if self._has_periodic():
+                    # jobstore and watched directory read from disk so they must not block event loop
+                    timeout = await loop.run_in_executor(None, self._run_periodic)
+                try:
+                    await asyncio.wait_for(wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                wake.clear()
+        finally:
+            for handle in self._timers.values():
+                handle.cancel()
+            self._timers.clear()
+            self._loop = None
+            self._loop_thread_id = None
+            self.is_running.clear()
+            logger.info(msg=f'agent {self.name} stopped')
+
+    def _call_in_loop(self, func, *args):
+        loop = self._loop
+        if loop is None:
+            return
+        if threading.get_ident() == self._loop_thread_id:
+            func(*args)
+        else:
+            try:
+                loop.call_soon_threadsafe(func, *args)
+            except RuntimeError:
+                # event loop is closed, agent is stopped
+                pass
+
+    def _set_timer(self, job: Job, deadline=None):
+        self._cancel_timer(job)
+        if not job.is_enable or job.next_run_time is None or self._loop is None:
+            return
+        if deadline is None:
+            deadline = job_deadline(job)
+        self._timers[job] = self._loop.call_later(max(deadline - monotonic(), 0), self._dispatch, job)
+
+    def _dispatch(self, job: Job):
+        self._timers.pop(job, None)
+        super()._dispatch(job)
+
+    def _schedule_job(self, job: Job):
+        if not self._job_changed(job):
+            return
+        self._call_in_loop(self._set_timer, job)
+
+    def _unschedule_job(self, job: Job):
+        self._call_in_loop(self._cancel_timer, job)
+
+    def _scheduled_count(self):
+        return len(self._timers)
+
+    def _cancel_timer(self, job: Job):
+        handle = self._timers.pop(job, None)
+        if handle is not None:
+            handle.cancel()
+
+    def _run_late(self, job: Job):
+        self._call_in_loop(self._set_timer, job, monotonic() + self._executor_options.get('run_late_delay', 1))
+
+    def _run_class(self, job: Job):
+        if isinstance(job, AsyncFunctionJob) and self._loop is not None:
+            return _AsyncJobRun
+        return super()._run_class(job)
+
+    def _start_run(self, run: JobRun):
+        loop = self._loop
+        if not isinstance(run, _AsyncJobRun) or loop is None:
+            return super()._start_run(run)
+        if threading.get_ident() == self._loop_thread_id:
+            task = loop.create_task(run._run_async())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            asyncio.run_coroutine_threadsafe(run._run_async(), loop)
+        return run
+
+    def _wakeup(self):
+        if self._wake is not None:
+            self._call_in_loop(self._wake.set)
@@ -0,0 +1,218 @@
+# ------------------------------------------------------------------------------
+# Copyright 2021 Mohammad Reza Golsorkhi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+# name: checkpoint.py
+# Description: append only checkpoint log of runtime state of jobs for crash safe restart
+# Version: 0.1.0
+# Author: Mohammad Reza Golsorkhi
+# ------------------------------------------------------------------------------
+"""
+every state change of a job is appended to the log as a frame
+
+    <length: uint32> <crc32: uint32> <pickle of (name, state tuple or None for a removed job)>
+
+frames are buffered in memory and a background thread write and fsync them every sync_interval seconds,
+so a crash lose at most the last sync_interval seconds of state. when the log has compact_ratio times more
+frames than live jobs it is written again whit one frame per job, so replay cost is proportional to the
+number of live jobs. a torn frame at the end of the log is dropped on replay
+"""
+
+import logging
+import os
+import pickle
+import struct
+import threading
+import zlib
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct('<II')
+
+# order of state tuple, the same keys as serialization.job_state
+_STATE_KEYS = ('next_run_time', 'is_enable', 'fail_count', 'last_run_state', 'last_runtime')
+
+
+def _frame(record):
+    payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+    return _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _state_tuple(job):
+    return (job._next_run_time, job._is_enable, job._fail_count, job.status['LastRunState'].name,
+            job.status['LastRuntime'])
+
+
+def _fsync_directory(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # directories can not be opened on windows, os.replace is durable there
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class CheckpointLog:
+    """
+    write ahead log of next_run_time, is_enable, fail_count, LastRunState and LastRuntime of jobs by job name
+    """
+
+    def __init__(self, path, sync_interval=1.0, compact_ratio=4, compact_min=1024):
+        """
+        :param path: log file, it is replayed if it exist
+        :param sync_interval: seconds between batched writes and fsync of log, 0 write and fsync every record
+        :param compact_ratio: log is compacted when it has compact_ratio frames per live job
+        :param compact_min: log whit less frames than this is not compacted
+        """
+        self.path = Path(path)
+        self.sync_interval = sync_interval
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._buffer = []
+        # live state of every job: state tuple
+        self._states = {}
+        self._frames = 0
+        self._replayed = {}
+        self._replay()
+        self._file = open(self.path, 'ab')
+        self._closed = False
+        self._wake = threading.Event()
+        self._thread = None
+        if self.sync_interval > 0:
+            self._thread = threading.Thread(target=self._flusher, daemon=True, name=f'checkpoint {self.path.name}')
+            self._thread.start()
+
+    def __len__(self):
+        return len(self._states)
+
+    def _replay(self):
+        if not self.path.is_file():
+            return
+        data = self.path.read_bytes()
+        offset, end = 0, len(data)
+        while offset + _HEADER.size <= end:
+            length, crc = _HEADER.unpack_from(data, offset)
+            payload = data[offset + _HEADER.size:offset + _HEADER.size + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                break
+            try:
+                name, state = pickle.loads(payload)
+            except Exception:
+                break
+            if state is None:
+                self._states.pop(name, None)
+            else:
+                self._states[name] = state
+            self._frames += 1
+            offset += _HEADER.size + length
+        if offset != end:
+            logger.warning(msg=f'checkpoint {self.path} has a torn tail of {end - offset} bytes, it is dropped')
+            with open(self.path, 'r+b') as file:
+                file.truncate(offset)
+        self._replayed = dict(self._states)
+
+    def pop_replayed(self, name):
+        """
+        state of job name that was read from log on start, each state is given once
+        :return: dict like serialization.job_state or None
+        """
+        if not self._replayed:
+            return None
+        state = self._replayed.pop(name, None)
+        if state is None:
+            return None
+        return dict(zip(_STATE_KEYS, state))
+
+    def record(self, job):
+        """
+        append the current state of job, it is cheap and do not touch disk
+        """
+        state = _state_tuple(job)
+        with self._lock:
+            if self._states.get(job._name) == state:
+                return
+            self._states[job._name] = state
+            self._buffer.append(_frame((job._name, state)))
+        if self._thread is None:
+            self.flush()
+
+    def remove(self, name):
+        with self._lock:
+            if self._states.pop(name, None) is None:
+                return
+            self._buffer.append(_frame((name, None)))
+        if self._thread is None:
+            self.flush()
+
+    def flush(self):
+        """
+        write buffered frames and fsync them, compact log if it is too large
+        """
+        with self._io_lock:
+            if self._closed:
+                return
+            with self._lock:
+                buffer, self._buffer = self._buffer, []
+                frames = self._frames + len(buffer)
+                if frames >= self.compact_min and frames > self.compact_ratio * len(self._states):
+                    # live states include every buffered frame
+                    snapshot = list(self._states.items())
+                else:
+                    snapshot = None
+                self._frames = frames
+            if snapshot is not None:
+                self._compact(snapshot)
+            elif buffer:
+                self._file.write(b''.join(buffer))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+    def _compact(self, snapshot):
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'wb') as file:
+            file.write(b''.join(_frame(record) for record in snapshot))
+            file.flush()
+            os.fsync(file.fileno())
+        self._file.close()
+        os.replace(tmp_path, self.path)
+        _fsync_directory(self.path.parent)
+        self._file = open(self.path, 'ab')
+        with self._lock:
+            # frames that are buffered during compaction are counted when they are flushed
+            self._frames = len(snapshot)
+        logger.debug(msg=f'checkpoint {self.path} compacted to {len(snapshot)} jobs')
+
+    def _flusher(self):
+        while not self._wake.wait(self.sync_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.error(msg=f'failed to write checkpoint {self.path}', exc_info=True)
+
+    def close(self):
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        with self._io_lock:
+            self._closed = True
+            self._file.close()
@@ -0,0 +1,291 @@
+# ------------------------------------------------------------------------------
+# Copyright 2021 Mohammad Reza Golsorkhi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+# name: cron.py
+# Description: compiled cron expressions for the cron scheduler of Cnrt
+# Version: 0.1.0
+# Author: Mohammad Reza Golsorkhi
+# ------------------------------------------------------------------------------
+
+
+import calendar
+import datetime
+import functools
+from typing import List, Optional
+
+from src.agent.exceptions import InvalidOption
+
+try:
+    import zoneinfo
+except ImportError:
+    # python 3.8, timezone option must be a tzinfo object
+    zoneinfo = None  # type: ignore[assignment]
+
+ALIASES = {
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+    '@monthly': '0 0 1 * *',
+    '@weekly': '0 0 * * 0',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@hourly': '0 * * * *',
+}
+
+_MONTH_NAMES = {name.upper(): i for i, name in enumerate(calendar.month_abbr) if name}
+_DAY_NAMES = {'SUN': 0, 'MON': 1, 'TUE': 2, 'WED': 3, 'THU': 4, 'FRI': 5, 'SAT': 6}
+
+# how far a wall clock can move on a daylight saving transition
+_MAX_DST_SHIFT = datetime.timedelta(hours=3)
+# 29 February on a given weekday repeat at most every 28 years
+_MAX_YEARS = 30
+
+
+def _parse_field(text, low, high, names=None):
+    """
+    parse one cron field to a bit mask, bit n is set if value n is allowed
+    """
+    def value(token):
+        token = token.upper()
+        if names and token in names:
+            return names[token]
+        try:
+            v = int(token)
+        except ValueError:
+            raise InvalidOption(f'invalid cron value {token!r}')
+        if not low <= v <= high:
+            raise InvalidOption(f'cron value {v} is out of range {low}-{high}')
+        return v
+
+    mask = 0
+    for part in text.split(','):
+        step = 1
+        if '/' in part:
+            part, step_text = part.split('/', 1)
+            try:
+                step = int(step_text)
+            except ValueError:
+                raise InvalidOption(f'invalid cron step {step_text!r}')
+            if step <= 0:
+                raise InvalidOption('cron step must be greater than 0')
+        if part in ('*', '?'):
+            start, end = low, high
+        elif '-' in part:
+            start, end = map(value, part.split('-', 1))
+            if start > end:
+                raise InvalidOption(f'invalid cron range {part!r}')
+        else:
+            start = value(part)
+            end = high if step > 1 else start
+        for v in range(start, end + 1, step):
+            mask |= 1 << v
+    return mask
+
+
+def _next_table(mask, low, high):
+    """
+    table[v] is the smallest allowed value >= v or None
+    """
+    table: List[Optional[int]] = [None] * (high + 2)
+    following = None
+    for v in range(high, low - 1, -1):
+        if mask >> v & 1:
+            following = v
+        table[v] = following
+    return table
+
+
+def _lowest_bit(mask):
+    return (mask & -mask).bit_length() - 1
+
+
+class CronExpression:
+    """
+    cron expression compiled to bit masks and next value tables
+    accept 5 fields (minute hour day month weekday), 6 fields (second first) and the @ aliases
+    next fire time is found field by field so its cost do not depend on how far it is
+
+    daylight saving:
+    a wall time that do not exist (clock jump forward) fire later by the length of the jump,
+    a wall time that happen twice (clock jump back) fire once at its first occurrence,
+    unless the expression match every hour, then it also fire in the repeated hour
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        text = ALIASES.get(expression.strip().lower(), expression)
+        fields = text.split()
+        if len(fields) == 5:
+            fields.insert(0, '0')
+            self.has_seconds = False
+        elif len(fields) == 6:
+            self.has_seconds = True
+        else:
+            raise InvalidOption(f'cron expression must have 5 or 6 fields {expression!r}')
+        second, minute, hour, dom, month, dow = fields
+
+        self._seconds = _next_table(_parse_field(second, 0, 59), 0, 59)
+        self._minutes = _next_table(_parse_field(minute, 0, 59), 0, 59)
+        hours = _parse_field(hour, 0, 23)
+        self._hours = _next_table(hours, 0, 23)
+        months = _parse_field(month, 1, 12, _MONTH_NAMES)
+        self._months = _next_table(months, 1, 12)
+        dom_mask = _parse_field(dom, 1, 31)
+        dow_mask = _parse_field(dow, 0, 7, _DAY_NAMES)
+        dow_mask = (dow_mask | dow_mask >> 7) & 0x7f
+        self.every_hour = hours == (1 << 24) - 1
+
+        # allowed days of a month by weekday of its first day and its length
+        # like vixie cron if both day fields are restricted a day match either of them
+        either = dom[0] not in '*?' and dow[0] not in '*?'
+        self._day_masks = []
+        for first_weekday in range(7):
+            masks = []
+            for length in range(28, 32):
+                by_weekday = 0
+                for day in range(1, length + 1):
+                    if dow_mask >> ((first_weekday + day - 1) % 7) & 1:
+                        by_weekday |= 1 << day
+                by_day = dom_mask & ((1 << (length + 1)) - 1)
+                masks.append(by_day | by_weekday if either else by_day & by_weekday)
+            self._day_masks.append(masks)
+        # 2000 is a leap year so february can have 29 days
+        lengths = {calendar.monthrange(2000, m)[1] for m in range(1, 13) if months >> m & 1}
+        if not any(masks[length - 28] for masks in self._day_masks for length in lengths):
+            raise InvalidOption(f'cron expression never fire {expression!r}')
+
+    def __repr__(self):
+        return f'CronExpression({self.expression!r})'
+
+    def _next_day(self, t):
+        first_weekday = (datetime.date(t.year, t.month, 1).weekday() + 1) % 7
+        length = calendar.monthrange(t.year, t.month)[1]
+        mask = self._day_masks[first_weekday][length - 28] >> t.day
+        return t.day + _lowest_bit(mask) if mask else None
+
+    def next_wall_time(self, after):
+        """
+        next matching wall clock time strictly after `after`, time zone is ignored
+        :param after: naive datetime
+        :return: naive datetime
+        """
+        if self.has_seconds:
+            t = after.replace(microsecond=0) + datetime.timedelta(seconds=1)
+        else:
+            t = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = t.year + _MAX_YEARS
+        while t.year <= limit:
+            month = self._months[t.month]
+            if month is None:
+                t = datetime.datetime(t.year + 1, 1, 1)
+                continue
+            if month != t.month:
+                t = datetime.datetime(t.year, month, 1)
+            day = self._next_day(t)
+            if day is None:
+                t = (datetime.datetime(t.year, t.month, 1) + datetime.timedelta(days=32)).replace(day=1)
+                continue
+            if day != t.day:
+                t = datetime.datetime(t.year, t.month, day)
+            hour = self._hours[t.hour]
+            if hour is None:
+                t = datetime.datetime(t.year, t.month, t.day) + datetime.timedelta(days=1)
+                continue
+            if hour != t.hour:
+                t = t.replace(hour=hour, minute=0, second=0)
+            minute = self._minutes[t.minute]
+            if minute is None:
+                t = t.replace(minute=0, second=0) + datetime.timedelta(hours=1)
+                continue
+            if minute != t.minute:
+                t = t.replace(minute=minute, second=0)
+            second = self._seconds[t.second]
+            if second is None:
+                t = t.replace(second=0) + datetime.timedelta(minutes=1)
+                continue
+            return t.replace(second=second)
+        raise InvalidOption(f'cron expression never fire {self.expression!r}')
+
+    def next_fire_time(self, after, timezone=None):
+        """
+        next fire time strictly after `after`
+        :param after: datetime, naive datetime is local time
+        :param timezone: tzinfo the expression is read in, None for naive local wall clock
+        :return: aware datetime in timezone or naive datetime if timezone is None
+        """
+        if timezone is None:
+            if after.tzinfo is not None:
+                after = after.astimezone().replace(tzinfo=None)
+            return self.next_wall_time(after)
+
+        if after.tzinfo is None:
+            after = after.astimezone()
+        after = after.astimezone(datetime.timezone.utc)
+        wall = after.astimezone(timezone).replace(tzinfo=None)
+        shift = (after - _MAX_DST_SHIFT).astimezone(timezone).utcoffset() - \
+            (after + _MAX_DST_SHIFT).astimezone(timezone).utcoffset()
+        if shift > datetime.timedelta(0):
+            # clock go back near `after`, the repeated hour can have fire times whit a lower wall time
+            wall -= shift
+        best = None
+        candidate = self.next_wall_time(wall)
+        while True:
+            instants = self._instants(candidate, timezone)
+            for instant in instants:
+                if instant > after and (best is None or instant < best):
+                    best = instant
+            if best is not None and instants[0] >= best:
+                return best.astimezone(timezone)
+            candidate = self.next_wall_time(candidate)
+
+    def _instants(self, wall, timezone):
+        """
+        moments in utc that a wall time of timezone stand for
+        """
+        first = wall.replace(tzinfo=timezone, fold=0)
+        second = wall.replace(tzinfo=timezone, fold=1)
+        first_utc = first.astimezone(datetime.timezone.utc)
+        if first.utcoffset() == second.utcoffset():
+            return [first_utc]
+        if first_utc.astimezone(timezone).replace(tzinfo=None) != wall:
+            # wall time is skipped by clock, fold=0 put it after the jump by length of the jump
+            return [first_utc]
+        if self.every_hour:
+            return [first_utc, second.astimezone(datetime.timezone.utc)]
+        return [first_utc]
+
+
+@functools.lru_cache(maxsize=None)
+def compile_cron(expression):
+    """
+    compile a cron expression once, jobs whit the same expression share it
+    :param expression: cron expression or alias like '@daily'
+    :return: CronExpression
+    """
+    return CronExpression(expression)
+
+
+def get_timezone(timezone):
+    """
+    :param timezone: None, a tzinfo or a IANA time zone name like 'Europe/London'
+    :return: tzinfo or None
+    """
+    if timezone is None or isinstance(timezone, datetime.tzinfo):
+        return timezone
+    if zoneinfo is None:
+        raise InvalidOption('time zone names need python 3.9 or later, pass a tzinfo object')
+    try:
+        return zoneinfo.ZoneInfo(timezone)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError) as E:
+        raise InvalidOption(f'unknown timezone {timezone!r}') from E
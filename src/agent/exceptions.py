@@ -40,3 +40,31 @@ class DuplicateName(Exception):
     DuplicateName
     """
     pass
+
+
+class ProcessWorkerError(Exception):
+    """
+    worker process of ProcessPool died or could not send back result
+    """
+    pass
+
+
+class SerializationError(Exception):
+    """
+    job spec can not be written or read
+    """
+    pass
+
+
+class JobCancelled(Exception):
+    """
+    run of job is cancelled by job.stop
+    """
+    pass
+
+
+class JobTimeout(JobCancelled):
+    """
+    run of job took longer than options['run_timeout']
+    """
+    pass
@@ -0,0 +1,513 @@
+# ------------------------------------------------------------------------------
+# Copyright 2021 Mohammad Reza Golsorkhi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+# name: executor.py
+# Description: worker pool that run jobs for agent
+# Version: 0.1.0
+# Author: Mohammad Reza Golsorkhi
+# ------------------------------------------------------------------------------
+
+
+import collections
+import heapq
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+from time import monotonic
+from typing import Deque, Union
+
+from src.agent.exceptions import InvalidOption, JobCancelled, JobTimeout, ProcessWorkerError
+
+try:
+    import dill as serializer
+except ImportError:
+    # without dill only functions that pickle can find by name can run in a process
+    import pickle as serializer
+
+logger = logging.getLogger(__name__)
+
+_worker_local = threading.local()
+
+
+class CancelToken:
+    """
+    cancel request of a run, a function that declare a cancel_token parameter get it
+    it should return soon after token.cancelled is True, token.wait(seconds) is a sleep that end when run is cancelled
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason = None
+
+    def __repr__(self):
+        return f'CancelToken cancelled : {self.cancelled} reason : {self.reason}'
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    @property
+    def timed_out(self):
+        return self.reason == 'timeout'
+
+    def cancel(self, reason='stop'):
+        """
+        :param reason: 'stop' or 'timeout'
+        """
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    def wait(self, timeout=None):
+        """
+        :return: True if run is cancelled
+        """
+        return self._event.wait(timeout)
+
+    def raise_if_cancelled(self):
+        """
+        :raise: JobTimeout or JobCancelled if run is cancelled
+        """
+        if self._event.is_set():
+            if self.timed_out:
+                raise JobTimeout('run is longer than run_timeout')
+            raise JobCancelled('run is cancelled')
+
+
+class JobRun:
+    """
+    a run of a job that is submitted to WorkerPool
+    it has join and is_alive like threading.Thread so job.job_thread keep working
+    """
+
+    def __init__(self, job, key=None, due=None, on_start=None):
+        """
+        :param key: order of run in a prioritized worker queue, smaller first
+        :param due: monotonic time that run was due
+        :param on_start: function that get the run when a worker start it
+        """
+        self.job = job
+        self.key = key
+        self.due = due
+        self.on_start = on_start
+        self.token = CancelToken()
+        self._done = threading.Event()
+
+    def __repr__(self):
+        return f'JobRun job : {self.job.name if self.job else None} done : {self._done.is_set()}'
+
+    def join(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def is_alive(self):
+        return not self._done.is_set()
+
+    def _started(self):
+        if self.on_start is not None:
+            try:
+                self.on_start(self)
+            except Exception:
+                logger.error(msg=f'start callback of {self.job.name} failed', exc_info=True)
+
+    def _run(self):
+        self._started()
+        try:
+            self.job._job_run(self)
+        finally:
+            self._done.set()
+
+
+# job.job_thread of a job that never started
+NO_RUN = JobRun(None)
+NO_RUN._done.set()
+
+# WorkerPool.submit gave the job to run_late callback
+RUN_LATE = JobRun(None)
+RUN_LATE._done.set()
+
+
+class RunWatchdog:
+    """
+    one thread that cancel token of runs that are longer than their timeout
+    the thread is started by watch and stop when no run is watched
+    """
+
+    def __init__(self, name='agent'):
+        self._name = name
+        # (monotonic deadline, counter, run), finished runs are dropped when they reach the top
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def watch(self, run, timeout):
+        """
+        cancel token of run whit reason 'timeout' if it is not done after timeout seconds
+        """
+        with self._condition:
+            heapq.heappush(self._heap, (monotonic() + timeout, next(self._counter), run))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._watch, daemon=True, name=f'{self._name}-watchdog')
+                self._thread.start()
+            elif self._heap[0][-1] is run:
+                self._condition.notify()
+
+    def _watch(self):
+        with self._condition:
+            while True:
+                while self._heap and self._heap[0][-1]._done.is_set():
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._thread = None
+                    return
+                deadline, _, run = self._heap[0]
+                timeout = deadline - monotonic()
+                if timeout > 0:
+                    self._condition.wait(timeout)
+                    continue
+                heapq.heappop(self._heap)
+                logger.warning(msg=f'run of job {run.job.name} is longer than its timeout and is cancelled')
+                run.token.cancel('timeout')
+
+
+class PriorityRunQueue:
+    """
+    queue of runs that give the run whit the smallest key first, runs whit the same key in submit order
+    it has the part of deque interface that WorkerPool use
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def append(self, run):
+        heapq.heappush(self._heap, (run.key, next(self._counter), run))
+
+    def popleft(self):
+        return heapq.heappop(self._heap)[-1]
+
+
+class WorkerPool:
+    """
+    fixed size pool of reusable worker threads whit a bounded queue
+    workers are started when there is more work than idle workers and stop after shutdown
+    overflow_policy decide what happen when queue is full
+    block: wait for a free place in queue
+    drop: do not run the job
+    run_late: give the job to run_late callback that run it later
+    a worker that submit to its own full pool would wait for itself forever, so block act like run_late there
+    (or like drop if there is no run_late callback)
+    """
+    overflow_policies = ('block', 'drop', 'run_late')
+
+    def __init__(self, max_workers=None, max_queue_size=1000, overflow_policy='block', name='agent', daemon=True,
+                 run_late=None, prioritized=False):
+        """
+        :param max_workers: max number of worker threads default is min(32, cpu count + 4)
+        :param max_queue_size: max number of runs waiting for a worker, 0 for no limit
+        :param overflow_policy: 'block', 'drop' or 'run_late'
+        :param name: prefix of worker thread names
+        :param daemon: run worker threads as daemon
+        :param run_late: function that get a job when overflow_policy is 'run_late' and queue is full
+        :param prioritized: workers take queued runs by their key instead of submit order
+        """
+        if max_workers is None:
+            max_workers = min(32, (os.cpu_count() or 1) + 4)
+        if max_workers <= 0:
+            raise InvalidOption('max_workers must be greater than 0')
+        if overflow_policy not in self.overflow_policies:
+            raise InvalidOption(f'overflow_policy must be one of {self.overflow_policies}')
+        if overflow_policy == 'run_late' and run_late is None:
+            raise InvalidOption('run_late callback is needed for run_late overflow_policy')
+        self._max_workers = max_workers
+        self._max_queue_size = max_queue_size
+        self._overflow_policy = overflow_policy
+        self._name = name
+        self._daemon = daemon
+        self._run_late = run_late
+        self._queue: Union[PriorityRunQueue, Deque[JobRun]] = PriorityRunQueue() if prioritized else collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._workers = set()
+        self._idle = 0
+        self._worker_counter = 0
+        self._shutdown = False
+
+    @property
+    def max_workers(self):
+        return self._max_workers
+
+    @property
+    def qsize(self):
+        """
+        number of runs waiting for a worker
+        """
+        return len(self._queue)
+
+    @property
+    def num_workers(self):
+        return len(self._workers)
+
+    def submit(self, job, run=None):
+        """
+        put a run of job in queue
+        :param job: a instance of job
+        :param run: JobRun of job that is created before, default is a new one
+        :return: JobRun, RUN_LATE if job is given to run_late or None if job is dropped
+        """
+        with self._lock:
+            self._shutdown = False
+            while self._max_queue_size and len(self._queue) >= self._max_queue_size:
+                # a worker that wait for its own pool could wait forever
+                if self._overflow_policy == 'block' and getattr(_worker_local, 'pool', None) is not self:
+                    self._not_full.wait()
+                    continue
+                break
+            else:
+                if run is None:
+                    run = JobRun(job)
+                self._queue.append(run)
+                self._not_empty.notify()
+                if len(self._queue) > self._idle and len(self._workers) < self._max_workers:
+                    self._start_worker()
+                return run
+
+        if self._overflow_policy == 'drop' or self._run_late is None:
+            logger.warning(msg=f'worker queue of {self._name} is full job {job.name} is dropped')
+            return None
+        logger.warning(msg=f'worker queue of {self._name} is full job {job.name} will run late')
+        self._run_late(job)
+        return RUN_LATE
+
+    def _start_worker(self):
+        self._worker_counter += 1
+        worker = threading.Thread(target=self._worker, daemon=self._daemon,
+                                  name=f'{self._name}-worker-{self._worker_counter}')
+        self._workers.add(worker)
+        worker.start()
+
+    def _worker(self):
+        _worker_local.pool = self
+        while True:
+            with self._lock:
+                self._idle += 1
+                while not self._queue and not self._shutdown:
+                    self._not_empty.wait()
+                self._idle -= 1
+                if not self._queue:
+                    self._workers.discard(threading.current_thread())
+                    return
+                run = self._queue.popleft()
+                self._not_full.notify()
+            try:
+                run._run()
+            except Exception:
+                logger.error(msg=f'worker {threading.current_thread().name} failed to run {run.job.name}',
+                             exc_info=True)
+
+    def shutdown(self):
+        """
+        stop workers after queue is empty, a later submit start workers again
+        :return: None
+        """
+        with self._lock:
+            self._shutdown = True
+            self._not_empty.notify_all()
+
+
+def _process_worker(conn):
+    """
+    main loop of a worker process, get (func, args, kwargs) and send back (is_success, return or exception)
+    """
+    while True:
+        try:
+            payload = conn.recv_bytes()
+        except (EOFError, OSError):
+            return
+        try:
+            func, args, kwargs = serializer.loads(payload)
+            result = (True, func(*args, **kwargs))
+        except BaseException as E:
+            result = (False, E)
+        try:
+            data = serializer.dumps(result)
+        except Exception as E:
+            data = serializer.dumps((False, ProcessWorkerError(f'cannot send result back to agent: {E!r}')))
+        conn.send_bytes(data)
+
+
+class _ProcessWorker:
+    def __init__(self, context, name):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_process_worker, args=(child_conn,), daemon=True, name=name)
+        self.process.start()
+        child_conn.close()
+
+    def close(self):
+        self.conn.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+
+    def kill(self):
+        """
+        stop a worker that is still running a function
+        """
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class ProcessPool:
+    """
+    pool of reusable worker processes for jobs that use options['executor'] = 'process'
+    processes are started when needed up to max_processes and stay alive for next runs
+    function, args and return value are sent whit dill (or pickle if dill is not installed)
+    """
+
+    def __init__(self, max_processes=None, mp_context='spawn', name='agent'):
+        """
+        :param max_processes: max number of worker processes default is cpu count
+        :param mp_context: multiprocessing start method name, default is 'spawn' because agent has threads and
+        a forked child can hang on a lock that another thread held, 'fork' is faster to start but is opt-in
+        :param name: prefix of worker process names
+        """
+        if max_processes is None:
+            max_processes = os.cpu_count() or 1
+        if max_processes <= 0:
+            raise InvalidOption('max_processes must be greater than 0')
+        self._max_processes = max_processes
+        self._context = multiprocessing.get_context(mp_context)
+        self._name = name
+        self._idle = []
+        self._num_processes = 0
+        self._process_counter = 0
+        self._condition = threading.Condition()
+        self._shutdown = False
+
+    @property
+    def num_processes(self):
+        return self._num_processes
+
+    def call(self, func, args=(), kwargs=None, timeout=None, cancel_token=None):
+        """
+        run func(*args, **kwargs) in a worker process and wait for it
+        a worker that is still running after timeout seconds or when cancel_token is cancelled is killed and
+        a new one is started for the next call
+        :return: return value of func
+        :raise: exception raised by func, JobTimeout or JobCancelled if worker is killed or ProcessWorkerError if
+        worker process died
+        """
+        payload = serializer.dumps((func, args, kwargs or {}))
+        worker = self._checkout()
+        try:
+            worker.conn.send_bytes(payload)
+            if timeout is not None or cancel_token is not None:
+                self._wait_result(worker, timeout, cancel_token)
+            is_success, value = serializer.loads(worker.conn.recv_bytes())
+        except JobCancelled:
+            # worker is already killed
+            raise
+        except (EOFError, OSError) as E:
+            self._discard(worker)
+            raise ProcessWorkerError(f'worker process {worker.process.name} died') from E
+        except BaseException:
+            self._discard(worker)
+            raise
+        self._checkin(worker)
+        if is_success:
+            return value
+        raise value
+
+    def _wait_result(self, worker, timeout, cancel_token):
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            # a cancel is seen after at most 0.1 seconds, a result is read as soon as it is sent
+            step = 0.1 if cancel_token is not None else None
+            if deadline is not None:
+                remaining = max(deadline - monotonic(), 0)
+                step = remaining if step is None else min(step, remaining)
+            if worker.conn.poll(step):
+                return
+            if cancel_token is not None and cancel_token.cancelled:
+                self._kill(worker)
+                cancel_token.raise_if_cancelled()
+            if deadline is not None and monotonic() >= deadline:
+                self._kill(worker)
+                raise JobTimeout(f'function did not return in {timeout} seconds')
+
+    def _kill(self, worker):
+        logger.warning(msg=f'worker process {worker.process.name} is killed')
+        with self._condition:
+            self._num_processes -= 1
+            self._condition.notify()
+        worker.kill()
+
+    def _checkout(self):
+        with self._condition:
+            self._shutdown = False
+            while True:
+                if self._idle:
+                    return self._idle.pop()
+                if self._num_processes < self._max_processes:
+                    self._num_processes += 1
+                    self._process_counter += 1
+                    name = f'{self._name}-process-{self._process_counter}'
+                    break
+                self._condition.wait()
+        try:
+            return _ProcessWorker(self._context, name)
+        except BaseException:
+            self._discard(None)
+            raise
+
+    def _checkin(self, worker):
+        with self._condition:
+            if not self._shutdown:
+                self._idle.append(worker)
+                self._condition.notify()
+                return
+            self._num_processes -= 1
+            self._condition.notify()
+        worker.close()
+
+    def _discard(self, worker):
+        with self._condition:
+            self._num_processes -= 1
+            self._condition.notify()
+        if worker is not None:
+            worker.close()
+
+    def shutdown(self):
+        """
+        close idle worker processes, busy ones are closed after their run, a later call start processes again
+        :return: None
+        """
+        with self._condition:
+            self._shutdown = True
+            idle, self._idle = self._idle, []
+            self._num_processes -= len(idle)
+            self._condition.notify_all()
+        for worker in idle:
+            worker.close()
@@ -22,12 +22,36 @@
 
 import datetime
 import logging
-from inspect import signature
+import math
+import random
+import weakref
+from inspect import Signature, signature
+from time import monotonic
 
+from src.agent.cron import compile_cron, get_timezone
 from src.agent.exceptions import InvalidOption
 from src.agent.interrupt import RunJobNow
 from enum import Enum
-from typing import Dict
+from typing import Any, Dict
+
+
+_signatures: 'weakref.WeakKeyDictionary[Any, Signature]' = weakref.WeakKeyDictionary()
+
+
+def cached_signature(func):
+    """
+    inspect.signature that is computed once for every function
+    :param func: a callable
+    :return: inspect.Signature
+    """
+    try:
+        return _signatures[func]
+    except KeyError:
+        func_sig = _signatures[func] = signature(func)
+        return func_sig
+    except TypeError:
+        # callable that can not be weak referenced
+        return signature(func)
 
 
 class _BaseHandler:
@@ -63,7 +87,7 @@ class _BaseHandler:
         """
         if custom_func_kwargs is None:
             custom_func_kwargs = {}
-        func_sig = signature(func)
+        func_sig = cached_signature(func)
         custom_func_args = custom_func_args
         custom_func_kwargs = custom_func_kwargs
         for args_name in pass_args:
@@ -79,30 +103,83 @@ class Cnrt(_BaseHandler):
     """
     Cnrt stands for calculate_next_run_time
     it is inherited from BaseHandler but dose not call _BaseHandler __init__
+    after every call `deadline` is the monotonic time of the returned next_run_time or None
     """
 
     def __init__(self, job, options):
         self.job = job
         self.options = options
+        self.deadline = None
 
         if self.options.get('scheduler') == 'interval':
             self.func = self._interval
         elif self.options.get('scheduler') == 'custom':
             self.func = self._custom
+        elif self.options.get('scheduler') == 'cron':
+            if not self.options.get('cron'):
+                raise InvalidOption('cron not fond, add a cron expression like \'*/5 * * * *\'')
+            self._cron = compile_cron(self.options['cron'])
+            self._timezone = get_timezone(self.options.get('timezone'))
+            self.func = self._cron_next_run_time
         else:
             raise InvalidOption()
 
+    def _set_anchor(self, next_run_time, now):
+        """
+        runs of interval job are planned at anchor + n * interval on monotonic clock so they do not drift
+        """
+        self._anchor_time = next_run_time
+        self._anchor = now + (next_run_time - datetime.datetime.now()).total_seconds()
+        self._slot = 0
+
     def _interval(self):
-        if self.options.get('interval'):
-            if self.job.next_run_time is None:
-                try:
-                    return self.options['start_time']
-                except KeyError:
-                    raise InvalidOption('start_time not fond')
-            else:
-                return self.job.next_run_time + datetime.timedelta(seconds=self.options['interval'])
-        else:
+        """
+        next slot after the current one, missed slots are handled by the options
+        catch_up: max number of missed runs to replay, default replay all
+        coalesce: True to replay missed runs as one run
+        misfire_grace_time: seconds a run can be late, older slots are skipped
+        """
+        interval = self.options.get('interval')
+        if not interval:
             raise InvalidOption('interval not fond or interval = 0')
+        now = monotonic()
+        if self.job.next_run_time is None:
+            try:
+                start_time = self.options['start_time']
+            except KeyError:
+                raise InvalidOption('start_time not fond')
+            self._set_anchor(start_time, now)
+            self.deadline = self._anchor
+            return start_time
+        if self.job.planned_deadline is None:
+            # next_run_time is set by hand or job is loaded
+            self._set_anchor(self.job.next_run_time, now)
+
+        slot = self._slot + 1
+        # the last slot that is already due
+        due = math.floor((now - self._anchor) / interval)
+        if self.options.get('catch_up') is not None:
+            slot = max(slot, due - self.options['catch_up'] + 1)
+        if self.options.get('coalesce'):
+            slot = max(slot, due)
+        if self.options.get('misfire_grace_time') is not None:
+            slot = max(slot, math.ceil((now - self.options['misfire_grace_time'] - self._anchor) / interval))
+        self._slot = slot
+        self.deadline = self._anchor + slot * interval
+        return self._anchor_time + datetime.timedelta(seconds=slot * interval)
+
+    def _cron_next_run_time(self):
+        now = datetime.datetime.now()
+        if self.job.next_run_time is None:
+            # first run can be exactly at start_time
+            after = self.options.get('start_time', now) - datetime.timedelta(microseconds=1)
+        else:
+            # missed fire times are skipped like cron do
+            after = max(self.job.next_run_time, now)
+        next_run_time = self._cron.next_fire_time(after, self._timezone)
+        if next_run_time.tzinfo is not None:
+            next_run_time = next_run_time.astimezone().replace(tzinfo=None)
+        return next_run_time
 
     def _custom(self):
 
@@ -143,11 +220,24 @@ class JobFailHandler(_BaseHandler):
             self.func = self._basics
         elif self.job_fail_handler_options.get('Handler') == 'restart_after_fail':
             self.func = self._restart_after_fail
+        elif self.job_fail_handler_options.get('Handler') == 'backoff':
+            self._check_backoff_options()
+            self.func = self._backoff
         elif self.job_fail_handler_options.get('Handler') == 'custom':
             self.func = self._custom
         else:
             raise InvalidOption()
 
+    def _check_backoff_options(self):
+        options = self.job_fail_handler_options
+        for key, default in (('base', 1), ('factor', 2), ('cap', 300)):
+            value = options.get(key, default)
+            if not isinstance(value, (int, float)) or value <= 0:
+                raise InvalidOption(f'backoff {key} must be a number > 0')
+        trys = options.get('num_restart_trys_after_fail', 5)
+        if not isinstance(trys, int) or trys < 0:
+            raise InvalidOption('num_restart_trys_after_fail must be a int >= 0')
+
     def __call__(self, *args, **kwargs):
         if self.func:
             self.func(kwargs.get('exception', Exception('unknown Error')))
@@ -165,16 +255,14 @@ class JobFailHandler(_BaseHandler):
                                     'num_restart_trys_after_fail')) - self.job.fail_count))
                         )
             if self.job.agent.is_running.is_set():
-                self.job.agent.interrupt = RunJobNow(self.job.agent, self.job)
-                self.job.agent.interrupt.set()
+                RunJobNow(self.job.agent, self.job).set()
             elif self.job_fail_handler_options.get(
                     'overwrite_agent_not_running') == self.OverwriteAgentNotRunning.force_restart_job:
                 self.job.is_not_running.set()
                 self.job.start()
             elif self.job_fail_handler_options.get(
                     'overwrite_agent_not_running') == self.OverwriteAgentNotRunning.force_run_agent:
-                self.job.agent.interrupt = RunJobNow(self.job.agent, self.job)
-                self.job.agent.interrupt.set()
+                RunJobNow(self.job.agent, self.job).set()
                 self.job.agent.start()
             else:
                 logging.log(level=logging.WARNING,
@@ -184,6 +272,29 @@ class JobFailHandler(_BaseHandler):
             logging.log(level=logging.INFO,
                         msg='job {} failed more than {} times'.format(self.job.name, self.job.fail_count))
 
+    def _backoff(self, exception: Exception):
+        """
+        retry after a random delay between 0 and min(cap, base * factor ** fail_count) seconds (full jitter)
+        the retry is planned like a normal run in timer queue of agent, after num_restart_trys_after_fail
+        retries job go back to the schedule of its options
+        """
+        options = self.job_fail_handler_options
+        trys = options.get('num_restart_trys_after_fail', 5)
+        if self.job.fail_count > trys:
+            logging.log(level=logging.INFO,
+                        msg='job {} failed more than {} times'.format(self.job.name, self.job.fail_count))
+            return
+        cap = options.get('cap', 300)
+        try:
+            ceiling = min(cap, options.get('base', 1) * options.get('factor', 2) ** self.job.fail_count)
+        except OverflowError:
+            ceiling = cap
+        delay = random.uniform(0, ceiling)
+        logging.log(level=logging.INFO,
+                    msg='retry job {} after {} fail in {:.3f} seconds {} remaining'.format(
+                        self.job.name, self.job.fail_count, delay, trys - self.job.fail_count))
+        self.job._plan_retry(delay)
+
     def _custom(self, exception: Exception):
 
         if not hasattr(self, '_custom_func'):
@@ -0,0 +1,304 @@
+# ------------------------------------------------------------------------------
+# Copyright 2021 Mohammad Reza Golsorkhi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+# name: history.py
+# Description: bounded run history of jobs in arrays whit streaming quantiles
+# Version: 0.1.0
+# Author: Mohammad Reza Golsorkhi
+# ------------------------------------------------------------------------------
+
+
+import sys
+import threading
+from array import array
+from typing import Optional, Tuple
+
+SUCCESS = 1
+FAILED = 2
+MISFIRED = 3
+
+OUTCOMES = {SUCCESS: 'success', FAILED: 'failed', MISFIRED: 'misfired'}
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class P2Quantile:
+    """
+    P-square estimator of a quantile (Jain and Chlamtac 1985)
+    five markers follow the quantile of a stream, memory is constant and no value is kept
+    """
+
+    __slots__ = ('p', 'count', '_heights', '_positions', '_desired', '_increments')
+
+    def __init__(self, p):
+        if not 0 < p < 1:
+            raise ValueError('quantile must be between 0 and 1')
+        self.p = p
+        self.count = 0
+        # lists of floats are faster to update in place than arrays that box every read
+        self._heights = [0.0] * 5
+        self._positions = [1, 2, 3, 4, 5]
+        self._desired = [1.0, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5.0]
+        self._increments = (0.0, p / 2, p, (1 + p) / 2, 1.0)
+
+    def add(self, x):
+        q, n = self._heights, self._positions
+        if self.count < 5:
+            q[self.count] = x
+            self.count += 1
+            if self.count == 5:
+                q.sort()
+            return
+        self.count += 1
+        if x < q[0]:
+            q[0] = x
+            k = 1
+        elif x >= q[4]:
+            q[4] = x
+            k = 4
+        elif x < q[1]:
+            k = 1
+        elif x < q[2]:
+            k = 2
+        elif x < q[3]:
+            k = 3
+        else:
+            k = 4
+        while k < 5:
+            n[k] += 1
+            k += 1
+        desired, increments = self._desired, self._increments
+        desired[1] += increments[1]
+        desired[2] += increments[2]
+        desired[3] += increments[3]
+        desired[4] += 1
+        for i in (1, 2, 3):
+            d = desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                # piecewise parabolic prediction, linear if it leave the neighbour markers
+                height = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                        (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+                        (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    def value(self):
+        """
+        :return: estimated quantile or None if there is no value
+        """
+        if self.count == 0:
+            return None
+        if self.count < 5:
+            values = sorted(self._heights[:self.count])
+            return values[min(int(self.p * self.count), self.count - 1)]
+        return self._heights[2]
+
+
+class RunHistory:
+    """
+    the last size runs of a job in a ring buffer of arrays
+    (start timestamp, duration seconds, lag seconds, outcome code) and quantiles of duration and lag of all runs
+    recording a run write in place so memory of a job is constant, nothing is allocated before the first run
+    runs of a job whit max_instances > 1 can record at the same time so buffer and estimators are locked
+    """
+
+    def __init__(self, size=100, quantiles=QUANTILES):
+        """
+        :param size: number of runs that are kept
+        :param quantiles: quantiles of duration and lag that stats report
+        """
+        self.size = size
+        self.quantiles = tuple(quantiles)
+        # arrays and estimators are allocated on the first run, most registered jobs wait a long time
+        self._start: Optional['array[float]'] = None
+        self._duration: Optional['array[float]'] = None
+        self._lag: Optional['array[float]'] = None
+        self._outcome: Optional['array[int]'] = None
+        self._duration_quantiles: Tuple[P2Quantile, ...] = ()
+        self._lag_quantiles: Tuple[P2Quantile, ...] = ()
+        self._index = 0
+        self.count = 0
+        self.failures = 0
+        self.misfires = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _allocate(self):
+        self._start = array('d', bytes(8 * self.size))
+        self._duration = array('d', bytes(8 * self.size))
+        self._lag = array('d', bytes(8 * self.size))
+        self._outcome = array('b', bytes(self.size))
+        self._duration_quantiles = tuple(P2Quantile(p) for p in self.quantiles)
+        self._lag_quantiles = tuple(P2Quantile(p) for p in self.quantiles)
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def __repr__(self):
+        return f'RunHistory runs : {self.count} kept : {len(self)}'
+
+    def record(self, start, duration, lag, outcome):
+        """
+        :param start: timestamp that run started
+        :param duration: seconds
+        :param lag: seconds that run started after its next_run_time
+        :param outcome: SUCCESS, FAILED or MISFIRED
+        """
+        with self._lock:
+            if self._start is None:
+                self._allocate()
+            assert self._start is not None and self._duration is not None and self._lag is not None \
+                and self._outcome is not None
+            if self.size:
+                i = self._index
+                self._start[i] = start
+                self._duration[i] = duration
+                self._lag[i] = lag
+                self._outcome[i] = outcome
+                self._index = (i + 1) % self.size
+            self.count += 1
+            if outcome == FAILED:
+                self.failures += 1
+            elif outcome == MISFIRED:
+                self.misfires += 1
+                # a misfired run has no duration
+                return
+            for quantile in self._duration_quantiles:
+                quantile.add(duration)
+            for quantile in self._lag_quantiles:
+                quantile.add(lag)
+
+    def runs(self):
+        """
+        :return: list of (start, duration, lag, outcome name) of kept runs, oldest first
+        """
+        with self._lock:
+            n = len(self)
+            if not n:
+                return []
+            assert self._start is not None and self._duration is not None and self._lag is not None \
+                and self._outcome is not None
+            first = (self._index - n) % self.size
+            return [(self._start[i], self._duration[i], self._lag[i], OUTCOMES[self._outcome[i]])
+                    for i in ((first + j) % self.size for j in range(n))]
+
+    def _quantile_values(self, estimators):
+        if not estimators:
+            return dict.fromkeys(self.quantiles)
+        return {q.p: q.value() for q in estimators}
+
+    def stats(self):
+        """
+        :return: dict whit number of runs, failure and misfire rate of all runs and
+        {quantile: seconds} of duration and lag
+        """
+        with self._lock:
+            return {
+                'runs': self.count,
+                'failures': self.failures,
+                'misfires': self.misfires,
+                'failure_rate': self.failures / self.count if self.count else 0.0,
+                'duration': self._quantile_values(self._duration_quantiles),
+                'lag': self._quantile_values(self._lag_quantiles),
+            }
+
+
+class LagSummary:
+    """
+    count, mean, max and quantiles of a stream of lags in constant memory
+    """
+
+    def __init__(self, quantiles=QUANTILES):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._quantiles = tuple(P2Quantile(p) for p in quantiles)
+
+    def add(self, lag):
+        self.count += 1
+        self.total += lag
+        if lag > self.max:
+            self.max = lag
+        for quantile in self._quantiles:
+            quantile.add(lag)
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'quantiles': {q.p: q.value() for q in self._quantiles},
+        }
+
+
+def limit_return(value, max_size):
+    """
+    keep a return value of a run only if it is small
+    str and bytes are truncated to max_size, other values bigger than max_size bytes are dropped
+    :param max_size: bytes or None for no limit
+    :return: (value, is_limited)
+    """
+    if max_size is None:
+        return value, False
+    if isinstance(value, (str, bytes, bytearray)):
+        if len(value) > max_size:
+            return value[:max_size], True
+        return value, False
+    if _deep_size(value, max_size) > max_size:
+        return None, True
+    return value, False
+
+
+def _deep_size(value, max_size):
+    """
+    size of value and every object it refer to, an object is counted once
+    :return: bytes, counting stop when it is over max_size
+    """
+    size = 0
+    seen = set()
+    stack = [value]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if size > max_size:
+            break
+        if isinstance(obj, (str, bytes, bytearray, int, float, complex, bool, type(None))):
+            continue
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__') and not isinstance(obj, type):
+            stack.append(obj.__dict__)
+        slots = getattr(type(obj), '__slots__', ())
+        for name in (slots,) if isinstance(slots, str) else slots:
+            if hasattr(obj, name):
+                stack.append(getattr(obj, name))
+    return size
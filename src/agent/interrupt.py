@@ -42,6 +42,14 @@ class BaseInterrupt(Event):
     def agent(self):
         raise PermissionError('cannot delete agent')
 
+    def set(self):
+        """
+        set interrupt and queue it for agent thread, agent thread is woken up immediately
+        it never block so many threads can set interrupts at the same time
+        """
+        super().set()
+        self._agent._post_interrupt(self)
+
     def interrupt_handler(self):
         """
         this function always run after Interrupt set by agent thread
@@ -65,6 +73,43 @@ class RunJobNow(BaseInterrupt):
     def interrupt_handler(self):
         self.agent.run_job(self.job)
 
+
+class PauseJob(BaseInterrupt):
+    """
+    disable job so agent do not run it until ResumeJob
+    """
+
+    def __init__(self, agent, job):
+        super().__init__(agent)
+        self.job = job
+
+    def interrupt_handler(self):
+        self.job.is_enable = False
+
+
+class ResumeJob(BaseInterrupt):
+    def __init__(self, agent, job):
+        super().__init__(agent)
+        self.job = job
+
+    def interrupt_handler(self):
+        self.job.is_enable = True
+
+
+class RescheduleJob(BaseInterrupt):
+    """
+    move next run of job to next_run_time
+    """
+
+    def __init__(self, agent, job, next_run_time):
+        super().__init__(agent)
+        self.job = job
+        self.next_run_time = next_run_time
+
+    def interrupt_handler(self):
+        self.job.next_run_time = self.next_run_time
+
+
 class NoneInterrupt(BaseInterrupt):
     """
     this Interrupt is for empty Interrupt
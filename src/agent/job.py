@@ -20,19 +20,39 @@
 # ------------------------------------------------------------------------------
 
 
+import asyncio
 import threading
 
-from threading import Thread, Event
+from threading import Event
+from time import monotonic, perf_counter, time
 import datetime
-from inspect import signature
+from contextlib import contextmanager
 from enum import Enum
-from src.agent.handler import Cnrt, JobFailHandler, JobSuccessHandler
-from src.agent.exceptions import JobNotRunning
-import inspect
+from typing import Any, Dict
+from src.agent.handler import Cnrt, JobFailHandler, JobSuccessHandler, cached_signature
+from src.agent.exceptions import JobCancelled, JobNotRunning, JobTimeout, InvalidOption
+from src.agent.executor import NO_RUN, CancelToken
+from src.agent.history import FAILED, MISFIRED, SUCCESS, RunHistory, limit_return
+from src.agent.limits import token_bucket
+from src.agent.profiling import RunProfiler
 import logging
 
 logger = logging.getLogger(__name__)
 
+_agent_construction = threading.local()
+
+
+@contextmanager
+def agent_construction():
+    """
+    jobs that are created in this block are created by agent and get ready in Job.__init__
+    """
+    _agent_construction.active = True
+    try:
+        yield
+    finally:
+        _agent_construction.active = False
+
 
 class LastRuntimeState(str, Enum):
     never_executed = 0
@@ -42,6 +62,8 @@ class LastRuntimeState(str, Enum):
 
 class Job:
     _initialized = False
+    # run get its cancel_token as a keyword argument
+    _pass_cancel_token = False
 
     def __repr__(self):
         return str(self.status)
@@ -51,32 +73,73 @@ class Job:
 
     def __init__(self, agent, job_id, name, options, is_enable, args=None, kwargs=None, **variables):
         logger.info(msg=f'initializing job {name}')
-        stack = inspect.stack()
-        caller_class = stack[1][0].f_locals["self"].__class__
         self._id = job_id
         self._name = name
         self._agent = agent
         self._fail_count = 0
-        self.status = {}
+        self._next_run_time = None
+        self._planned_deadline = None
+        # (next_run_time, planned deadline) of schedule that a backoff retry is planned before
+        self._resume_next_run_time = None
+        self._is_enable = False
+        self.status: Dict[str, Any] = {
+            'LastRunState': LastRuntimeState.never_executed,
+            'LastRuntime': None,
+        }
         self.__dict__.update(variables)
         self.update_status()
         self.options = options
+        history_size = options.get('history_size', 100)
+        if not isinstance(history_size, int) or history_size < 0:
+            raise InvalidOption('history_size must be a int >= 0')
+        self.history = RunHistory(history_size)
+        tags = options.get('tags', ())
+        if isinstance(tags, str) or not all(isinstance(tag, str) for tag in tags):
+            raise InvalidOption('tags must be a list of str')
+        self.tags = tuple(tags)
+        self._profiler = None if options.get('profile') is None else RunProfiler(name, options['profile'])
+        self.max_instances = options.get('max_instances', 1)
+        if not isinstance(self.max_instances, int) or self.max_instances < 1:
+            raise InvalidOption('max_instances must be a int >= 1')
+        self.priority = options.get('priority', 0)
+        if not isinstance(self.priority, int):
+            raise InvalidOption('priority must be a int')
+        self.deadline_tolerance = options.get('deadline_tolerance', 0)
+        if not isinstance(self.deadline_tolerance, (int, float)) or self.deadline_tolerance < 0:
+            raise InvalidOption('deadline_tolerance must be seconds >= 0')
+        # runs that hold concurrency slots and runs that wait for them, agent limiter change them
+        self._admitted = 0
+        self._parked = 0
+        self._running = 0
+        # runs that wait for rate limit tokens, agent limiter change it like _admitted and _parked
+        self._deferred = 0
+        self._rate_bucket = token_bucket(options.get('rate_limit'))
+        self.run_timeout = options.get('run_timeout')
+        if self.run_timeout is not None and (not isinstance(self.run_timeout, (int, float)) or self.run_timeout <= 0):
+            raise InvalidOption('run_timeout must be seconds > 0')
+        # bound method is a new object on every access, signature is cached for the class function
+        self._pass_cancel_token = self._pass_cancel_token or \
+            cached_signature(type(self).run).parameters.get('cancel_token') is not None
+        self._active_runs = set()
+        self._run_lock = threading.Lock()
+        self._run_start = 0.0
+        self._run_clock = 0.0
         self.next_run_time = None
         self._calculate_next_run_time = Cnrt(self, options)
         self._job_fail_handler = JobFailHandler(self, options=self.options)
         self._job_success_handler = JobSuccessHandler(self, options=self.options)
-        self.next_run_time = self._calculate_next_run_time()
+        self._plan_next_run()
         self._is_not_running = Event()
         self._is_not_running.set()
         self.is_enable = is_enable
-        self.job_thread = threading.Thread()
-        if 'Agent' == caller_class.__name__:
+        self.job_thread = NO_RUN
+        if getattr(_agent_construction, 'active', False):
             self._kwargs = kwargs
             if kwargs is None:
                 self._kwargs = {}
             self._args = args
             if args is None:
-                self._kwargs = ()
+                self._args = ()
             self.ready()
 
     def ready(self):
@@ -88,74 +151,260 @@ class Job:
         self.status.update({
             'job_id': self._id,
             'name': self._name,
-            'LastRunState': LastRuntimeState.never_executed,
-            'LastRuntime': None,
             'fail_count': self._fail_count
         })
 
     def run(self, *args, **kwargs):
         pass
 
-    def _job_run(self):
+    def _job_run(self, job_run=None):
+        """
+        :param job_run: JobRun that run in this thread, its token is cancelled by stop or after run_timeout
+        """
+        token = CancelToken() if job_run is None else job_run.token
+        kwargs = {**self._kwargs, 'cancel_token': token} if self._pass_cancel_token else self._kwargs
         try:
-            self._is_not_running.clear()
-            logger.info(msg=f'starting job {self._name}')
-            self.next_run_time = self._calculate_next_run_time()
-            logger.info(msg=f'executing job {self._name} function')
-            self.status['last_return'] = self.run(*self._args, **self._kwargs)
+            self._run_started(job_run)
+            if self._profiler is None:
+                value = self.run(*self._args, **kwargs)
+            else:
+                value = self._profiler.call(self.run, self._args, kwargs)
+            if token.timed_out:
+                raise JobTimeout(f'job {self._name} is longer than run_timeout {self.run_timeout} seconds')
+            self._set_return(value)
         except Exception as E:
-            print(E)
-            self._fail_count += 1
-            self.status['LastRunState'] = LastRuntimeState.failed
-            logger.error(msg=f'job: {self.name} Failed to Execute du\n', exc_info=True)
-            self._job_fail_handler(exception=E)
+            if token.timed_out and not isinstance(E, JobTimeout):
+                E = JobTimeout(f'job {self._name} is longer than run_timeout {self.run_timeout} seconds: {E!r}')
+            self._run_failed(E)
             return 0
         else:
-            self._fail_count = 0
-            self._job_success_handler()
-            logger.info(msg=f'job {self.name} execute successfully')
-            self.status['LastRunState'] = LastRuntimeState.success
+            self._run_succeeded()
         finally:
-            self.status['LastRuntime'] = datetime.datetime.now()
-            self.update_status()
-            self._is_not_running.set()
-            logging.log(level=logging.DEBUG, msg=str(self.status))
+            self._run_finished(job_run)
+
+    def _set_return(self, value):
+        """
+        keep return value of run in status['last_return'], values bigger than options['max_return_size']
+        are truncated or dropped
+        """
+        value, limited = limit_return(value, self.options.get('max_return_size'))
+        if limited:
+            logger.debug(msg=f'return value of job {self._name} is bigger than max_return_size')
+        self.status['last_return'] = value
+        self.status['last_return_limited'] = limited
+
+    def _run_started(self, job_run=None):
+        with self._run_lock:
+            self._running += 1
+            self._is_not_running.clear()
+            if job_run is not None:
+                self._active_runs.add(job_run)
+        if job_run is not None and self.run_timeout is not None:
+            watchdog = getattr(self._agent, '_watchdog', None)
+            if watchdog is not None:
+                watchdog.watch(job_run, self.run_timeout)
+        self._run_start = time()
+        self._run_clock = perf_counter()
+        logger.info(msg=f'starting job {self._name}')
+        self._plan_next_run()
+        logger.info(msg=f'executing job {self._name} function')
+
+    def _run_failed(self, exception):
+        print(exception)
+        self._fail_count += 1
+        self.status['LastRunState'] = LastRuntimeState.failed
+        logger.error(msg=f'job: {self.name} Failed to Execute du\n', exc_info=True)
+        if type(exception) is JobCancelled:
+            # a run that is stopped is not restarted
+            return
+        self._job_fail_handler(exception=exception)
+
+    def _run_succeeded(self):
+        self._fail_count = 0
+        self._job_success_handler()
+        logger.info(msg=f'job {self.name} execute successfully')
+        self.status['LastRunState'] = LastRuntimeState.success
+
+    def _run_finished(self, job_run=None):
+        duration = perf_counter() - self._run_clock
+        failed = self.status['LastRunState'] is LastRuntimeState.failed
+        self.history.record(self._run_start, duration, self.status.get('last_lag', 0.0), FAILED if failed else SUCCESS)
+        metrics = getattr(self._agent, 'metrics', None)
+        if metrics is not None:
+            metrics.observe_run(self, duration, failed)
+        self.status['LastRuntime'] = datetime.datetime.now()
+        self.update_status()
+        with self._run_lock:
+            self._active_runs.discard(job_run)
+            self._running -= 1
+            if self._running <= 0:
+                self._running = 0
+                self._is_not_running.set()
+        logging.log(level=logging.DEBUG, msg=str(self.status))
+        self._schedule()
+        run_done = getattr(self._agent, '_run_done', None)
+        if run_done is not None:
+            run_done(self)
+
+    def _plan_next_run(self):
+        """
+        set next_run_time and its monotonic deadline from Cnrt
+        a run that is planned before a backoff retry is restored instead so Cnrt do not skip it
+        """
+        if self._resume_next_run_time is not None:
+            (self._next_run_time, self._planned_deadline), self._resume_next_run_time = \
+                self._resume_next_run_time, None
+        else:
+            self._next_run_time = self._calculate_next_run_time()
+            self._planned_deadline = self._calculate_next_run_time.deadline
+        self._schedule()
+
+    def _plan_retry(self, delay):
+        """
+        run job after delay seconds and then go back to the planned run
+        a retry that is not before the planned run is not needed
+        job is scheduled whit the retry when the current run finish
+        """
+        deadline = monotonic() + delay
+        if self._resume_next_run_time is None:
+            resume = (self._next_run_time, self._planned_deadline)
+        else:
+            resume = self._resume_next_run_time
+        resume_deadline = resume[1]
+        if resume_deadline is None and resume[0] is not None:
+            resume_deadline = monotonic() + (resume[0] - datetime.datetime.now()).total_seconds()
+        if resume_deadline is not None and deadline >= resume_deadline:
+            self._next_run_time, self._planned_deadline = resume
+            self._resume_next_run_time = None
+            return
+        self._resume_next_run_time = resume
+        self._next_run_time = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+        self._planned_deadline = deadline
+
+    def _dispatch_lag(self):
+        """
+        :return: seconds that now is after next_run_time
+        """
+        if self._planned_deadline is not None:
+            return monotonic() - self._planned_deadline
+        if self._next_run_time is None:
+            return 0.0
+        return (datetime.datetime.now() - self._next_run_time).total_seconds()
+
+    def _misfire(self, lag):
+        """
+        skip the due run that is later than misfire_grace_time and plan the next one
+        """
+        self.status['misfire_count'] = self.status.get('misfire_count', 0) + 1
+        self.history.record(time(), 0.0, lag, MISFIRED)
+        metrics = getattr(self._agent, 'metrics', None)
+        if metrics is not None:
+            metrics.observe_misfire(self)
+        logger.warning(msg=f'job {self._name} missed its run by {lag:.3f} seconds')
+        self._plan_next_run()
+
+    def _schedule(self):
+        """
+        tell agent to put this job in its timer queue whit the current next_run_time
+        """
+        if self._initialized:
+            self._agent._schedule_job(self)
+
+    def __setstate__(self, state):
+        # jobs saved before next_run_time and is_enable became properties
+        if 'next_run_time' in state:
+            state['_next_run_time'] = state.pop('next_run_time')
+        if 'is_enable' in state:
+            state['_is_enable'] = state.pop('is_enable')
+        # monotonic time is meaningless in another process, Cnrt plan again from next_run_time
+        state['_planned_deadline'] = None
+        resume = state.get('_resume_next_run_time')
+        state['_resume_next_run_time'] = None if resume is None else (resume[0], None)
+        # jobs saved before run history
+        state.setdefault('history', RunHistory(state.get('options', {}).get('history_size', 100)))
+        state.setdefault('_run_start', 0.0)
+        state.setdefault('_run_clock', 0.0)
+        state.setdefault('tags', tuple(state.get('options', {}).get('tags', ())))
+        state.setdefault('_profiler', None)
+        state.setdefault('max_instances', state.get('options', {}).get('max_instances', 1))
+        state.setdefault('priority', state.get('options', {}).get('priority', 0))
+        state.setdefault('deadline_tolerance', state.get('options', {}).get('deadline_tolerance', 0))
+        state['_admitted'] = state['_parked'] = state['_running'] = state['_deferred'] = 0
+        state.setdefault('_rate_bucket', token_bucket(state.get('options', {}).get('rate_limit')))
+        state.setdefault('run_timeout', state.get('options', {}).get('run_timeout'))
+        state.setdefault('_pass_cancel_token', False)
+        state['_active_runs'] = set()
+        state['_run_lock'] = threading.Lock()
+        self.__dict__.update(state)
 
     def stop(self, timeout: float = 10, silence_error=None):
         """
-        stop job Thread if is _is_not_running == False
-        this function use threading join for stopping the FunctionJob Thread
+        stop job runs if is _is_not_running == False
+        this function cancel cancel_token of every run and join them, a process job is killed but a thread can
+        not be killed so a function that do not check its cancel_token keep running and job stay running
         if _is_not_running == True this function raise JobNotRunning but you can use silence_error
 
         if silence_error Not None than return  silence_error
-        :param timeout: wait before kill job Thread by default is set to 10
+        :param timeout: wait for runs to stop by default is set to 10
         :param silence_error: None for raise JobNotRunning() or return silence_error if not none
-        :return: 1 if successful None if not
+        :return: 1 if successful None if a run is still running after timeout
         """
         if self._is_not_running.is_set():
             if silence_error:
                 return None
             raise JobNotRunning()
-        else:
-            self.job_thread.join(timeout=timeout)
-            self._is_not_running.set()
-            return 1
+        with self._run_lock:
+            runs = list(self._active_runs) or [self.job_thread]
+        for job_run in runs:
+            job_run.token.cancel('stop')
+        deadline = monotonic() + timeout
+        for job_run in runs:
+            if not job_run.join(timeout=max(deadline - monotonic(), 0)):
+                logger.warning(msg=f'job {self._name} is still running {timeout} seconds after stop')
+                return None
+        return 1
 
     def start(self, timeout=None):
         """
-        start job in a another Thread whit name of job
-        by default daemon is set to True you can change this in options
-        :return: 1 if successful
+        submit a run of job to worker pool of agent, it never wait
+        a job that has options['max_instances'] runs or a full agent or tag limit queue the run until a slot is free
+        job.job_thread is set to the submitted run and can be joined like a Thread
+        :param timeout: not used, runs wait for a slot in agent
+        :return: 1 if successful 0 if worker pool did not accept the run
         """
-        if not self.is_not_running.is_set():
-            logger.warning(msg=f'job {self.name} is running whiting for job to done')
-            if not self.is_not_running.wait(timeout=timeout):
-                logging.log(level=logging.WARNING, msg=f'timeout occurred on job{self.name}')
-
-        self.job_thread = Thread(target=self._job_run, daemon=self.options.get('daemon', True), name=self._name)
-        self.job_thread.start()
+        job_run = self._agent._submit(self)
+        if job_run is None:
+            return 0
+        self.job_thread = job_run
         return 1
 
+    @property
+    def next_run_time(self):
+        return self._next_run_time
+
+    @next_run_time.setter
+    def next_run_time(self, val):
+        self._next_run_time = val
+        self._planned_deadline = None
+        self._resume_next_run_time = None
+        self._schedule()
+
+    @property
+    def planned_deadline(self):
+        """
+        monotonic time that next_run_time was planned for, None if next_run_time is only a wall clock time
+        """
+        return self._planned_deadline
+
+    @property
+    def is_enable(self):
+        return self._is_enable
+
+    @is_enable.setter
+    def is_enable(self, val):
+        self._is_enable = val
+        self._schedule()
+
     @property
     def initialized(self):
         return self._initialized
@@ -209,10 +458,7 @@ class Job:
         if not self._is_not_running.is_set():
             raise PermissionError('cannot set name of active job')
         else:
-            if self.agent.get_job_by_name(val) is None:
-                self._name = val
-            else:
-                raise NameError('name in agent must be unique {} already exist'.format(val))
+            self.agent.jobs.rename(self, val)
 
     @property
     def id(self):
@@ -231,10 +477,13 @@ class FunctionJob(Job):
         self._func = func
         self._args = args
 
-        func_sig = signature(self._func)
+        func_sig = cached_signature(self._func)
         self._kwargs = kwargs
         if kwargs is None:
             self._kwargs = {}
+        self._executor = options.get('executor', 'thread')
+        if self._executor not in ('thread', 'process'):
+            raise InvalidOption("executor must be 'thread' or 'process'")
         if (len(self._args) + len(self._kwargs) < len(func_sig.parameters)) and func_sig.parameters.get(
                 'job') is not None:
             self._kwargs = {**self._kwargs, **{'job': self}}
@@ -243,30 +492,66 @@ class FunctionJob(Job):
                 'agent') is not None:
             self._kwargs = {**self._kwargs, **{'agent': agent}}
 
-        super().__init__(agent, job_id, name, options, is_enable, **job_variables)
-        self.ready()
+        if (len(self._args) + len(self._kwargs) < len(func_sig.parameters)) and func_sig.parameters.get(
+                'cancel_token') is not None:
+            # token of each run is added when it start
+            self._pass_cancel_token = True
+
+        if self._executor == 'process' and ('job' in self._kwargs or 'agent' in self._kwargs or
+                                            self._pass_cancel_token):
+            raise InvalidOption('job, agent and cancel_token can not be sent to a function that run in a process')
+        if self._executor == 'process':
+            # run use token to kill the process
+            self._pass_cancel_token = True
+
+        super().__init__(agent, job_id, name, options, is_enable, self._args, self._kwargs, **job_variables)
+        if not self._initialized:
+            self.ready()
+
+    def run(self, *args, **kwargs):
+        if self._executor == 'process':
+            cancel_token = kwargs.pop('cancel_token', None)
+            return self._agent._process_pool.call(self._func, args, kwargs, self.run_timeout, cancel_token)
+        return self._func(*args, **kwargs)
+
+
+class AsyncFunctionJob(FunctionJob):
+    """
+    FunctionJob for `async def` functions
+    AsyncAgent run it as a task on its event loop, without a running loop each run get its own loop
+    """
 
-    def _job_run(self):
+    def __init__(self, agent, job_id, name, func, options, is_enable, args, kwargs, **job_variables):
+        if options.get('executor', 'thread') != 'thread':
+            raise InvalidOption('async jobs run on event loop of agent and can not use executor option')
+        if options.get('profile') is not None:
+            raise InvalidOption('async jobs share event loop whit other tasks and can not be profiled')
+        super().__init__(agent, job_id, name, func, options, is_enable, args, kwargs, **job_variables)
+
+    async def _job_run_async(self, job_run=None):
+        """
+        a run that is longer than run_timeout is cancelled on event loop
+        """
+        token = CancelToken() if job_run is None else job_run.token
+        kwargs = {**self._kwargs, 'cancel_token': token} if self._pass_cancel_token else self._kwargs
         try:
-            self._is_not_running.clear()
-            logger.info(msg=f'starting job {self._name}')
-            self.next_run_time = self._calculate_next_run_time()
-            logger.info(msg=f'executing job {self._name} function')
-            self.status['last_return'] = self._func(*self._args, **self._kwargs)
+            self._run_started()
+            try:
+                if self.run_timeout is None:
+                    value = await self._func(*self._args, **kwargs)
+                else:
+                    value = await asyncio.wait_for(self._func(*self._args, **kwargs), self.run_timeout)
+            except asyncio.TimeoutError:
+                token.cancel('timeout')
+                raise JobTimeout(f'job {self._name} is longer than run_timeout {self.run_timeout} seconds')
+            self._set_return(value)
         except Exception as E:
-            print(E)
-            self._fail_count += 1
-            self.status['LastRunState'] = LastRuntimeState.failed
-            logger.error(msg=f'job: {self.name} Failed to Execute du\n', exc_info=True)
-            self._job_fail_handler(exception=E)
+            self._run_failed(E)
             return 0
         else:
-            self._fail_count = 0
-            self._job_success_handler()
-            logger.info(msg=f'job {self.name} execute successfully')
-            self.status['LastRunState'] = LastRuntimeState.success
+            self._run_succeeded()
         finally:
-            self.status['LastRuntime'] = datetime.datetime.now()
-            self.update_status()
-            self._is_not_running.set()
-            logging.log(level=logging.DEBUG, msg=str(self.status))
+            self._run_finished()
+
+    def run(self, *args, **kwargs):
+        return asyncio.run(self._func(*args, **kwargs))
@@ -0,0 +1,182 @@
+# ------------------------------------------------------------------------------
+# Copyright 2021 Mohammad Reza Golsorkhi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+# name: jobstore.py
+# Description: persistent stores of job definitions and their runtime state
+# Version: 0.1.0
+# Author: Mohammad Reza Golsorkhi
+# ------------------------------------------------------------------------------
+
+
+import datetime
+import sqlite3
+import threading
+
+from src.agent.serialization import dumps_definition, job_state, loads_definition
+
+
+def _to_timestamp(value):
+    return None if value is None else value.timestamp()
+
+
+def _from_timestamp(value):
+    return None if value is None else datetime.datetime.fromtimestamp(value)
+
+
+class BaseJobStore:
+    """
+    BaseJobStore is a Interface do not use it
+    a job store keep definition and state of jobs by job name
+    records are dict whit 'name', 'definition' and the keys of job_state, see serialization.py
+    """
+
+    def add_job(self, job):
+        """
+        save definition and state of job, a job whit the same name is replaced
+        :param job: a instance of job
+        :return: None
+        """
+        self.add_jobs([job])
+
+    def add_jobs(self, jobs):
+        """
+        save many jobs in one transaction
+        :param jobs: iterable of jobs
+        :return: None
+        """
+        raise NotImplementedError
+
+    def update_job_state(self, job):
+        """
+        save only state of job, definition is not written again
+        :param job: a instance of job
+        :return: None
+        """
+        raise NotImplementedError
+
+    def remove_job(self, name):
+        """
+        :param name: name of job
+        :return: 1 if job removed 0 if job not found
+        """
+        raise NotImplementedError
+
+    def get_job(self, name):
+        """
+        :param name: name of job
+        :return: record or None
+        """
+        raise NotImplementedError
+
+    def get_due_jobs(self, until):
+        """
+        enabled jobs that their next_run_time is not after until, ordered by next_run_time
+        :param until: datetime
+        :return: list of records
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteJobStore(BaseJobStore):
+    """
+    job store in a SQLite database
+    WAL journal let readers work while a run write its state, next_run_time is indexed so
+    get_due_jobs read only due rows, definitions are written once and state is updated in place
+    """
+
+    def __init__(self, path=':memory:', table='jobs'):
+        """
+        :param path: database file
+        :param table: table name
+        """
+        if not table.isidentifier():
+            raise ValueError(f'invalid table name {table!r}')
+        self._table = table
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        # WAL whit synchronous NORMAL do not lose consistency, only the last commits on power loss
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                name TEXT PRIMARY KEY,
+                next_run_time REAL,
+                is_enable INTEGER NOT NULL,
+                fail_count INTEGER NOT NULL DEFAULT 0,
+                last_run_state TEXT,
+                last_runtime REAL,
+                definition BLOB NOT NULL
+            )''')
+        self._conn.execute(f'CREATE INDEX IF NOT EXISTS {table}_next_run_time ON {table} (next_run_time)')
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(f'SELECT COUNT(*) FROM {self._table}').fetchone()[0]
+
+    @staticmethod
+    def _state_row(job):
+        state = job_state(job)
+        return (_to_timestamp(state['next_run_time']), int(bool(state['is_enable'])), state['fail_count'],
+                state['last_run_state'], _to_timestamp(state['last_runtime']))
+
+    def add_jobs(self, jobs):
+        rows = [(job.name, *self._state_row(job), dumps_definition(job)) for job in jobs]
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN')
+                self._conn.executemany(
+                    f'INSERT OR REPLACE INTO {self._table} (name, next_run_time, is_enable, fail_count, '
+                    f'last_run_state, last_runtime, definition) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def update_job_state(self, job):
+        with self._lock:
+            self._conn.execute(
+                f'UPDATE {self._table} SET next_run_time = ?, is_enable = ?, fail_count = ?, last_run_state = ?, '
+                f'last_runtime = ? WHERE name = ?', (*self._state_row(job), job.name))
+
+    def remove_job(self, name):
+        with self._lock:
+            return self._conn.execute(f'DELETE FROM {self._table} WHERE name = ?', (name,)).rowcount
+
+    def _record(self, row):
+        name, next_run_time, is_enable, fail_count, last_run_state, last_runtime, definition = row
+        return {
+            'name': name,
+            'next_run_time': _from_timestamp(next_run_time),
+            'is_enable': bool(is_enable),
+            'fail_count': fail_count,
+            'last_run_state': last_run_state,
+            'last_runtime': _from_timestamp(last_runtime),
+            'definition': loads_definition(definition),
+        }
+
+    def get_job(self, name):
+        with self._lock:
+            row = self._conn.execute(f'SELECT * FROM {self._table} WHERE name = ?', (name,)).fetchone()
+        return None if row is None else self._record(row)
+
+    def get_due_jobs(self, until):
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT * FROM {self._table} WHERE next_run_time <= ? AND is_enable = 1 ORDER BY next_run_time',
+                (_to_timestamp(until),)).fetchall()
+        return [self._record(row) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,261 @@
+# ------------------------------------------------------------------------------
+# Copyright 2021 Mohammad Reza Golsorkhi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+# name: limits.py
+# Description: concurrency limits and rate limits of runs per job, per agent and per resource tag
+# Version: 0.1.0
+# Author: Mohammad Reza Golsorkhi
+# ------------------------------------------------------------------------------
+
+
+import heapq
+import itertools
+import threading
+from time import monotonic
+
+from src.agent.exceptions import InvalidOption
+
+
+class ConcurrencyLimiter:
+    """
+    give slots to runs before they are submitted to worker pool
+    a run need a slot of its job (options['max_instances']), a slot of agent (max_concurrent_jobs) and a slot of
+    every tag of job that has a limit, a run that can not get all of them wait in a queue whitout a thread
+    and get them when a run finish, older waiting runs (or runs whit smaller key if prioritized) are served first
+    """
+
+    def __init__(self, max_concurrent_jobs=None, tag_limits=None, prioritized=False):
+        """
+        :param max_concurrent_jobs: max runs of all jobs at the same time, None for no limit
+        :param tag_limits: {tag: max runs of jobs whit that tag at the same time}
+        :param prioritized: waiting runs get slots by their key instead of arrival order
+        """
+        if max_concurrent_jobs is not None and (not isinstance(max_concurrent_jobs, int) or max_concurrent_jobs < 1):
+            raise InvalidOption('max_concurrent_jobs must be a int >= 1')
+        tag_limits = dict(tag_limits or {})
+        for tag, limit in tag_limits.items():
+            if not isinstance(limit, int) or limit < 1:
+                raise InvalidOption(f'limit of tag {tag} must be a int >= 1')
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self.tag_limits = tag_limits
+        self.prioritized = prioritized
+        self._lock = threading.Lock()
+        self.running = 0
+        self._tag_running = dict.fromkeys(tag_limits, 0)
+        # heap of (key, counter, run), key is 0 if not prioritized so runs are served in arrival order
+        self._waiting = []
+        self._counter = itertools.count()
+
+    @property
+    def waiting(self):
+        """
+        number of runs waiting for a slot
+        """
+        return len(self._waiting)
+
+    def tag_usage(self):
+        """
+        :return: {tag: (running, limit)}
+        """
+        with self._lock:
+            return {tag: (self._tag_running[tag], limit) for tag, limit in self.tag_limits.items()}
+
+    def _can_start(self, job):
+        if job._admitted >= job.max_instances:
+            return False
+        if self.max_concurrent_jobs is not None and self.running >= self.max_concurrent_jobs:
+            return False
+        for tag in job.tags:
+            limit = self.tag_limits.get(tag)
+            if limit is not None and self._tag_running[tag] >= limit:
+                return False
+        return True
+
+    def _take(self, job):
+        job._admitted += 1
+        self.running += 1
+        for tag in job.tags:
+            if tag in self._tag_running:
+                self._tag_running[tag] += 1
+
+    def admit(self, run):
+        """
+        take slots for run or put it in waiting queue
+        :return: True if run can be submitted now
+        """
+        job = run.job
+        with self._lock:
+            if self._can_start(job):
+                self._take(job)
+                return True
+            job._parked += 1
+            key = run.key if self.prioritized else 0
+            heapq.heappush(self._waiting, (key, next(self._counter), run))
+            return False
+
+    def defer(self, job):
+        """
+        count a run of job that wait for a rate limit token, it count for max_instances of job in dispatch
+        """
+        with self._lock:
+            job._deferred += 1
+
+    def undefer(self, job):
+        """
+        a deferred run is submitted or dropped
+        """
+        with self._lock:
+            job._deferred -= 1
+
+    def release(self, job):
+        """
+        give back slots of a finished run
+        :return: list of waiting runs that got slots and must be submitted
+        """
+        with self._lock:
+            job._admitted -= 1
+            self.running -= 1
+            for tag in job.tags:
+                if tag in self._tag_running:
+                    self._tag_running[tag] -= 1
+            ready, blocked = [], []
+            while self._waiting:
+                if self.max_concurrent_jobs is not None and self.running >= self.max_concurrent_jobs:
+                    break
+                item = heapq.heappop(self._waiting)
+                run = item[-1]
+                if self._can_start(run.job):
+                    self._take(run.job)
+                    run.job._parked -= 1
+                    ready.append(run)
+                else:
+                    # job or tag limit is full, run keep its place
+                    blocked.append(item)
+            for item in blocked:
+                heapq.heappush(self._waiting, item)
+            return ready
+
+    def cancel_waiting(self):
+        """
+        drop every waiting run
+        :return: list of dropped runs
+        """
+        with self._lock:
+            runs, self._waiting = [item[-1] for item in sorted(self._waiting)], []
+            for run in runs:
+                run.job._parked -= 1
+            return runs
+
+
+class TokenBucket:
+    """
+    token bucket of a job or a tag, a run take a token and a empty bucket go in debt
+    so a run that find no token is delayed until its token is refilled, never dropped
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: tokens (runs) per second
+        :param burst: max tokens, runs that can start at once after a quiet time
+        """
+        if not isinstance(rate, (int, float)) or rate <= 0:
+            raise InvalidOption('rate must be runs per second > 0')
+        if not isinstance(burst, int) or burst < 1:
+            raise InvalidOption('burst must be a int >= 1')
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = monotonic()
+        self.allowed = 0
+        self.throttled = 0
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reserve(self, now):
+        """
+        take a token, caller must hold the lock of RateLimits
+        :return: seconds until the token is there, 0 if run can start now
+        """
+        self._refill(now)
+        self._tokens -= 1
+        if self._tokens >= 0:
+            self.allowed += 1
+            return 0.0
+        self.throttled += 1
+        return -self._tokens / self.rate
+
+    def tokens(self, now=None):
+        """
+        :return: tokens that are available now, negative if runs wait for tokens
+        """
+        now = monotonic() if now is None else now
+        return min(self.burst, self._tokens + (now - self._last) * self.rate)
+
+    def stats(self):
+        return {'rate': self.rate, 'burst': self.burst, 'tokens': self.tokens(), 'allowed': self.allowed,
+                'throttled': self.throttled}
+
+
+def token_bucket(options):
+    """
+    :param options: {'rate': runs per second, 'burst': n} or None
+    :return: TokenBucket or None
+    """
+    if options is None:
+        return None
+    if not isinstance(options, dict):
+        raise InvalidOption("rate_limit must be a dict whit 'rate' and 'burst'")
+    return TokenBucket(options.get('rate'), options.get('burst', 1))
+
+
+class RateLimits:
+    """
+    token buckets of tags and jobs of a agent, a run take a token from its job bucket and every tag bucket
+    """
+
+    def __init__(self, tag_rate_limits=None):
+        """
+        :param tag_rate_limits: {tag: {'rate': runs per second, 'burst': n}}
+        """
+        self.tag_buckets = {tag: token_bucket(options) for tag, options in (tag_rate_limits or {}).items()}
+        self._lock = threading.Lock()
+
+    def reserve(self, job):
+        """
+        :return: seconds that run of job must wait for its tokens
+        """
+        bucket = job._rate_bucket
+        tag_buckets = self.tag_buckets
+        if bucket is None and not tag_buckets:
+            return 0.0
+        now = monotonic()
+        delay = 0.0
+        with self._lock:
+            if bucket is not None:
+                delay = bucket.reserve(now)
+            for tag in job.tags:
+                tag_bucket = tag_buckets.get(tag)
+                if tag_bucket is not None:
+                    delay = max(delay, tag_bucket.reserve(now))
+        return delay
+
+    def stats(self):
+        """
+        :return: {tag: stats of bucket}
+        """
+        with self._lock:
+            return {tag: bucket.stats() for tag, bucket in self.tag_buckets.items()}
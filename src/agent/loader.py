@@ -0,0 +1,243 @@
+# ------------------------------------------------------------------------------
+# Copyright 2021 Mohammad Reza Golsorkhi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+# name: loader.py
+# Description: parallel reader of job directories whit a manifest of unchanged files
+# Version: 0.1.0
+# Author: Mohammad Reza Golsorkhi
+# ------------------------------------------------------------------------------
+
+
+import fnmatch
+import hashlib
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import src.agent.serialization as serialization
+
+logger = logging.getLogger(__name__)
+
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class ManifestEntry:
+    __slots__ = ('size', 'mtime_ns', 'digest')
+
+    def __init__(self, size, mtime_ns, digest):
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.digest = digest
+
+
+class Manifest:
+    """
+    index of job files of a directory by file name whit (size, mtime, hash) of the last read
+    a file whit the same size and mtime is not read again, a file whit a new mtime but the same hash is unchanged
+    manifest only live in memory, it skip files whose jobs are loaded and a new process must decode every file
+    to build its jobs anyway
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def remove(self, name):
+        self.entries.pop(name, None)
+
+
+class LoadReport:
+    """
+    result of Agent.load_jobs
+    jobs: loaded jobs, errors: {path: exception} of files that could not be loaded,
+    read: number of files that are decoded, cached: number of unchanged files whose loaded job is kept
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self.errors = {}
+        self.read = 0
+        self.cached = 0
+
+    def __repr__(self):
+        return f'LoadReport jobs : {len(self.jobs)} errors : {len(self.errors)} read : {self.read} ' \
+               f'cached : {self.cached}'
+
+
+def scan(directory, pattern='*.job'):
+    """
+    :return: {file name: os.stat_result} of job files in directory
+    """
+    files = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if fnmatch.fnmatch(entry.name, pattern) and entry.is_file():
+                files[entry.name] = entry.stat()
+    return files
+
+
+def _read(path, stat, entry, known):
+    """
+    read a job file
+    :param known: job of file is loaded, a file whit the same hash as its manifest entry is not decoded
+    :return: (entry, data or None if file is unchanged and known)
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+    digest = _digest(data)
+    new_entry = ManifestEntry(len(data), stat.st_mtime_ns, digest)
+    if known and entry is not None and entry.digest == digest:
+        # only mtime is changed
+        return new_entry, None
+    return new_entry, data
+
+
+def _is_unchanged(entry, stat):
+    return entry is not None and entry.size == stat.st_size and entry.mtime_ns == stat.st_mtime_ns
+
+
+def read_specs(directory, names=None, manifest=None, workers=None, pattern='*.job', known=()):
+    """
+    read and decode job files, files that are changed since manifest are read and hashed in parallel
+    and then decoded one by one because decoding hold GIL
+    :param directory: job directory
+    :param names: {file name: os.stat_result} to read, default is every file that match pattern
+    :param manifest: Manifest that is used and updated
+    :param workers: number of reader threads, file reads and hashing release GIL
+    :param pattern: glob pattern of job files
+    :param known: file names whose jobs are loaded, they are skipped if they did not change
+    :return: (list of (path, spec) of decoded files ordered by file name, {path: exception}), paths are str
+    """
+    directory = str(directory)
+    if names is None:
+        names = scan(directory, pattern)
+    if manifest is None:
+        manifest = Manifest()
+    entries = manifest.entries
+
+    todo = [name for name in names if name not in known or not _is_unchanged(entries.get(name), names[name])]
+    read, errors = {}, {}
+    if todo:
+        if workers is None:
+            workers = min(32, (os.cpu_count() or 1) + 4)
+
+        def task(chunk):
+            results = []
+            for name in chunk:
+                try:
+                    results.append(_read(os.path.join(directory, name), names[name], entries.get(name),
+                                         name in known))
+                except Exception as E:
+                    results.append(E)
+            return results
+
+        # job files are small, a task per file cost more than reading it
+        size = max(1, min(256, len(todo) // max(workers, 1)))
+        chunks = [todo[i:i + size] for i in range(0, len(todo), size)]
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            for chunk, chunk_results in zip(chunks, pool.map(task, chunks)):
+                for name, result in zip(chunk, chunk_results):
+                    if isinstance(result, Exception):
+                        path = os.path.join(directory, name)
+                        logger.error(msg=f'failed to read job file {path}', exc_info=result)
+                        errors[path] = result
+                        manifest.remove(name)
+                        continue
+                    entry, data = result
+                    entries[name] = entry
+                    if data is not None:
+                        read[name] = data
+
+    results = []
+    for name in sorted(read):
+        path = os.path.join(directory, name)
+        try:
+            spec = serialization.loads_spec(read[name])
+        except Exception as E:
+            # entry is kept, a file whit no loaded job is decoded again on the next load
+            logger.error(msg=f'failed to read job file {path}', exc_info=True)
+            errors[path] = E
+            continue
+        results.append((path, spec))
+    return results, errors
+
+
+class DirectoryWatcher:
+    """
+    find new, changed and deleted job files of a directory
+    files are listed again only when mtime of directory change (a file is added, removed or replaced like
+    save_job do) or every full_scan_interval seconds to find files that are edited in place,
+    only new and changed files are read
+    """
+
+    # mtime of file systems can be coarse, a change in the same tick as the last scan keep the same mtime
+    # so mtimes that are this close to the last scan are not trusted
+    racy_ns = 1_000_000_000
+
+    def __init__(self, directory, pattern='*.job', full_scan_interval=60):
+        self.directory = str(directory)
+        self.pattern = pattern
+        self.full_scan_interval = full_scan_interval
+        self.manifest = Manifest()
+        self._dir_mtime_ns = None
+        self._scan_time_ns = 0
+        self._next_full_scan = 0
+
+    def poll(self, now):
+        """
+        :param now: monotonic time
+        :return: (added, changed, deleted, errors) added and changed are lists of (file name, spec),
+        deleted is a list of file names and errors is {path: exception}
+        """
+        dir_mtime_ns = os.stat(self.directory).st_mtime_ns
+        if dir_mtime_ns == self._dir_mtime_ns and now < self._next_full_scan and \
+                dir_mtime_ns < self._scan_time_ns - self.racy_ns:
+            return [], [], [], {}
+        scan_time_ns = time.time_ns()
+        self._dir_mtime_ns = dir_mtime_ns
+        if now >= self._next_full_scan:
+            self._next_full_scan = now + self.full_scan_interval
+
+        entries = self.manifest.entries
+        names = scan(self.directory, self.pattern)
+        deleted = [name for name in entries if name not in names]
+        for name in deleted:
+            del entries[name]
+        racy = self._scan_time_ns - self.racy_ns
+        self._scan_time_ns = scan_time_ns
+        candidates = {name: stat for name, stat in names.items()
+                      if not _is_unchanged(entries.get(name), stat) or stat.st_mtime_ns >= racy}
+        for name, stat in candidates.items():
+            entry = entries.get(name)
+            if entry is not None:
+                # hash decide if file is changed
+                entry.mtime_ns = None
+        if not candidates:
+            return [], [], deleted, {}
+        known = {name for name in candidates if name in entries}
+        results, errors = read_specs(self.directory, candidates, self.manifest, workers=1, known=known)
+        added, changed = [], []
+        for path, spec in results:
+            name = os.path.basename(path)
+            if name not in known:
+                added.append((name, spec))
+            else:
+                changed.append((name, spec))
+        return added, changed, deleted, errors
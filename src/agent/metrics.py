@@ -0,0 +1,329 @@
+# ------------------------------------------------------------------------------
+# Copyright 2021 Mohammad Reza Golsorkhi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+# name: metrics.py
+# Description: counters, gauges and histograms of agent whit prometheus text format and http listener
+# Version: 0.1.0
+# Author: Mohammad Reza Golsorkhi
+# ------------------------------------------------------------------------------
+
+
+import logging
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _CounterValue:
+    __slots__ = ('_lock', 'value')
+
+    def __init__(self):
+        # a lock that is not contended cost less than a dict lookup
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def get(self):
+        return self.value
+
+
+class _GaugeValue:
+    __slots__ = ('value', '_function')
+
+    def __init__(self):
+        self.value = 0.0
+        self._function = None
+
+    def set(self, value):
+        # a float assignment is atomic
+        self.value = value
+
+    def set_function(self, function):
+        """
+        value is read from function when metrics are collected
+        """
+        self._function = function
+
+    def get(self):
+        return self._function() if self._function is not None else self.value
+
+
+class _HistogramValue:
+    __slots__ = ('_lock', '_bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self._lock = threading.Lock()
+        self._bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect_left(self._bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def get(self):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        buckets, cumulative = {}, 0
+        for bound, n in zip(self._bounds + (float('inf'),), counts):
+            cumulative += n
+            buckets[bound] = cumulative
+        return {'count': count, 'sum': total, 'buckets': buckets}
+
+
+class Metric:
+    """
+    a metric whit optional labels, metrics whitout labels can be updated directly
+    """
+    type: Optional[str] = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """
+        :return: child metric of label values, it can be kept to skip the lookup
+        """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f'{self.name} has labels {self.labelnames}')
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def remove(self, *values):
+        with self._lock:
+            self._children.pop(values, None)
+
+    def collect(self):
+        """
+        :return: list of (labels dict, value)
+        """
+        with self._lock:
+            children = list(self._children.items())
+        return [(dict(zip(self.labelnames, values)), child.get()) for values, child in children]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def _new_child(self):
+        return _GaugeValue()
+
+    def set(self, value):
+        self._children[()].set(value)
+
+    def set_function(self, function):
+        self._children[()].set_function(function)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(float(b) for b in buckets if b != float('inf')))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._children[()].observe(value)
+
+
+class MetricsRegistry:
+    """
+    metrics by name, exposition give them in prometheus text format and snapshot as a dict
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'metric {metric.name} already exist')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._add(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def snapshot(self):
+        """
+        :return: {metric name: list of (labels dict, value)}, value of histograms is dict whit count, sum and
+        cumulative buckets
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.collect() for metric in metrics}
+
+    def exposition(self):
+        """
+        :return: str in prometheus text format 0.0.4
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {_escape(metric.documentation)}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for labels, value in metric.collect():
+                if metric.type == 'histogram':
+                    for bound, count in value['buckets'].items():
+                        lines.append(f'{metric.name}_bucket{_labels({**labels, "le": _format_value(bound)})} '
+                                     f'{count}')
+                    lines.append(f'{metric.name}_sum{_labels(labels)} {_format_value(value["sum"])}')
+                    lines.append(f'{metric.name}_count{_labels(labels)} {value["count"]}')
+                else:
+                    lines.append(f'{metric.name}{_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + '}'
+
+
+def start_http_server(registry, port, address='127.0.0.1'):
+    """
+    serve exposition of registry on http://address:port/ in a daemon thread
+    :return: server, call server.shutdown() to stop it
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.exposition().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(msg=format % args)
+
+    server = ThreadingHTTPServer((address, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name=f'metrics {address}:{port}').start()
+    return server
+
+
+class AgentMetrics(MetricsRegistry):
+    """
+    metrics of a agent
+    """
+
+    def __init__(self, agent, buckets=DEFAULT_BUCKETS):
+        super().__init__()
+        self.dispatch_lag = self.histogram('agent_dispatch_lag_seconds',
+                                           'seconds that runs started after their next_run_time', buckets=buckets)
+        self.start_lag = self.histogram('agent_start_lag_seconds', 'seconds from due time of runs to their start',
+                                        ('priority',), buckets)
+        self.job_duration = self.histogram('agent_job_duration_seconds', 'run duration of jobs', ('job',), buckets)
+        self.tag_duration = self.histogram('agent_tag_duration_seconds', 'run duration of jobs by tag', ('tag',),
+                                           buckets)
+        self.runs = self.counter('agent_job_runs_total', 'finished runs of jobs', ('job', 'outcome'))
+        self.misfires = self.counter('agent_job_misfires_total', 'runs that are skipped by misfire_grace_time',
+                                     ('job',))
+        self.throttled = self.counter('agent_throttled_runs_total', 'runs that are delayed by rate limits', ('job',))
+        self.tag_tokens = self.gauge('agent_tag_rate_limit_tokens', 'tokens in rate limit bucket of tags', ('tag',))
+        for tag, bucket in agent._rate_limits.tag_buckets.items():
+            self.tag_tokens.labels(tag).set_function(bucket.tokens)
+        self.running_jobs = self.gauge('agent_running_jobs', 'jobs that are running')
+        self.running_jobs.set_function(lambda: len(agent.get_all_running_jobs()))
+        self.queued_runs = self.gauge('agent_queued_runs', 'runs that wait for a worker')
+        self.queued_runs.set_function(lambda: agent._executor.qsize)
+        self.waiting_runs = self.gauge('agent_waiting_runs', 'runs that wait for a concurrency slot')
+        self.waiting_runs.set_function(lambda: agent._limiter.waiting)
+        self.scheduled_jobs = self.gauge('agent_scheduled_jobs', 'jobs in timer queue')
+        self.scheduled_jobs.set_function(agent._scheduled_count)
+        self.loop_seconds = self.gauge('agent_loop_iteration_seconds', 'seconds of the last scheduler loop work')
+
+    def observe_run(self, job, duration, failed):
+        self.job_duration.labels(job._name).observe(duration)
+        for tag in job.tags:
+            self.tag_duration.labels(tag).observe(duration)
+        self.runs.labels(job._name, 'failed' if failed else 'success').inc()
+
+    def observe_misfire(self, job):
+        self.misfires.labels(job._name).inc()
+
+    def forget_job(self, name):
+        """
+        remove series of a job that is removed from agent
+        """
+        self.job_duration.remove(name)
+        self.runs.remove(name, 'success')
+        self.runs.remove(name, 'failed')
+        self.misfires.remove(name)
+        self.throttled.remove(name)
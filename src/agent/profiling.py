@@ -0,0 +1,183 @@
+# ------------------------------------------------------------------------------
+# Copyright 2021 Mohammad Reza Golsorkhi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+# name: profiling.py
+# Description: cProfile and tracemalloc sampling of job runs whit aggregated reports
+# Version: 0.1.0
+# Author: Mohammad Reza Golsorkhi
+# ------------------------------------------------------------------------------
+
+
+import cProfile
+import logging
+import pstats
+import threading
+import tracemalloc
+from pathlib import Path
+
+from src.agent.exceptions import InvalidOption
+
+logger = logging.getLogger(__name__)
+
+# only one cProfile can be active at a time in newer pythons, a run that can not get it is not sampled
+_cprofile_lock = threading.Lock()
+
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+_tracemalloc_started = False
+
+
+def _start_tracemalloc(frames):
+    global _tracemalloc_users, _tracemalloc_started
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            _tracemalloc_started = True
+        _tracemalloc_users += 1
+
+
+def _stop_tracemalloc():
+    global _tracemalloc_users, _tracemalloc_started
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        # tracing that is started by user is not stopped
+        if _tracemalloc_users == 0 and _tracemalloc_started:
+            tracemalloc.stop()
+            _tracemalloc_started = False
+
+
+class RunProfiler:
+    """
+    profile 1 in every runs of a job and aggregate the results
+    options is options['profile'] of job:
+    'every' sample 1 in every runs (default 1), 'cprofile' (default True), 'tracemalloc' (default False),
+    'frames' of tracemalloc tracebacks (default 1) and 'dump_dir' that pstats of each sampled run is written to
+    runs of a job whit max_instances > 1 can be profiled at the same time so counters and results are locked
+    """
+
+    def __init__(self, name, options):
+        if not isinstance(options, dict):
+            raise InvalidOption('profile must be a dict')
+        self.name = name
+        self.every = options.get('every', 1)
+        if not isinstance(self.every, int) or self.every < 1:
+            raise InvalidOption('profile every must be a int >= 1')
+        self.cprofile = options.get('cprofile', True)
+        self.tracemalloc = options.get('tracemalloc', False)
+        self.frames = options.get('frames', 1)
+        self.dump_dir = None if options.get('dump_dir') is None else Path(options['dump_dir'])
+        self.runs = 0
+        self.sampled = 0
+        self._stats = None
+        # traceback: [size diff, count diff]
+        self._allocations = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def call(self, func, args, kwargs):
+        """
+        call func(*args, **kwargs) and profile it if this run is sampled
+        """
+        with self._lock:
+            self.runs += 1
+            run = self.runs
+        if (run - 1) % self.every:
+            return func(*args, **kwargs)
+        profile = None
+        if self.cprofile and _cprofile_lock.acquire(blocking=False):
+            profile = cProfile.Profile()
+        before = None
+        if self.tracemalloc:
+            _start_tracemalloc(self.frames)
+            before = tracemalloc.take_snapshot()
+        try:
+            if profile is not None:
+                profile.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if profile is not None:
+                    profile.disable()
+        finally:
+            if profile is not None:
+                _cprofile_lock.release()
+            try:
+                self._collect(profile, before, run)
+            except Exception:
+                logger.error(msg=f'failed to collect profile of job {self.name}', exc_info=True)
+
+    def _collect(self, profile, before, run):
+        if profile is None and before is None:
+            return
+        diffs = []
+        if before is not None:
+            try:
+                after = tracemalloc.take_snapshot()
+            finally:
+                _stop_tracemalloc()
+            diffs = [diff for diff in after.compare_to(before, 'traceback') if diff.size_diff or diff.count_diff]
+        if profile is not None:
+            profile.create_stats()
+            if self.dump_dir is not None:
+                self.dump_dir.mkdir(parents=True, exist_ok=True)
+                profile.dump_stats(self.dump_dir / f'{self.name}-{run}.pstats')
+        with self._lock:
+            self.sampled += 1
+            if profile is not None:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+            for diff in diffs:
+                site = self._allocations.setdefault(str(diff.traceback), [0, 0])
+                site[0] += diff.size_diff
+                site[1] += diff.count_diff
+
+    def dump(self, path):
+        """
+        write aggregated pstats of all sampled runs, it can be read whit pstats.Stats(path)
+        """
+        with self._lock:
+            if self._stats is None:
+                raise ValueError(f'job {self.name} has no cProfile sample')
+            self._stats.dump_stats(str(path))
+
+    def report(self, top=20):
+        """
+        :return: dict whit runs, sampled runs, top functions by cumulative time
+        [(function, calls, total time, cumulative time)] and top allocation sites by growth [(site, bytes, count)]
+        """
+        with self._lock:
+            runs, sampled = self.runs, self.sampled
+            rows = [] if self._stats is None else list(self._stats.stats.items())
+            allocations = [(site, size, count) for site, (size, count) in self._allocations.items()]
+        rows = sorted(rows, key=lambda item: item[1][3], reverse=True)[:top]
+        functions = [(f'{file}:{line}({func})', calls, total, cumulative)
+                     for (file, line, func), (_, calls, total, cumulative, _) in rows]
+        allocations = sorted(allocations, key=lambda row: row[1], reverse=True)[:top]
+        return {
+            'runs': runs,
+            'sampled': sampled,
+            'functions': functions,
+            'allocations': allocations,
+        }
@@ -0,0 +1,177 @@
+# ------------------------------------------------------------------------------
+# Copyright 2021 Mohammad Reza Golsorkhi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+# name: registry.py
+# Description: container of agent jobs whit index by name and id
+# Version: 0.1.0
+# Author: Mohammad Reza Golsorkhi
+# ------------------------------------------------------------------------------
+
+
+import threading
+
+from src.agent.exceptions import DuplicateName
+
+
+class JobRegistry:
+    """
+    list like container of jobs of a agent
+    keep hash index by name and id so lookups cost O(1)
+    all methods are thread safe, iteration is over a snapshot
+    """
+
+    def __init__(self, jobs=()):
+        self.lock = threading.RLock()
+        # dict keep insertion order and remove in O(1)
+        self._jobs = {}
+        self._by_name = {}
+        self._by_id = {}
+        self.extend(jobs)
+
+    def __repr__(self):
+        return f'JobRegistry({list(self)})'
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self._jobs))
+
+    def __contains__(self, job):
+        return job in self._jobs
+
+    def __getitem__(self, index):
+        with self.lock:
+            return list(self._jobs)[index]
+
+    def append(self, job):
+        """
+        add job to registry
+        :param job: a instance of job
+        :return: None
+        :raise: DuplicateName if another job whit same name exist
+        """
+        with self.lock:
+            self._check_name(job, job._name)
+            self._jobs[job] = None
+            self._by_name[job._name] = job
+            self._by_id[job._id] = job
+
+    def extend(self, jobs):
+        """
+        add jobs to registry, if a name is duplicate no job is added
+        :param jobs: iterable of jobs
+        :return: None
+        :raise: DuplicateName
+        """
+        jobs = list(jobs)
+        with self.lock:
+            names = set()
+            for job in jobs:
+                if job._name in names:
+                    raise DuplicateName(f'job name must be unique {job._name} already exist')
+                self._check_name(job, job._name)
+                names.add(job._name)
+            for job in jobs:
+                self._jobs[job] = None
+                self._by_name[job._name] = job
+                self._by_id[job._id] = job
+
+    def remove(self, job):
+        """
+        remove job from registry
+        :param job: a instance of job
+        :return: None
+        :raise: ValueError if job is not in registry
+        """
+        with self.lock:
+            if job not in self._jobs:
+                raise ValueError(f'job {job._name} is not in registry')
+            del self._jobs[job]
+            self._unindex(job)
+
+    def replace(self, old, new):
+        """
+        put new job in place of old job in one step, a lookup by name never miss the job
+        :param old: a job in registry
+        :param new: a job whit the same name or a name that is free
+        :return: None
+        :raise: ValueError if old is not in registry, DuplicateName if name of new is taken by another job
+        """
+        with self.lock:
+            if old not in self._jobs:
+                raise ValueError(f'job {old._name} is not in registry')
+            other = self._by_name.get(new._name)
+            if other is not None and other is not old and other is not new:
+                raise DuplicateName(f'job name must be unique {new._name} already exist')
+            del self._jobs[old]
+            self._jobs[new] = None
+            self._unindex(old)
+            self._by_name[new._name] = new
+            self._by_id[new._id] = new
+
+    def _unindex(self, job):
+        """
+        remove job from name and id index, an index entry of another job whit the same key is kept
+        """
+        name, job_id = job._name, job._id
+        if self._by_name.get(name) is job:
+            del self._by_name[name]
+        if self._by_id.get(job_id) is job:
+            del self._by_id[job_id]
+
+    def rename(self, job, name):
+        """
+        change name of job and update index
+        :param job: a instance of job
+        :param name: new name
+        :return: None
+        :raise: NameError if another job whit same name exist
+        """
+        with self.lock:
+            other = self._by_name.get(name)
+            if other is not None and other is not job:
+                raise NameError('name in agent must be unique {} already exist'.format(name))
+            if job in self._jobs:
+                old_name = job._name
+                if self._by_name.get(old_name) is job:
+                    del self._by_name[old_name]
+                self._by_name[name] = job
+            job._name = name
+
+    def get_by_name(self, name):
+        return self._by_name.get(name)
+
+    def get_by_id(self, job_id):
+        return self._by_id.get(job_id)
+
+    def unique_name(self, name, reserved=()):
+        """
+        :param reserved: names that are not in registry but are taken too
+        :return: name or name whit the first free ' (n)' suffix
+        """
+        with self.lock:
+            if name not in self._by_name and name not in reserved:
+                return name
+            counter = 1
+            while f'{name} ({counter})' in self._by_name or f'{name} ({counter})' in reserved:
+                counter += 1
+            return f'{name} ({counter})'
+
+    def _check_name(self, job, name):
+        other = self._by_name.get(name)
+        if other is not None and other is not job:
+            raise DuplicateName(f'job name must be unique {name} already exist')
@@ -0,0 +1,441 @@
+# ------------------------------------------------------------------------------
+# Copyright 2021 Mohammad Reza Golsorkhi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+# name: scheduler.py
+# Description: timer queues that tell the agent thread which job is due
+# Version: 0.1.0
+# Author: Mohammad Reza Golsorkhi
+# ------------------------------------------------------------------------------
+
+
+import datetime
+import heapq
+import itertools
+import math
+import threading
+from time import monotonic
+from typing import Any, Dict, List
+
+from src.agent.exceptions import InvalidOption
+
+try:
+    import numpy
+except ImportError:
+    # vectorized backend is optional
+    numpy = None  # type: ignore[assignment]
+
+
+def job_deadline(job):
+    """
+    convert job.next_run_time to a point on the monotonic clock
+    jobs that are planned on the monotonic clock (interval jobs) use their planned_deadline
+    :param job: a instance of job
+    :return: float or None if job has no next_run_time
+    """
+    planned = getattr(job, 'planned_deadline', None)
+    if planned is not None:
+        return planned
+    if job.next_run_time is None:
+        return None
+    return monotonic() + (job.next_run_time - datetime.datetime.now()).total_seconds()
+
+
+class BaseScheduler:
+    """
+    BaseScheduler is a Interface do not use it
+    a scheduler hold jobs until their next_run_time and let agent thread sleep until then
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._notified = False
+        # deadline that the waiting thread sleep until, None when nobody is waiting
+        self._wake_at = None
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def schedule(self, job, deadline=None):
+        """
+        add job to queue or move it if it is already in queue
+        :param job: a instance of job
+        :param deadline: monotonic time to wake up for job default is job.next_run_time
+        :return: None
+        """
+        raise NotImplementedError
+
+    def cancel(self, job):
+        """
+        remove job from queue
+        :param job: a instance of job
+        :return: None
+        """
+        raise NotImplementedError
+
+    def pop_due(self, now=None):
+        """
+        remove and return every job that its deadline is passed
+        :param now: monotonic time default is now
+        :return: list of jobs
+        """
+        raise NotImplementedError
+
+    def next_deadline(self):
+        """
+        :return: the earliest time agent must wake up or None if queue is empty
+        """
+        with self._condition:
+            return self._next_deadline()
+
+    def _next_deadline(self):
+        raise NotImplementedError
+
+    def notify(self):
+        """
+        wake up the thread that is waiting in wait
+        :return: None
+        """
+        with self._condition:
+            self._notify()
+
+    def _notify(self):
+        self._notified = True
+        self._condition.notify_all()
+
+    def _notify_if_earlier(self, deadline):
+        if self._wake_at is not None and deadline < self._wake_at:
+            self._condition.notify_all()
+
+    def wait(self, timeout=None):
+        """
+        block until the earliest deadline, notify or timeout
+        :param timeout: max seconds to wait default is no limit
+        :return: None
+        """
+        with self._condition:
+            if not self._notified:
+                deadline = self._next_deadline()
+                if deadline is not None:
+                    delay = max(deadline - monotonic(), 0)
+                    timeout = delay if timeout is None else min(timeout, delay)
+                if timeout is None or timeout > 0:
+                    self._wake_at = math.inf if timeout is None else monotonic() + timeout
+                    self._condition.wait(timeout)
+                    self._wake_at = None
+            self._notified = False
+
+
+class HeapScheduler(BaseScheduler):
+    """
+    keep jobs in a heap ordered by next_run_time
+    schedule, cancel and pop cost O(log n)
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def schedule(self, job, deadline=None):
+        if deadline is None:
+            deadline = job_deadline(job)
+        with self._condition:
+            self._remove(job)
+            if deadline is None:
+                return
+            entry = [deadline, next(self._counter), job]
+            self._entries[job] = entry
+            heapq.heappush(self._heap, entry)
+            self._notify_if_earlier(deadline)
+
+    def cancel(self, job):
+        with self._condition:
+            self._remove(job)
+
+    def _remove(self, job):
+        entry = self._entries.pop(job, None)
+        if entry is not None:
+            # removed entries stay in heap and are skipped when they reach the top
+            entry[-1] = None
+
+    def pop_due(self, now=None):
+        if now is None:
+            now = monotonic()
+        due = []
+        with self._condition:
+            while self._heap and self._heap[0][0] <= now:
+                job = heapq.heappop(self._heap)[-1]
+                if job is not None:
+                    del self._entries[job]
+                    due.append(job)
+        return due
+
+    def _next_deadline(self):
+        while self._heap and self._heap[0][-1] is None:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+
+class TimingWheelScheduler(BaseScheduler):
+    """
+    hierarchical timing wheel
+    time is cut in ticks of `tick` seconds, level 0 has one slot per tick and every upper level
+    has one slot per full turn of the level below it, jobs further than all levels wait in overflow
+    buckets, one bucket for each turn of the top level
+    schedule and cancel cost O(1), a job can run up to one tick late
+    """
+
+    def __init__(self, tick=0.01, wheel_size=256, levels=4):
+        super().__init__()
+        if tick <= 0:
+            raise InvalidOption('tick must be greater than 0')
+        if wheel_size < 2 or wheel_size & (wheel_size - 1):
+            raise InvalidOption('wheel_size must be a power of 2')
+        if levels < 1:
+            raise InvalidOption('levels must be at least 1')
+        self._tick = tick
+        self._bits = wheel_size.bit_length() - 1
+        self._mask = wheel_size - 1
+        self._levels = levels
+        # bucket is {job: tick}
+        self._wheels: List[List[Dict[Any, int]]] = [[{} for _ in range(wheel_size)] for _ in range(levels)]
+        self._level_counts = [0] * levels
+        self._overflow = {}
+        self._entries = {}
+        # every tick <= _current is already processed
+        self._current = math.floor(monotonic() / tick)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def schedule(self, job, deadline=None):
+        if deadline is None:
+            deadline = job_deadline(job)
+        with self._condition:
+            self._remove(job)
+            if deadline is None:
+                return
+            if not self._entries:
+                # nothing is waiting so there is nothing to cascade, skip the idle time
+                self._current = max(self._current, math.floor(monotonic() / self._tick))
+            self._insert(job, max(math.ceil(deadline / self._tick), self._current + 1))
+            self._notify_if_earlier(deadline)
+
+    def cancel(self, job):
+        with self._condition:
+            self._remove(job)
+
+    def _insert(self, job, tick):
+        # the lowest level whose turn contain both tick and _current, found from the highest differing bit
+        level = max((tick ^ self._current).bit_length() - 1, 0) // self._bits
+        if level < self._levels:
+            bucket = self._wheels[level][(tick >> (self._bits * level)) & self._mask]
+            self._level_counts[level] += 1
+        else:
+            level = self._levels
+            bucket = self._overflow.setdefault(tick >> (self._bits * self._levels), {})
+        bucket[job] = tick
+        self._entries[job] = (level, bucket)
+
+    def _remove(self, job):
+        entry = self._entries.pop(job, None)
+        if entry is not None:
+            level, bucket = entry
+            del bucket[job]
+            if level < self._levels:
+                self._level_counts[level] -= 1
+
+    def _reinsert(self, bucket, level):
+        if level < self._levels:
+            self._level_counts[level] -= len(bucket)
+        for job, tick in list(bucket.items()):
+            del self._entries[job]
+            self._insert(job, tick)
+        bucket.clear()
+
+    def pop_due(self, now=None):
+        if now is None:
+            now = monotonic()
+        target = math.floor(now / self._tick)
+        due = []
+        with self._condition:
+            while self._current < target:
+                if not self._entries:
+                    self._current = target
+                    break
+                self._current = self._skip_empty(target) + 1
+                self._cascade()
+                bucket = self._wheels[0][self._current & self._mask]
+                if bucket:
+                    due.extend(bucket)
+                    for job in bucket:
+                        del self._entries[job]
+                    self._level_counts[0] -= len(bucket)
+                    bucket.clear()
+        return due
+
+    def _skip_empty(self, target):
+        """
+        when lower levels are empty jump to the tick before the next cascade of the first non empty level
+        """
+        current = self._current
+        for level in range(self._levels):
+            if self._level_counts[level]:
+                break
+            shift = self._bits * (level + 1)
+            current = max(current, min(target, ((current >> shift) + 1) << shift) - 1)
+        return current
+
+    def _cascade(self):
+        """
+        move jobs from upper levels to lower ones when the lower level start a new turn
+        """
+        for level in range(self._levels, 0, -1):
+            shift = self._bits * level
+            if self._current & ((1 << shift) - 1):
+                continue
+            if level == self._levels:
+                bucket = self._overflow.pop(self._current >> shift, None)
+                if bucket:
+                    self._reinsert(bucket, level)
+            else:
+                bucket = self._wheels[level][(self._current >> shift) & self._mask]
+                if bucket:
+                    self._reinsert(bucket, level)
+
+    def _next_deadline(self):
+        """
+        earliest filled slot of level 0 or the next cascade, agent wake up there and ask again
+        """
+        if not self._entries:
+            return None
+        if self._level_counts[0]:
+            for tick in range(self._current + 1, ((self._current >> self._bits) + 1) << self._bits):
+                if self._wheels[0][tick & self._mask]:
+                    return tick * self._tick
+        for level in range(1, self._levels + 1):
+            if level == self._levels or self._level_counts[level]:
+                break
+        shift = self._bits * level
+        return (((self._current >> shift) + 1) << shift) * self._tick
+
+
+class VectorizedScheduler(BaseScheduler):
+    """
+    schedule table of parallel numpy arrays, one row per job
+    deadline, enabled and running of all jobs are checked whit one vectorized mask in pop_due
+    a popped job is marked running, the row is free again for dispatch when the job schedule itself whit its
+    next deadline, next deadlines are planned by each job (misfire and run_late rules) and not in bulk
+    jobs are found from their row whit _jobs and rows from jobs whit _rows
+    needs numpy
+    """
+
+    def __init__(self, capacity=1024):
+        super().__init__()
+        if numpy is None:
+            raise InvalidOption('vectorized scheduler backend needs numpy, pip install numpy')
+        if capacity <= 0:
+            raise InvalidOption('capacity must be greater than 0')
+        self._deadlines = numpy.full(capacity, math.inf)
+        self._enabled = numpy.zeros(capacity, dtype=bool)
+        self._running = numpy.zeros(capacity, dtype=bool)
+        self._jobs = [None] * capacity
+        self._rows = {}
+        self._free = list(range(capacity - 1, -1, -1))
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _grow(self):
+        capacity = len(self._jobs)
+        self._deadlines = numpy.concatenate((self._deadlines, numpy.full(capacity, math.inf)))
+        self._enabled = numpy.concatenate((self._enabled, numpy.zeros(capacity, dtype=bool)))
+        self._running = numpy.concatenate((self._running, numpy.zeros(capacity, dtype=bool)))
+        self._jobs.extend([None] * capacity)
+        self._free.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+    def schedule(self, job, deadline=None):
+        if deadline is None:
+            deadline = job_deadline(job)
+        with self._condition:
+            if deadline is None:
+                self._remove(job)
+                return
+            row = self._rows.get(job)
+            if row is None:
+                if not self._free:
+                    self._grow()
+                row = self._free.pop()
+                self._rows[job] = row
+                self._jobs[row] = job
+                self._enabled[row] = True
+            self._deadlines[row] = deadline
+            self._running[row] = False
+            self._notify_if_earlier(deadline)
+
+    def cancel(self, job):
+        with self._condition:
+            self._remove(job)
+
+    def _remove(self, job):
+        row = self._rows.pop(job, None)
+        if row is not None:
+            self._jobs[row] = None
+            self._enabled[row] = False
+            self._running[row] = False
+            self._deadlines[row] = math.inf
+            self._free.append(row)
+
+    def pop_due(self, now=None):
+        if now is None:
+            now = monotonic()
+        with self._condition:
+            rows = numpy.flatnonzero(self._enabled & ~self._running & (self._deadlines <= now))
+            if not rows.size:
+                return []
+            self._running[rows] = True
+            jobs = self._jobs
+            return [jobs[row] for row in rows.tolist()]
+
+    def _next_deadline(self):
+        if not self._rows:
+            return None
+        waiting = self._deadlines[self._enabled & ~self._running]
+        return float(waiting.min()) if waiting.size else None
+
+
+def create_scheduler(options=None):
+    """
+    build a scheduler backend for agent
+    :param options: dict whit 'backend' that is 'heap', 'timing_wheel' or 'vectorized', timing_wheel also accept
+    'tick', 'wheel_size' and 'levels', vectorized accept 'capacity'
+    :return: a instance of BaseScheduler
+    """
+    if options is None:
+        options = {}
+    backend = options.get('backend', 'heap')
+    if backend == 'heap':
+        return HeapScheduler()
+    elif backend == 'timing_wheel':
+        return TimingWheelScheduler(tick=options.get('tick', 0.01), wheel_size=options.get('wheel_size', 256),
+                                    levels=options.get('levels', 4))
+    elif backend == 'vectorized':
+        return VectorizedScheduler(capacity=options.get('capacity', 1024))
+    else:
+        raise InvalidOption(f'unknown scheduler backend {backend}')
@@ -0,0 +1,219 @@
+# ------------------------------------------------------------------------------
+# Copyright 2021 Mohammad Reza Golsorkhi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+# name: serialization.py
+# Description: compact versioned job spec format for save_job, dumps_job and job stores
+# Version: 0.1.0
+# Author: Mohammad Reza Golsorkhi
+# ------------------------------------------------------------------------------
+"""
+a job spec hold only what is needed to build a job again
+
+    {'format': 'agent.job', 'version': 1, 'name': ...,
+     'definition': {'class': 'module:qualname', 'func': 'module:qualname' or None,
+                    'args': (...), 'kwargs': {...}, 'options': {...}},
+     'state': {'next_run_time', 'is_enable', 'fail_count', 'last_run_state', 'last_runtime'}}
+
+function and job class are saved as import path, the spec is pickled and values that pickle can not
+save by reference (lambda, closure, ...) are saved whit dill one by one
+"""
+
+import importlib
+import pickle
+
+from src.agent.exceptions import SerializationError
+from src.agent.job import Job, LastRuntimeState
+
+try:
+    import dill
+except ImportError:
+    dill = None
+
+# dill save lambdas, closures and old job files
+dill_available = dill is not None
+
+FORMAT = 'agent.job'
+VERSION = 1
+
+
+class _DillValue:
+    """
+    a value that pickle can not save, it is written whit dill and read back whit dill.loads
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def __reduce__(self):
+        return dill.loads, (dill.dumps(self.value),)
+
+
+def _encode_value(value, protocol=None):
+    try:
+        pickle.dumps(value, protocol=protocol)
+    except (pickle.PicklingError, TypeError, AttributeError) as E:
+        if dill is None:
+            raise SerializationError(f'{value!r} can not be saved by reference and dill is not installed') from E
+        return _DillValue(value)
+    return value
+
+
+def import_path(obj):
+    """
+    :return: 'module:qualname' of obj or None if obj can not be imported by that path
+    """
+    module, qualname = getattr(obj, '__module__', None), getattr(obj, '__qualname__', None)
+    if not module or not qualname or '<' in qualname:
+        return None
+    try:
+        if resolve(f'{module}:{qualname}') is not obj:
+            return None
+    except (ImportError, AttributeError):
+        return None
+    return f'{module}:{qualname}'
+
+
+def resolve(path):
+    """
+    :param path: 'module:qualname'
+    :return: the object
+    """
+    module, _, qualname = path.partition(':')
+    obj = importlib.import_module(module)
+    for attr in qualname.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+
+def _encode_ref(obj, protocol=None):
+    if obj is None:
+        return None
+    path = import_path(obj)
+    if path is not None:
+        return path
+    return _encode_value(obj, protocol)
+
+
+def _decode_ref(ref):
+    if isinstance(ref, str):
+        try:
+            return resolve(ref)
+        except (ImportError, AttributeError) as E:
+            raise SerializationError(f'can not import {ref}') from E
+    return ref
+
+
+def job_definition(job):
+    """
+    what is needed to build job again
+    job and agent that FunctionJob pass to its function are not part of definition
+    :param job: a instance of job
+    :return: dict
+    """
+    kwargs = {k: v for k, v in job._kwargs.items() if v is not job and v is not job._agent}
+    return {
+        'class': type(job),
+        'func': getattr(job, '_func', None),
+        'args': tuple(job._args),
+        'kwargs': kwargs,
+        'options': job.options,
+    }
+
+
+def job_state(job):
+    """
+    runtime state of job that change after every run
+    :param job: a instance of job
+    :return: dict
+    """
+    return {
+        'next_run_time': job.next_run_time,
+        'is_enable': job.is_enable,
+        'fail_count': job.fail_count,
+        'last_run_state': job.status['LastRunState'].name,
+        'last_runtime': job.status['LastRuntime'],
+    }
+
+
+def restore_job_state(job, state):
+    """
+    put state that is read from a spec or a job store back in a new job
+    """
+    job._fail_count = state['fail_count']
+    job.status['LastRunState'] = LastRuntimeState[state['last_run_state']]
+    job.status['LastRuntime'] = state['last_runtime']
+    job.update_status()
+    job.next_run_time = state['next_run_time']
+
+
+def encode_definition(definition, protocol=None):
+    return {
+        'class': _encode_ref(definition['class'], protocol),
+        'func': _encode_ref(definition['func'], protocol),
+        'args': tuple(_encode_value(v, protocol) for v in definition['args']),
+        'kwargs': {k: _encode_value(v, protocol) for k, v in definition['kwargs'].items()},
+        'options': {k: _encode_value(v, protocol) for k, v in definition['options'].items()},
+    }
+
+
+def decode_definition(definition):
+    return {**definition, 'class': _decode_ref(definition['class']), 'func': _decode_ref(definition['func'])}
+
+
+def dumps_definition(job, protocol=None):
+    return pickle.dumps(encode_definition(job_definition(job), protocol), protocol=protocol)
+
+
+def loads_definition(data):
+    return decode_definition(pickle.loads(data))
+
+
+def dumps_spec(job, protocol=None):
+    """
+    :param job: a instance of job
+    :param protocol: pickle protocol
+    :return: bytes
+    """
+    return pickle.dumps({
+        'format': FORMAT,
+        'version': VERSION,
+        'name': job.name,
+        'definition': encode_definition(job_definition(job), protocol),
+        'state': job_state(job),
+    }, protocol=protocol)
+
+
+def loads_spec(data, **kwargs):
+    """
+    read a job spec, data that is not a spec is read as a pickled job of older versions
+    :param data: bytes
+    :param kwargs: passed to dill for old job files
+    :return: spec dict whit decoded definition or a instance of Job for old job files
+    """
+    try:
+        spec = pickle.loads(data)
+    except Exception as E:
+        # job files before version 1 are whole jobs pickled whit dill
+        if dill is None:
+            raise SerializationError('job is not a job spec, dill is needed to read old job files') from E
+        spec = dill.loads(data, **kwargs)
+    if isinstance(spec, Job):
+        return spec
+    if not isinstance(spec, dict) or spec.get('format') != FORMAT:
+        raise SerializationError('data is not a job spec')
+    if spec['version'] > VERSION:
+        raise SerializationError(f'job spec version {spec["version"]} is newer than {VERSION}')
+    spec['definition'] = decode_definition(spec['definition'])
+    return spec
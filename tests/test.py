@@ -22,9 +22,9 @@
 
 import datetime
 import time
-from unittest import TestCase
+from unittest import TestCase, skipUnless
 
-from src.agent import Agent, job
+from src.agent import Agent, job, scheduler, serialization
 
 
 def _test_func(t):
@@ -42,6 +42,19 @@ def _test_func_list_int_str(t):
     time.sleep(2)
 
 
+def _sleep(seconds):
+    time.sleep(seconds)
+
+
+def _pid_and_square(x):
+    import os
+    return os.getpid(), x * x
+
+
+def _raise_value_error():
+    raise ValueError('test_exception')
+
+
 class TestAgent(TestCase):
     options = {
         'scheduler': 'interval',
@@ -259,6 +272,32 @@ class TestAgent(TestCase):
         time.sleep(0.7)
         self.assertEqual(job.status['jfh'], 3)
 
+    def test_job_backoff_after_fail(self):
+        start_time = datetime.datetime.now()
+        options = {
+            'scheduler': 'interval',
+            'start_time': start_time,
+            'interval': 100,
+            'job_fail_handler': {'Handler': 'backoff', 'base': 0.05, 'factor': 2, 'cap': 0.2,
+                                 'num_restart_trys_after_fail': 3}
+        }
+        agent = Agent()
+        runs = []
+
+        @agent.create_job_decorator(options=options, name='job_backoff')
+        def always_fail():
+            runs.append(time.monotonic())
+            raise Exception('test_exception')
+
+        agent.start()
+        time.sleep(1.5)
+        agent.stop()
+        job = agent.get_job_by_name('job_backoff')
+        # first run and 3 retries whit growing random delays, then regular schedule
+        self.assertEqual(4, len(runs))
+        self.assertTrue(all(b - a <= 0.3 for a, b in zip(runs, runs[1:])))
+        self.assertEqual(start_time + datetime.timedelta(seconds=100), job.next_run_time)
+
     def test_job_restart_after_fail_force_run_agent(self):
         from src.agent.handler import JobFailHandler
 
@@ -341,3 +380,1166 @@ class TestAgent(TestCase):
         job_a1 = agent.get_job_by_name('job_a1')
         job_a1_loaded = agent.get_job_by_name('job_a1 (1)')
         self.assertEqual(job_a1_loaded._func.__code__.co_code, job_a1._func.__code__.co_code)
+
+    def test_agent_wakeup_on_new_job(self):
+        agent = Agent()
+        agent.start()
+        time.sleep(0.2)
+        t = [0, '0']
+        options = {
+            'scheduler': 'interval',
+            'start_time': datetime.datetime.now() + datetime.timedelta(seconds=0.3),
+            'interval': 100
+        }
+        agent.create_job(func=_test_func_list_int_str, options=options, args=(t,), name='job_w1')
+        time.sleep(0.5)
+        self.assertEqual([1, '1'], t)
+        agent.stop()
+
+
+class TestHeapScheduler(TestCase):
+    class _Job:
+        def __init__(self, seconds):
+            self.next_run_time = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+
+    def test_pop_due_order_and_cancel(self):
+        from src.agent.scheduler import HeapScheduler
+        scheduler = HeapScheduler()
+        j1, j2, j3 = self._Job(-2), self._Job(-1), self._Job(60)
+        for j in (j3, j2, j1):
+            scheduler.schedule(j)
+        scheduler.schedule(j2)
+        scheduler.cancel(j1)
+        self.assertEqual([j2], scheduler.pop_due())
+        self.assertEqual(1, len(scheduler))
+        self.assertEqual([], scheduler.pop_due())
+
+    def test_wait_until_notify(self):
+        import threading
+        from src.agent.scheduler import HeapScheduler
+        scheduler = HeapScheduler()
+        threading.Timer(0.1, scheduler.notify).start()
+        started = time.monotonic()
+        scheduler.wait(timeout=5)
+        self.assertLess(time.monotonic() - started, 1)
+
+
+class TestTimingWheelScheduler(TestCase):
+    class _Job:
+        def __init__(self, seconds):
+            self.next_run_time = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+
+    def test_every_job_pop_once_and_not_early(self):
+        import random
+        from src.agent.scheduler import TimingWheelScheduler
+        tick, step = 0.01, 0.03
+        scheduler = TimingWheelScheduler(tick=tick, wheel_size=4, levels=2)
+        offsets = [random.uniform(-1, 5) for _ in range(300)]
+        t0 = time.monotonic()
+        jobs = [self._Job(offset) for offset in offsets]
+        for j in jobs:
+            scheduler.schedule(j)
+        for j in jobs[::3]:
+            scheduler.cancel(j)
+        t1 = time.monotonic()
+        popped = {}
+        now = t0
+        while now < t1 + 6:
+            now += step
+            for j in scheduler.pop_due(now):
+                self.assertNotIn(j, popped)
+                popped[j] = now
+        self.assertEqual(0, len(scheduler))
+        kept = [(j, o) for i, (j, o) in enumerate(zip(jobs, offsets)) if i % 3]
+        self.assertEqual(len(kept), len(popped))
+        for j, offset in kept:
+            self.assertGreaterEqual(popped[j], t0 + offset - 0.01)
+            self.assertLessEqual(popped[j], max(t1, t1 + offset) + tick + step + 0.01)
+
+    def test_agent_with_timing_wheel(self):
+        agent = Agent(scheduler_options={'backend': 'timing_wheel', 'tick': 0.05})
+        t = [0, '0']
+        agent.create_job(func=_test_func_list_int_str, options=TestAgent.options, args=(t,), name='job_tw1')
+        agent.start()
+        time.sleep(0.3)
+        self.assertEqual([1, '1'], t)
+        agent.stop()
+
+
+@skipUnless(scheduler.numpy, 'numpy is not installed')
+class TestVectorizedScheduler(TestCase):
+    class _Job:
+        def __init__(self, seconds):
+            self.next_run_time = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+
+    def test_pop_due_and_mark_running(self):
+        from src.agent.scheduler import VectorizedScheduler
+        s = VectorizedScheduler(capacity=2)
+        j1, j2, j3 = self._Job(-1), self._Job(-1), self._Job(60)
+        for j in (j1, j2, j3):
+            s.schedule(j)
+        s.cancel(j3)
+        now = time.monotonic()
+        self.assertEqual({j1, j2}, set(s.pop_due(now)))
+        # running jobs are not popped again until they schedule themselves
+        self.assertEqual([], s.pop_due(now + 20))
+        self.assertIsNone(s.next_deadline())
+        s.schedule(j2)
+        self.assertEqual([j2], s.pop_due(now + 20))
+        self.assertEqual(2, len(s))
+
+    def test_agent_with_vectorized(self):
+        agent = Agent(scheduler_options={'backend': 'vectorized'})
+        t = [0, '0']
+        agent.create_job(func=_test_func_list_int_str, options=TestAgent.options, args=(t,), name='job_vec1')
+        agent.start()
+        time.sleep(0.3)
+        self.assertEqual([1, '1'], t)
+        agent.stop()
+
+
+class TestMisfire(TestCase):
+    def _runs(self, **options):
+        agent = Agent()
+        counter = [0]
+        options = {
+            'scheduler': 'interval',
+            'start_time': datetime.datetime.now() - datetime.timedelta(seconds=10),
+            'interval': 1,
+            **options
+        }
+        agent.create_job(func=_test_func, options=options, args=(counter,), name='misfire_1')
+        job = agent.get_job_by_name('misfire_1')
+        agent.start()
+        time.sleep(0.5)
+        agent.stop()
+        return counter[0], job
+
+    def test_replay_all_by_default(self):
+        runs, job = self._runs()
+        self.assertEqual(11, runs)
+        # slots are start_time + n * interval
+        self.assertEqual(datetime.timedelta(seconds=11), job.next_run_time - job.options['start_time'])
+
+    def test_coalesce(self):
+        runs, job = self._runs(coalesce=True)
+        self.assertEqual(2, runs)
+        self.assertLess(job.status['last_lag'], 0.5)
+
+    def test_catch_up(self):
+        runs, job = self._runs(catch_up=3)
+        self.assertEqual(4, runs)
+
+    def test_misfire_grace_time(self):
+        runs, job = self._runs(misfire_grace_time=0.5)
+        self.assertEqual(1, runs)
+        self.assertEqual(1, job.status['misfire_count'])
+
+
+class TestJobStore(TestCase):
+    options = {
+        'scheduler': 'interval',
+        'start_time': datetime.datetime.now(),
+        'interval': 1
+    }
+
+    def test_sqlite_due_jobs_and_state(self):
+        from src.agent.jobstore import SQLiteJobStore
+        store = SQLiteJobStore()
+        agent = Agent(jobstore=store)
+        agent.create_job(func=_test_func, options=self.options, args=([0],), name='store_1')
+        later = {**self.options, 'start_time': datetime.datetime.now() + datetime.timedelta(days=1)}
+        agent.create_job(func=_test_func, options=later, args=([0],), name='store_2')
+        for name in ('store_1', 'store_2'):
+            agent.store_job(name)
+        self.assertEqual(2, len(store))
+        due = store.get_due_jobs(datetime.datetime.now() + datetime.timedelta(seconds=60))
+        self.assertEqual(['store_1'], [record['name'] for record in due])
+        self.assertIs(_test_func, due[0]['definition']['func'])
+
+        job = agent.get_job_by_name('store_1')
+        job.is_enable = False
+        self.assertEqual([], store.get_due_jobs(datetime.datetime.now() + datetime.timedelta(seconds=60)))
+        agent.remove_job('store_2')
+        self.assertIsNone(store.get_job('store_2'))
+
+    def test_agent_load_due_jobs_from_store(self):
+        import os
+        import tempfile
+        from src.agent.jobstore import SQLiteJobStore
+        path = os.path.join(tempfile.mkdtemp(), 'jobs.db')
+        agent = Agent(jobstore=SQLiteJobStore(path))
+        options = {**self.options, 'start_time': datetime.datetime.now()}
+        agent.create_job(func=_test_func, options=options, args=([0],), name='store_3')
+        agent.store_job('store_3')
+
+        # a new agent whit the same file only load due jobs and keep their state
+        agent_2 = Agent(jobstore=SQLiteJobStore(path), jobstore_options={'window': 10})
+        self.assertIsNone(agent_2.get_job_by_name('store_3'))
+        agent_2.start()
+        time.sleep(0.3)
+        agent_2.stop()
+        job = agent_2.get_job_by_name('store_3')
+        self.assertEqual(1, job._args[0][0])
+        record = SQLiteJobStore(path).get_job('store_3')
+        self.assertEqual('success', record['last_run_state'])
+        self.assertEqual(job.next_run_time, record['next_run_time'])
+
+
+class TestSerialization(TestCase):
+    options = {
+        'scheduler': 'interval',
+        'start_time': datetime.datetime.now() + datetime.timedelta(days=1),
+        'interval': 60
+    }
+
+    def test_spec_keep_state_and_reference_function(self):
+        import pickle
+        agent = Agent()
+        agent.create_job(func=_test_func, options=self.options, args=([0],), name='spec_1')
+        job = agent.get_job_by_name('spec_1')
+        job._fail_count = 3
+        job.is_enable = False
+        data = agent.dumps_job(job)
+        spec = pickle.loads(data)
+        self.assertEqual(1, spec['version'])
+        self.assertEqual('tests.test:_test_func', spec['definition']['func'])
+
+        loaded = Agent().loads_job(data)
+        self.assertIs(_test_func, loaded._func)
+        self.assertEqual(3, loaded.fail_count)
+        self.assertFalse(loaded.is_enable)
+        self.assertEqual(job.next_run_time, loaded.next_run_time)
+
+    @skipUnless(not serialization.dill, 'dill can save lambda')
+    def test_unreferenced_function_without_dill(self):
+        from src.agent.exceptions import SerializationError
+        agent = Agent()
+        agent.create_job(func=lambda: None, options=self.options, name='spec_2')
+        with self.assertRaises(SerializationError):
+            agent.dumps_job(agent.get_job_by_name('spec_2'))
+
+    def test_load_jobs(self):
+        import os
+        import tempfile
+        directory = tempfile.mkdtemp()
+        agent = Agent()
+        for i in range(3):
+            agent.create_job(func=_test_func, options=self.options, args=([i],), name=f'spec_dir_{i}')
+            agent.save_job(agent.get_job_by_name(f'spec_dir_{i}'), directory)
+        with open(os.path.join(directory, 'broken.job'), 'wb') as file:
+            file.write(b'not a job')
+
+        loader = Agent()
+        report = loader.load_jobs(directory, workers=2)
+        self.assertEqual(['spec_dir_0', 'spec_dir_1', 'spec_dir_2'], [j.name for j in report.jobs])
+        self.assertEqual([[0], [1], [2]], [j._args[0] for j in report.jobs])
+        self.assertEqual([os.path.join(directory, 'broken.job')], list(report.errors))
+        self.assertEqual(3, report.read)
+        # manifest stay in memory of agent
+        self.assertEqual(['broken.job', 'spec_dir_0.job', 'spec_dir_1.job', 'spec_dir_2.job'], sorted(os.listdir(directory)))
+
+        # unchanged files are skipped and their jobs are kept, a file whit only a new mtime is unchanged
+        old_jobs = list(loader.jobs)
+        os.utime(os.path.join(directory, 'spec_dir_0.job'))
+        agent.save_job(agent.get_job_by_name('spec_dir_1'), directory, file_name='spec_dir_3')
+        report = loader.load_jobs(directory)
+        self.assertEqual(4, len(report.jobs))
+        self.assertEqual(4, len(loader.jobs))
+        self.assertEqual(old_jobs, report.jobs[:3])
+        self.assertEqual((1, 3), (report.read, report.cached))
+
+        # nothing changed, nothing read
+        report = loader.load_jobs(directory)
+        self.assertEqual((0, 4), (report.read, report.cached))
+
+        # a new agent decode every file
+        self.assertEqual(4, Agent().load_jobs(directory).read)
+
+
+class TestHotReload(TestCase):
+    options = {
+        'scheduler': 'interval',
+        'start_time': datetime.datetime.now() + datetime.timedelta(days=1),
+        'interval': 60
+    }
+
+    def test_watch_directory(self):
+        import os
+        import tempfile
+        directory = tempfile.mkdtemp()
+        writer = Agent()
+        writer.create_job(func=_test_func, options=self.options, args=([0],), name='watch_1')
+        writer.save_job(writer.get_job_by_name('watch_1'), directory)
+        agent = Agent(watch_options={'directory': directory, 'poll_interval': 0})
+
+        agent._poll_watch()
+        old = agent.get_job_by_name('watch_1')
+        self.assertEqual([[0]], [j._args[0] for j in agent.jobs])
+
+        # changed file swap job but keep its place in timer queue
+        writer.get_job_by_name('watch_1')._args = ([1],)
+        writer.save_job(writer.get_job_by_name('watch_1'), directory)
+        old._is_not_running.clear()
+        agent._poll_watch()
+        self.assertIs(old, agent.get_job_by_name('watch_1'))
+        old._is_not_running.set()
+        old._schedule()
+        new = agent.get_job_by_name('watch_1')
+        self.assertIsNot(old, new)
+        self.assertEqual([1], new._args[0])
+        self.assertEqual(old.next_run_time, new.next_run_time)
+        self.assertEqual(1, len(agent.jobs))
+
+        # nothing changed, nothing read
+        agent._poll_watch()
+        self.assertIs(new, agent.get_job_by_name('watch_1'))
+
+        os.remove(os.path.join(directory, 'watch_1.job'))
+        agent._poll_watch()
+        self.assertEqual(0, len(agent.jobs))
+
+
+class TestCheckpoint(TestCase):
+    options = {
+        'scheduler': 'interval',
+        'start_time': datetime.datetime.now() + datetime.timedelta(days=1),
+        'interval': 60
+    }
+
+    def test_restart_resume_state(self):
+        import os
+        import tempfile
+        from src.agent.checkpoint import CheckpointLog
+        path = os.path.join(tempfile.mkdtemp(), 'agent.ckpt')
+        agent = Agent(checkpoint=CheckpointLog(path))
+        agent.create_job(func=_test_func, options=self.options, args=([0],), name='ckpt_1')
+        agent.create_job(func=_test_func, options=self.options, args=([0],), name='ckpt_2')
+        job = agent.get_job_by_name('ckpt_1')
+        job._fail_count = 2
+        job.next_run_time = datetime.datetime(2030, 1, 1)
+        agent.remove_job('ckpt_2')
+        agent._checkpoint.close()
+        # torn frame of a crash in the middle of a write
+        with open(path, 'ab') as file:
+            file.write(b'\x10\x00\x00')
+
+        checkpoint = CheckpointLog(path, sync_interval=0)
+        self.assertEqual(1, len(checkpoint))
+        agent = Agent(checkpoint=checkpoint)
+        agent.create_job(func=_test_func, options=self.options, args=([0],), name='ckpt_1')
+        agent.create_job(func=_test_func, options=self.options, args=([0],), name='ckpt_2')
+        self.assertEqual(datetime.datetime(2030, 1, 1), agent.get_job_by_name('ckpt_1').next_run_time)
+        self.assertEqual(2, agent.get_job_by_name('ckpt_1').fail_count)
+        self.assertEqual(0, agent.get_job_by_name('ckpt_2').fail_count)
+        checkpoint.close()
+
+    def test_compaction(self):
+        import os
+        import tempfile
+        from src.agent.checkpoint import CheckpointLog
+        path = os.path.join(tempfile.mkdtemp(), 'agent.ckpt')
+        agent = Agent(checkpoint=CheckpointLog(path, sync_interval=0, compact_min=8))
+        agent.create_job(func=_test_func, options=self.options, args=([0],), name='ckpt_3')
+        job = agent.get_job_by_name('ckpt_3')
+        for i in range(20):
+            job.next_run_time = datetime.datetime(2030, 1, 1 + i)
+        agent._checkpoint.close()
+        checkpoint = CheckpointLog(path)
+        self.assertLess(checkpoint._frames, 8)
+        self.assertEqual(datetime.datetime(2030, 1, 20), checkpoint.pop_replayed('ckpt_3')['next_run_time'])
+        checkpoint.close()
+
+
+class TestRunHistory(TestCase):
+
+    def test_ring_buffer_and_quantiles(self):
+        import random
+        from src.agent import history
+        runs = history.RunHistory(size=3)
+        for i in range(5):
+            runs.record(i, i / 10, 0.0, history.FAILED if i == 4 else history.SUCCESS)
+        self.assertEqual([2, 3, 4], [run[0] for run in runs.runs()])
+        self.assertEqual('failed', runs.runs()[-1][3])
+        self.assertEqual(0.2, runs.stats()['failure_rate'])
+
+        estimator = history.P2Quantile(0.95)
+        rng = random.Random(1)
+        for _ in range(10000):
+            estimator.add(rng.random())
+        self.assertAlmostEqual(0.95, estimator.value(), delta=0.01)
+
+    def test_concurrent_record(self):
+        import pickle
+        import threading
+        from src.agent import history
+        runs = history.RunHistory(size=50)
+
+        def record(seed):
+            for i in range(2000):
+                runs.record(i, ((seed * 7919 + i) % 1000) / 1000, 0.0, history.SUCCESS)
+
+        threads = [threading.Thread(target=record, args=(seed,)) for seed in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(16000, runs.stats()['runs'])
+        self.assertEqual(50, len(runs.runs()))
+        # markers of estimators stay ordered
+        for estimator in runs._duration_quantiles:
+            self.assertEqual(sorted(estimator._heights), estimator._heights)
+            self.assertEqual(16000, estimator._positions[4])
+        self.assertEqual(runs.stats(), pickle.loads(pickle.dumps(runs)).stats())
+
+    def test_limit_return_measure_nested_values(self):
+        from src.agent import history
+        # a small list that refer to big strings is big
+        big = ['x' * 10000, 'y' * 10000]
+        self.assertEqual((None, True), history.limit_return(big, 1024))
+        self.assertEqual((None, True), history.limit_return({'data': [b'z' * 10000]}, 1024))
+        shared = 'x' * 100
+        self.assertEqual(([shared] * 50, False), history.limit_return([shared] * 50, 1024))
+
+    def test_job_history_and_max_return_size(self):
+        agent = Agent()
+        options = {
+            'scheduler': 'interval',
+            'start_time': datetime.datetime.now() + datetime.timedelta(days=1),
+            'interval': 60,
+            'history_size': 2,
+            'max_return_size': 4
+        }
+        agent.create_job(func=lambda: 'a long return value', options=options, name='history_1')
+        agent.create_job(func=lambda: list(range(1000)), options=options, name='history_2')
+        agent.create_job(func=_raise_value_error, options=options, name='history_3')
+        for name in ('history_1', 'history_2', 'history_3'):
+            agent.run_job_by_name(name)
+            agent.get_job_by_name(name).job_thread.join()
+        self.assertEqual('a lo', agent.get_job_by_name('history_1').status['last_return'])
+        self.assertIsNone(agent.get_job_by_name('history_2').status['last_return'])
+        self.assertEqual(1, agent.get_job_by_name('history_1').history.stats()['runs'])
+        self.assertEqual(1.0, agent.get_job_by_name('history_3').history.stats()['failure_rate'])
+
+
+class TestMetrics(TestCase):
+
+    def test_agent_metrics_snapshot_and_http(self):
+        import urllib.request
+        agent = Agent(metrics_options={'port': 0})
+        options = {
+            'scheduler': 'interval',
+            'start_time': datetime.datetime.now() + datetime.timedelta(days=1),
+            'interval': 60,
+            'tags': ['etl']
+        }
+        agent.create_job(func=_test_func, options=options, args=([0],), name='metrics_1')
+        agent.create_job(func=_raise_value_error, options=options, name='metrics_2')
+        for name in ('metrics_1', 'metrics_2'):
+            agent.run_job_by_name(name)
+            agent.get_job_by_name(name).job_thread.join()
+
+        snapshot = agent.metrics.snapshot()
+        runs = {(labels['job'], labels['outcome']): value for labels, value in snapshot['agent_job_runs_total']}
+        self.assertEqual({('metrics_1', 'success'): 1, ('metrics_2', 'failed'): 1}, runs)
+        [(labels, value)] = snapshot['agent_tag_duration_seconds']
+        self.assertEqual(({'tag': 'etl'}, 2), (labels, value['count']))
+
+        agent.start()
+        try:
+            port = agent._metrics_server.server_address[1]
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics') as response:
+                text = response.read().decode()
+        finally:
+            agent.stop()
+        self.assertIn('agent_job_runs_total{job="metrics_1",outcome="success"} 1', text)
+        self.assertIn('agent_job_duration_seconds_bucket{job="metrics_2",le="+Inf"} 1', text)
+        self.assertIn('# TYPE agent_running_jobs gauge', text)
+
+
+class TestProfiling(TestCase):
+
+    def test_sampled_profile_report(self):
+        import os
+        import pstats
+        import tempfile
+        directory = tempfile.mkdtemp()
+        agent = Agent()
+        options = {
+            'scheduler': 'interval',
+            'start_time': datetime.datetime.now() + datetime.timedelta(days=1),
+            'interval': 60,
+            'profile': {'every': 2, 'tracemalloc': True, 'dump_dir': directory}
+        }
+        agent.create_job(func=_pid_and_square, options=options, args=(3,), name='profile_1')
+        job = agent.get_job_by_name('profile_1')
+        for _ in range(4):
+            agent.run_job(job)
+            job.job_thread.join()
+
+        report = agent.profile_report('profile_1')
+        self.assertEqual((4, 2), (report['runs'], report['sampled']))
+        self.assertTrue(any('_pid_and_square' in row[0] for row in report['functions']))
+        self.assertEqual(2, len(os.listdir(directory)))
+        agent.dump_profile(job, os.path.join(directory, 'all.pstats'))
+        self.assertTrue(pstats.Stats(os.path.join(directory, 'all.pstats')).total_calls > 0)
+        self.assertEqual(['profile_1'], list(agent.profile_reports()))
+
+    def test_concurrent_runs(self):
+        import threading
+        from src.agent.profiling import RunProfiler
+        profiler = RunProfiler('profile_2', {'every': 3})
+
+        def call():
+            for i in range(300):
+                profiler.call(_pid_and_square, (i,), {})
+                profiler.report()
+
+        threads = [threading.Thread(target=call) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        report = profiler.report()
+        self.assertEqual(2400, report['runs'])
+        self.assertLessEqual(report['sampled'], 800)
+
+
+class TestWorkerPool(TestCase):
+    options = {
+        'scheduler': 'interval',
+        'start_time': datetime.datetime.now() + datetime.timedelta(days=1),
+        'interval': 100
+    }
+
+    def test_max_workers_and_thread_reuse(self):
+        import threading
+        agent = Agent(executor_options={'max_workers': 2})
+        threads = set()
+        running = [0, 0]
+        lock = threading.Lock()
+
+        def slow():
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            threads.add(threading.current_thread().name)
+            time.sleep(0.2)
+            with lock:
+                running[0] -= 1
+
+        for i in range(6):
+            agent.create_job(func=slow, options=self.options, name=f'pool_{i}')
+            agent.run_job_by_name(f'pool_{i}')
+        for pool_job in agent.get_all_jobs():
+            pool_job.job_thread.join(2)
+        self.assertEqual(2, running[1])
+        self.assertEqual(2, len(threads))
+
+    def test_drop_policy(self):
+        agent = Agent(executor_options={'max_workers': 1, 'max_queue_size': 1, 'overflow_policy': 'drop'})
+        for i in range(3):
+            agent.create_job(func=_sleep, options=self.options, args=(0.3,), name=f'drop_{i}')
+        self.assertEqual(1, agent.run_job_by_name('drop_0'))
+        time.sleep(0.05)
+        self.assertEqual(1, agent.get_job_by_name('drop_1').start())
+        self.assertEqual(0, agent.get_job_by_name('drop_2').start())
+        self.assertEqual(1, agent.get_job_by_name('drop_0').stop(1))
+
+    def test_dropped_job_run_on_next_slot(self):
+        agent = Agent(executor_options={'max_workers': 1, 'max_queue_size': 1, 'overflow_policy': 'drop'})
+        runs = []
+        agent.create_job(func=_sleep, options=self.options, args=(0.4,), name='blocker')
+        agent.create_job(func=_sleep, options=self.options, args=(0.01,), name='filler')
+        start_time = datetime.datetime.now() + datetime.timedelta(seconds=0.2)
+        agent.create_job(func=lambda: runs.append(datetime.datetime.now()), name='interval',
+                         options={'scheduler': 'interval', 'start_time': start_time, 'interval': 0.5})
+        agent.run_job_by_name('blocker')
+        time.sleep(0.05)
+        agent.run_job_by_name('filler')
+        agent.start()
+        time.sleep(1)
+        agent.stop()
+        # first slot is dropped because worker and queue are busy, job stay in timer queue for its next slot
+        self.assertEqual(1, len(runs))
+        self.assertGreaterEqual(runs[0], start_time + datetime.timedelta(seconds=0.5))
+        self.assertEqual(start_time + datetime.timedelta(seconds=1), agent.get_job_by_name('interval').next_run_time)
+
+    def test_run_late_policy(self):
+        agent = Agent(executor_options={'max_workers': 1, 'max_queue_size': 1, 'overflow_policy': 'run_late',
+                                        'run_late_delay': 0.3})
+        runs = []
+        agent.create_job(func=_sleep, options=self.options, args=(0.3,), name='blocker')
+        agent.create_job(func=_sleep, options=self.options, args=(0.01,), name='filler')
+        start_time = datetime.datetime.now() + datetime.timedelta(seconds=0.2)
+        agent.create_job(func=lambda: runs.append(datetime.datetime.now()), name='interval',
+                         options={'scheduler': 'interval', 'start_time': start_time, 'interval': 2})
+        agent.run_job_by_name('blocker')
+        time.sleep(0.05)
+        agent.run_job_by_name('filler')
+        agent.start()
+        time.sleep(1)
+        agent.stop()
+        # first slot overflow and job run run_late_delay later instead of waiting for its next slot
+        self.assertEqual(1, len(runs))
+        self.assertGreaterEqual(runs[0], start_time + datetime.timedelta(seconds=0.3))
+        self.assertLess(runs[0], start_time + datetime.timedelta(seconds=0.6))
+
+
+class TestConcurrencyLimits(TestCase):
+    options = {
+        'scheduler': 'interval',
+        'start_time': datetime.datetime.now() + datetime.timedelta(days=1),
+        'interval': 100
+    }
+
+    def _peak(self, agent, jobs, runs_per_job=1):
+        import threading
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def tracked():
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.1)
+            with lock:
+                running[0] -= 1
+
+        for name, options in jobs:
+            agent.create_job(func=tracked, options={**self.options, **options}, name=name)
+        runs = []
+        for name, _ in jobs:
+            for _ in range(runs_per_job):
+                agent.run_job_by_name(name)
+                runs.append(agent.get_job_by_name(name).job_thread)
+        return running, runs
+
+    def test_tag_and_global_limits(self):
+        agent = Agent(executor_options={'max_workers': 8, 'max_concurrent_jobs': 3, 'tag_limits': {'db': 2}})
+        jobs = [(f'db_{i}', {'tags': ['db']}) for i in range(4)] + [(f'cpu_{i}', {}) for i in range(2)]
+        running, runs = self._peak(agent, jobs)
+        # runs that wait do not hold a worker thread
+        self.assertLessEqual(agent._executor.num_workers, 3)
+        self.assertEqual(3, agent._limiter.waiting)
+        for run in runs:
+            self.assertTrue(run.join(5))
+        self.assertEqual(3, running[1])
+        self.assertEqual(0, agent._limiter.running)
+        self.assertEqual({'db': (0, 2)}, agent._limiter.tag_usage())
+
+    def test_prioritized_waiting_runs(self):
+        from src.agent.executor import JobRun
+        from src.agent.limits import ConcurrencyLimiter
+        limiter = ConcurrencyLimiter(max_concurrent_jobs=1, tag_limits={'db': 1}, prioritized=True)
+        agent = Agent()
+        for name, tags in (('first', ['db']), ('db', ['db']), ('low', []), ('high', [])):
+            agent.create_job(func=print, options={**self.options, 'tags': tags, 'max_instances': 2}, name=name)
+        job = agent.get_job_by_name
+        runs = [JobRun(job('first'), 0), JobRun(job('low'), 5), JobRun(job('db'), 1), JobRun(job('high'), 1),
+                JobRun(job('low'), 5)]
+        self.assertEqual([True, False, False, False, False], [limiter.admit(run) for run in runs])
+        order = []
+        while limiter.waiting:
+            ready = limiter.release(order[-1].job if order else job('first'))
+            self.assertEqual(1, len(ready))
+            order.extend(ready)
+        # runs whit the same key keep arrival order
+        self.assertEqual([runs[2], runs[3], runs[1], runs[4]], order)
+
+    def test_max_instances(self):
+        agent = Agent(executor_options={'max_workers': 8})
+        running, runs = self._peak(agent, [('single', {}), ('double', {'max_instances': 2})], runs_per_job=3)
+        for run in runs:
+            self.assertTrue(run.join(5))
+        self.assertEqual(3, running[1])
+        self.assertTrue(agent.get_job_by_name('double').is_not_running.is_set())
+
+
+class TestDispatchPolicy(TestCase):
+    options = {
+        'scheduler': 'interval',
+        'start_time': datetime.datetime.now() + datetime.timedelta(days=1),
+        'interval': 100
+    }
+
+    def _order(self, executor_options, jobs):
+        agent = Agent(executor_options={'max_workers': 1, **executor_options})
+        order = []
+        agent.create_job(func=_sleep, options=self.options, args=(0.2,), name='blocker')
+        agent.run_job_by_name('blocker')
+        time.sleep(0.05)
+        for name, options in jobs:
+            agent.create_job(func=order.append, options={**self.options, **options}, args=(name,), name=name)
+            agent.run_job_by_name(name)
+        for ordered_job in agent.get_all_jobs():
+            ordered_job.job_thread.join(5)
+        return agent, order
+
+    def test_priority_and_start_lag(self):
+        agent, order = self._order({'dispatch_policy': 'priority'},
+                                   [('bulk_1', {}), ('bulk_2', {}), ('critical', {'priority': 10})])
+        self.assertEqual(['critical', 'bulk_1', 'bulk_2'], order)
+        self.assertEqual([0, 10], list(agent.start_lag_stats()))
+        self.assertEqual(3, agent.start_lag_stats()[0]['count'])
+
+    def test_edf_and_aging(self):
+        _, order = self._order({'dispatch_policy': 'edf'},
+                               [('loose', {'deadline_tolerance': 60}), ('tight', {'deadline_tolerance': 1})])
+        self.assertEqual(['tight', 'loose'], order)
+        # a run that waited 0.05 s is worth more than 1 priority when aging is 0.01 s
+        agent = Agent(executor_options={'max_workers': 1, 'dispatch_policy': 'priority', 'aging': 0.01})
+        order = []
+        agent.create_job(func=_sleep, options=self.options, args=(0.2,), name='blocker')
+        agent.run_job_by_name('blocker')
+        agent.create_job(func=order.append, options=self.options, args=('old',), name='old')
+        agent.run_job_by_name('old')
+        time.sleep(0.05)
+        agent.create_job(func=order.append, options={**self.options, 'priority': 1}, args=('new',), name='new')
+        agent.run_job_by_name('new')
+        for aged_job in agent.get_all_jobs():
+            aged_job.job_thread.join(5)
+        self.assertEqual(['old', 'new'], order)
+
+
+class TestRateLimit(TestCase):
+    options = {
+        'scheduler': 'interval',
+        'start_time': datetime.datetime.now() + datetime.timedelta(days=1),
+        'interval': 100
+    }
+
+    def test_job_rate_limit(self):
+        agent = Agent(executor_options={'max_workers': 4})
+        times = []
+        agent.create_job(func=lambda: times.append(time.monotonic()), name='limited',
+                         options={**self.options, 'rate_limit': {'rate': 10, 'burst': 2}, 'max_instances': 5})
+        started = time.monotonic()
+        runs = []
+        for _ in range(5):
+            agent.run_job_by_name('limited')
+            runs.append(agent.get_job_by_name('limited').job_thread)
+        for run in runs:
+            self.assertTrue(run.join(5))
+        # 2 runs start at once and the other 3 wait for tokens that come every 0.1 s
+        self.assertEqual(5, len(times))
+        self.assertGreaterEqual(max(times) - started, 0.25)
+        stats = agent.rate_limit_stats()['jobs']['limited']
+        self.assertEqual((2, 3), (stats['allowed'], stats['throttled']))
+
+    def test_deferred_runs_share_one_thread(self):
+        import threading
+        agent = Agent(executor_options={'max_workers': 4})
+        options = {**self.options, 'rate_limit': {'rate': 1000, 'burst': 1}, 'max_instances': 500}
+        agent.create_job(func=lambda: None, name='many', options=options)
+        threads = threading.active_count()
+        runs = []
+        for _ in range(200):
+            agent.run_job_by_name('many')
+            runs.append(agent.get_job_by_name('many').job_thread)
+        self.assertLessEqual(threading.active_count() - threads, 5)
+        for run in runs:
+            self.assertTrue(run.join(5))
+
+    def test_tag_rate_limit(self):
+        from src.agent.exceptions import InvalidOption
+        agent = Agent(executor_options={'tag_rate_limits': {'api': {'rate': 10, 'burst': 1}}})
+        agent.create_job(func=print, options={**self.options, 'tags': ['api']}, name='api_1')
+        agent.create_job(func=print, options={**self.options, 'tags': ['api']}, name='api_2')
+        self.assertEqual(0.0, agent._rate_limits.reserve(agent.get_job_by_name('api_1')))
+        self.assertAlmostEqual(0.1, agent._rate_limits.reserve(agent.get_job_by_name('api_2')), delta=0.01)
+        with self.assertRaises(InvalidOption):
+            Agent(executor_options={'tag_rate_limits': {'api': {'rate': 0}}})
+
+
+class TestRunTimeout(TestCase):
+    options = {
+        'scheduler': 'interval',
+        'start_time': datetime.datetime.now() + datetime.timedelta(days=1),
+        'interval': 100
+    }
+
+    def test_cancel_token_and_timeout(self):
+        from src.agent.exceptions import JobTimeout
+        errors = []
+
+        def jfh(exception, job):
+            errors.append(exception)
+
+        def cooperative(cancel_token):
+            while not cancel_token.wait(0.01):
+                pass
+            cancel_token.raise_if_cancelled()
+
+        agent = Agent()
+        options = {**self.options, 'run_timeout': 0.2,
+                   'job_fail_handler': {'Handler': 'custom', 'custom_job_fail_Handler': jfh}}
+        agent.create_job(func=cooperative, options=options, name='cooperative')
+        agent.create_job(func=_sleep, options=options, args=(0.5,), name='ignore_token')
+        started = time.monotonic()
+        for name in ('cooperative', 'ignore_token'):
+            agent.run_job_by_name(name)
+        job = agent.get_job_by_name('cooperative')
+        self.assertTrue(job.job_thread.join(5))
+        self.assertLess(time.monotonic() - started, 0.45)
+        # a thread can not be killed, job that ignore its token is running until it return
+        ignore_token = agent.get_job_by_name('ignore_token')
+        self.assertFalse(ignore_token.is_not_running.is_set())
+        self.assertTrue(ignore_token.job_thread.join(5))
+        self.assertEqual([JobTimeout, JobTimeout], [type(e) for e in errors])
+        self.assertEqual((1, 1), (job.fail_count, ignore_token.fail_count))
+        self.assertIsNone(ignore_token.status.get('last_return'))
+
+    def test_class_job_get_cancel_token(self):
+        from unittest import mock
+        from src.agent import handler
+
+        class J(job.Job):
+            def run(self, cancel_token):
+                return cancel_token.cancelled
+
+        agent = Agent()
+        agent.create_class_job(job=J, options=self.options, name='class_1')
+        # signature of run is computed once for the class
+        with mock.patch.object(handler, 'signature', wraps=handler.signature) as signature:
+            agent.create_class_job(job=J, options=self.options, name='class_2')
+        self.assertEqual(0, signature.call_count)
+        agent.run_job_by_name('class_2')
+        agent.get_job_by_name('class_2').job_thread.join(5)
+        self.assertIs(False, agent.get_job_by_name('class_2').status['last_return'])
+
+    def test_stop(self):
+        from src.agent.job import LastRuntimeState
+
+        def cooperative(cancel_token):
+            cancel_token.wait(10)
+            cancel_token.raise_if_cancelled()
+
+        agent = Agent()
+        agent.create_job(func=cooperative, options=self.options, name='cooperative')
+        agent.create_job(func=_sleep, options=self.options, args=(0.5,), name='ignore_token')
+        for name in ('cooperative', 'ignore_token'):
+            agent.run_job_by_name(name)
+        time.sleep(0.05)
+        job = agent.get_job_by_name('cooperative')
+        self.assertEqual(1, job.stop(1))
+        self.assertEqual(LastRuntimeState.failed, job.status['LastRunState'])
+        # stop do not report a run that is still running as stopped
+        ignore_token = agent.get_job_by_name('ignore_token')
+        self.assertIsNone(ignore_token.stop(0.1))
+        self.assertFalse(ignore_token.is_not_running.is_set())
+        self.assertTrue(ignore_token.job_thread.join(5))
+
+
+class TestProcessExecutor(TestCase):
+    options = {
+        'scheduler': 'interval',
+        'start_time': datetime.datetime.now() + datetime.timedelta(days=1),
+        'interval': 100,
+        'executor': 'process'
+    }
+
+    def test_process_job_status_and_reuse(self):
+        import os
+        from src.agent.job import LastRuntimeState
+        agent = Agent(executor_options={'max_processes': 1})
+        agent.create_job(func=_pid_and_square, options=self.options, args=(7,), name='proc_1')
+        job = agent.get_job_by_name('proc_1')
+        pids = set()
+        for _ in range(2):
+            job.start()
+            job.job_thread.join(30)
+            pid, square = job.status['last_return']
+            pids.add(pid)
+            self.assertEqual(49, square)
+            self.assertEqual(job.status['LastRunState'], LastRuntimeState.success)
+        self.assertNotIn(os.getpid(), pids)
+        self.assertEqual(1, len(pids))
+        # agent has threads so workers are not forked unless asked
+        self.assertEqual('spawn', agent._process_pool._context.get_start_method())
+        agent._process_pool.shutdown()
+
+    def test_process_job_fail_handler(self):
+        def jfh(exception, job):
+            job.status['exception'] = exception
+
+        options = {**self.options, 'job_fail_handler': {'Handler': 'custom', 'custom_job_fail_Handler': jfh}}
+        agent = Agent()
+        agent.create_job(func=_raise_value_error, options=options, name='proc_2')
+        job = agent.get_job_by_name('proc_2')
+        job.start()
+        job.job_thread.join(30)
+        self.assertEqual(1, job.fail_count)
+        self.assertIsInstance(job.status['exception'], ValueError)
+        agent._process_pool.shutdown()
+
+    def test_process_job_timeout_kill_worker(self):
+        from src.agent.exceptions import JobTimeout
+
+        def jfh(exception, job):
+            job.status['exception'] = exception
+
+        options = {**self.options, 'run_timeout': 0.5,
+                   'job_fail_handler': {'Handler': 'custom', 'custom_job_fail_Handler': jfh}}
+        agent = Agent(executor_options={'max_processes': 1})
+        agent.create_job(func=_sleep, options=options, args=(30,), name='proc_hung')
+        agent.create_job(func=_pid_and_square, options=self.options, args=(3,), name='proc_next')
+        job = agent.get_job_by_name('proc_hung')
+        job.start()
+        self.assertTrue(job.job_thread.join(10))
+        self.assertIsInstance(job.status['exception'], JobTimeout)
+        self.assertEqual(0, agent._process_pool.num_processes)
+        # a new worker take place of the killed one
+        agent.run_job_by_name('proc_next')
+        agent.get_job_by_name('proc_next').job_thread.join(30)
+        self.assertEqual(9, agent.get_job_by_name('proc_next').status['last_return'][1])
+        agent._process_pool.shutdown()
+
+    def test_process_job_can_not_get_job(self):
+        from src.agent.exceptions import InvalidOption
+
+        def needs_job(job):
+            pass
+
+        agent = Agent()
+        with self.assertRaises(InvalidOption):
+            agent.create_job(func=needs_job, options=self.options, name='proc_3')
+
+
+class TestAsyncAgent(TestCase):
+    def test_coroutine_jobs_run_concurrently(self):
+        import asyncio
+        from src.agent import AsyncAgent
+        agent = AsyncAgent()
+        finished = []
+        options = {
+            'scheduler': 'interval',
+            'start_time': datetime.datetime.now(),
+            'interval': 100
+        }
+
+        async def poll(i, job):
+            await asyncio.sleep(0.3)
+            finished.append(i)
+            return job.name
+
+        for i in range(500):
+            agent.create_job(func=poll, options=options, args=(i,), name=f'async_{i}')
+        t = [0, '0']
+        agent.create_job(func=_test_func_list_int_str, options=options, args=(t,), name='async_sync')
+        agent.start()
+        time.sleep(1)
+        self.assertEqual(500, len(finished))
+        self.assertEqual('async_7', agent.get_job_by_name('async_7').status['last_return'])
+        self.assertEqual([1, '1'], t)
+        agent.stop()
+
+    def test_serve_in_running_loop(self):
+        import asyncio
+        from src.agent import AsyncAgent
+        agent = AsyncAgent()
+        options = {
+            'scheduler': 'interval',
+            'start_time': datetime.datetime.now(),
+            'interval': 0.1
+        }
+        runs = []
+
+        @agent.create_job_decorator(options=options, name='async_serve')
+        async def tick():
+            runs.append(1)
+
+        async def main():
+            serve = asyncio.ensure_future(agent.serve())
+            await asyncio.sleep(0.55)
+            agent.stop()
+            await serve
+
+        asyncio.run(main())
+        self.assertGreaterEqual(len(runs), 4)
+        self.assertFalse(agent.is_running.is_set())
+
+
+class TestJobRegistry(TestCase):
+    options = {
+        'scheduler': 'interval',
+        'start_time': datetime.datetime.now() + datetime.timedelta(days=1),
+        'interval': 100
+    }
+
+    def test_index_follow_rename_move_and_remove(self):
+        agent, other = Agent(), Agent()
+        agent.create_job(func=_test_func, options=self.options, args=([0],), name='reg_1')
+        job = agent.get_job_by_name('reg_1')
+        self.assertIs(job, agent.get_job_by_id(job.id))
+
+        job.name = 'reg_2'
+        self.assertIsNone(agent.get_job_by_name('reg_1'))
+        self.assertIs(job, agent.get_job_by_name('reg_2'))
+
+        other.create_job(func=_test_func, options=self.options, args=([0],), name='reg_2')
+        other.append_job(job)
+        self.assertEqual(0, len(agent.get_all_jobs()))
+        self.assertIs(job, other.get_job_by_name('reg_2 (1)'))
+        self.assertIs(job, other.get_job_by_id(job.id))
+        self.assertIs(other, job.agent)
+
+        self.assertEqual(1, other.remove_job('reg_2 (1)'))
+        self.assertEqual(0, other.remove_job(job))
+        self.assertIsNone(other.get_job_by_id(job.id))
+        self.assertEqual(1, len(other.get_all_jobs()))
+        self.assertEqual(1, len(other._scheduler))
+
+    def test_duplicate_name(self):
+        from src.agent.exceptions import DuplicateName
+        agent = Agent()
+        agent.create_job(func=_test_func, options=self.options, args=([0],), name='reg_3')
+        with self.assertRaises(DuplicateName):
+            agent.create_job(func=_test_func, options=self.options, args=([0],), name='reg_3')
+        with self.assertRaises(NameError):
+            agent.create_job(func=_test_func, options=self.options, args=([0],), name='reg_4')
+            agent.get_job_by_name('reg_4').name = 'reg_3'
+
+
+class TestCreateJobs(TestCase):
+    options = {
+        'scheduler': 'interval',
+        'start_time': datetime.datetime.now() + datetime.timedelta(days=1),
+        'interval': 100
+    }
+
+    def test_create_jobs(self):
+        class J(job.Job):
+            def run(self, t):
+                t.append(self.name)
+
+        agent = Agent()
+        t = []
+        jobs = agent.create_jobs([
+            {'func': _test_func, 'options': self.options, 'args': ([0],), 'name': 'bulk_1'},
+            {'job': J, 'options': self.options, 'args': (t,), 'name': 'bulk_2', 'team': 'a'},
+            {'func': _test_func, 'options': self.options, 'args': ([0],)},
+        ])
+        self.assertEqual(3, len(agent.get_all_jobs()))
+        self.assertTrue(all(j.initialized for j in jobs))
+        self.assertEqual('a', agent.get_job_by_name('bulk_2').team)
+        self.assertIs(jobs[2], agent.get_job_by_name(jobs[2].name))
+        agent.run_job_by_name('bulk_2')
+        jobs[1].job_thread.join(2)
+        self.assertEqual(['bulk_2'], t)
+        self.assertEqual(3, len(agent._scheduler))
+
+    def test_create_jobs_is_all_or_nothing(self):
+        from src.agent.exceptions import DuplicateName
+        agent = Agent()
+        with self.assertRaises(DuplicateName):
+            agent.create_jobs([{'func': _test_func, 'options': self.options, 'name': 'bulk_3'},
+                               {'func': _test_func, 'options': self.options, 'name': 'bulk_3'}])
+        self.assertEqual(0, len(agent.get_all_jobs()))
+
+
+class TestInterruptQueue(TestCase):
+    def test_no_interrupt_is_lost(self):
+        import threading
+        from src.agent.interrupt import BaseInterrupt
+
+        handled = []
+
+        class Count(BaseInterrupt):
+            def interrupt_handler(self):
+                handled.append(self)
+
+        agent = Agent()
+        agent.start()
+
+        def producer():
+            for _ in range(200):
+                Count(agent).set()
+
+        producers = [threading.Thread(target=producer) for _ in range(8)]
+        for p in producers:
+            p.start()
+        for p in producers:
+            p.join()
+        time.sleep(0.3)
+        self.assertEqual(1600, len(handled))
+        self.assertEqual(1600, len(set(map(id, handled))))
+        agent.stop()
+
+    def test_pause_resume_and_reschedule(self):
+        from src.agent.interrupt import PauseJob, RescheduleJob, ResumeJob
+        agent = Agent()
+        t = [0, '0']
+        options = {
+            'scheduler': 'interval',
+            'start_time': datetime.datetime.now() + datetime.timedelta(days=1),
+            'interval': 100
+        }
+        agent.create_job(func=_test_func_list_int_str, options=options, args=(t,), name='cmd_1')
+        job = agent.get_job_by_name('cmd_1')
+        agent.start()
+        PauseJob(agent, job).set()
+        RescheduleJob(agent, job, datetime.datetime.now()).set()
+        time.sleep(0.2)
+        self.assertFalse(job.is_enable)
+        self.assertEqual([0, '0'], t)
+        ResumeJob(agent, job).set()
+        time.sleep(0.2)
+        self.assertEqual([1, '1'], t)
+        agent.stop()
+
+
+class TestCron(TestCase):
+    def test_fields_and_aliases(self):
+        from src.agent.cron import compile_cron
+        after = datetime.datetime(2021, 3, 10, 12, 7, 30)
+        self.assertEqual(datetime.datetime(2021, 3, 10, 12, 10), compile_cron('*/5 * * * *').next_fire_time(after))
+        self.assertEqual(datetime.datetime(2021, 3, 10, 12, 7, 45),
+                         compile_cron('*/15 * * * * *').next_fire_time(after))
+        self.assertEqual(datetime.datetime(2021, 3, 11), compile_cron('@daily').next_fire_time(after))
+        self.assertEqual(datetime.datetime(2022, 1, 1), compile_cron('@yearly').next_fire_time(after))
+        self.assertEqual(datetime.datetime(2021, 3, 15, 9), compile_cron('0 9 * * MON-FRI').next_fire_time(
+            datetime.datetime(2021, 3, 12, 10)))
+        # day of month and day of week are or-ed when both are restricted
+        self.assertEqual(datetime.datetime(2021, 3, 13), compile_cron('0 0 13 * 5').next_fire_time(
+            datetime.datetime(2021, 3, 12, 10)))
+        self.assertEqual(datetime.datetime(2024, 2, 29), compile_cron('0 0 29 2 *').next_fire_time(after))
+        self.assertIs(compile_cron('@hourly'), compile_cron('@hourly'))
+
+    def test_invalid_expression(self):
+        from src.agent.cron import compile_cron
+        from src.agent.exceptions import InvalidOption
+        for expression in ('* * * *', '61 * * * *', '0 0 30 2 *', '*/0 * * * *', 'a b c d e'):
+            with self.assertRaises(InvalidOption):
+                compile_cron(expression)
+
+    def test_dst(self):
+        from src.agent.cron import compile_cron, get_timezone
+        tz = get_timezone('America/New_York')
+        utc = datetime.timezone.utc
+        # 02:30 do not exist on 2021-03-14, it fire after the jump
+        fire = compile_cron('30 2 * * *').next_fire_time(datetime.datetime(2021, 3, 14, 6, tzinfo=utc), tz)
+        self.assertEqual(datetime.datetime(2021, 3, 14, 7, 30, tzinfo=utc), fire.astimezone(utc))
+        # 01:30 happen twice on 2021-11-07, fixed time fire once
+        daily = compile_cron('30 1 * * *')
+        fire = daily.next_fire_time(datetime.datetime(2021, 11, 7, 4, tzinfo=utc), tz)
+        self.assertEqual(datetime.datetime(2021, 11, 7, 5, 30, tzinfo=utc), fire.astimezone(utc))
+        fire = daily.next_fire_time(fire, tz)
+        self.assertEqual(datetime.datetime(2021, 11, 8, 6, 30, tzinfo=utc), fire.astimezone(utc))
+        # hourly jobs also run in the repeated hour
+        fires = [datetime.datetime(2021, 11, 7, 4, 59, tzinfo=utc)]
+        for _ in range(3):
+            fires.append(compile_cron('0 * * * *').next_fire_time(fires[-1], tz))
+        self.assertEqual([5, 6, 7], [f.astimezone(utc).hour for f in fires[1:]])
+
+    def test_cron_job(self):
+        agent = Agent()
+        options = {
+            'scheduler': 'cron',
+            'cron': '* * * * * *',
+            'start_time': datetime.datetime.now()
+        }
+        agent.create_job(func=_test_func, options=options, args=([0],), name='cron_1')
+        job = agent.get_job_by_name('cron_1')
+        self.assertEqual(0, job.next_run_time.microsecond)
+        self.assertLessEqual(job.next_run_time - datetime.datetime.now(), datetime.timedelta(seconds=1))